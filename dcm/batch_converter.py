@@ -0,0 +1,272 @@
+import argparse
+import csv
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from radlib.dcm import converters
+
+
+def input_types(to_type: str) -> list:
+    """
+    the file types find_inputs looks for by default: those the conversion graph can turn into to_type. to_type itself
+    is left out, those are earlier outputs, and so is .dcm, a folder of DICOM is mostly image slices rather than the
+    RTSTRUCTs the graph reads, so those have to be asked for with from_type
+
+    Parameters
+    ----------
+    to_type: str
+        the type to convert to
+
+    Returns
+    -------
+    a list of file types
+    """
+    return [file_type for file_type in converters.conversion_formats
+            if file_type not in (to_type, '.dcm') and converters.conversion_plan(file_type, to_type) is not None]
+
+
+def find_inputs(inputs: list, from_type: str = None, to_type: str = None, output_dir: str = None) -> list:
+    """
+    expand files, folders (searched recursively) and glob patterns into the files to convert
+
+    Parameters
+    ----------
+    inputs: list
+        paths, folders or glob patterns
+    from_type: str, optional, default None
+        only keep files of this type (see converters.image_file_type), otherwise the input_types of to_type, or any
+        type the conversion graph reads when that isn't given either
+    to_type: str, optional, default None
+        the type to convert to
+    output_dir: str, optional, default None
+        folder the converted files go in, files under it are outputs and are skipped
+
+    Returns
+    -------
+    a sorted list of unique file paths
+    """
+    if from_type is not None:
+        types = [from_type]
+    elif to_type is not None:
+        types = input_types(to_type)
+    else:
+        types = list(converters.conversion_formats)
+    output_root = None if output_dir is None else os.path.join(os.path.abspath(output_dir), '')
+    paths = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = glob.glob(os.path.join(item, '**', '*'), recursive=True)
+        else:
+            candidates = glob.glob(item, recursive=True) if glob.has_magic(item) else [item]
+        for path in candidates:
+            if output_root is not None and os.path.abspath(path).startswith(output_root):
+                continue
+            if os.path.isfile(path) and converters.image_file_type(path) in types:
+                paths.add(path)
+    if to_type is not None:
+        # converted files written next to their inputs by an earlier run
+        outputs = {os.path.abspath(output_path(path, to_type)) for path in paths}
+        paths = {path for path in paths if os.path.abspath(path) not in outputs}
+    return sorted(paths)
+
+
+def input_root(input_paths: list) -> str:
+    # the deepest folder holding all the inputs, their paths under it are kept under output_dir
+    if len(input_paths) == 0:
+        return ''
+    return os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in input_paths])
+
+
+def output_path(input_path: str, to_type: str, output_dir: str = None, root: str = None) -> str:
+    """
+    the converted file's path: the input name with the new type, next to the input or in output_dir
+
+    Parameters
+    ----------
+    input_path: str
+        the file to convert
+    to_type: str
+        the type to convert to, eg ".nii.gz"
+    output_dir: str, optional, default None
+        folder for the converted file
+    root: str, optional, default None
+        with output_dir, the folder the input's path is kept relative to (see input_root), so inputs with the same
+        name in different folders don't collide
+
+    Returns
+    -------
+    the path
+    """
+    from_type = converters.image_file_type(input_path)
+    name = os.path.basename(input_path)[:-len(from_type)] if from_type else os.path.basename(input_path)
+    if output_dir is None:
+        folder = os.path.dirname(input_path)
+    elif root is None:
+        folder = output_dir
+    else:
+        folder = os.path.join(output_dir, os.path.relpath(os.path.dirname(os.path.abspath(input_path)), root))
+    return os.path.normpath(os.path.join(folder, name + to_type))
+
+
+def is_up_to_date(input_path: str, converted_path: str) -> bool:
+    # the converted file exists and is no older than its input
+    try:
+        return os.path.getmtime(converted_path) >= os.path.getmtime(input_path)
+    except OSError:
+        return False
+
+
+def convert_one(input_path: str, converted_path: str, force: bool = False) -> dict:
+    """
+    convert one file, in a worker process
+
+    Parameters
+    ----------
+    input_path: str
+        the file to convert
+    converted_path: str
+        the file to write
+    force: bool=False
+        convert even when converted_path is up to date
+
+    Returns
+    -------
+    dict of input, output, status ("converted", "skipped", "unsupported" or "failed"), seconds and error
+    """
+    result = {'input': input_path, 'output': converted_path, 'status': 'skipped', 'seconds': 0.0, 'error': ''}
+    if not force and is_up_to_date(input_path, converted_path):
+        return result
+
+    start = time.perf_counter()
+    try:
+        if os.path.dirname(converted_path) != '':
+            os.makedirs(os.path.dirname(converted_path), exist_ok=True)
+        converted = converters.convert_file(input_path, to_path=converted_path)
+        result['status'] = 'converted' if converted else 'unsupported'
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def batch_convert(input_paths: list, to_type: str, output_dir: str = None, workers: int = None, force: bool = False,
+                  verbose: bool = True) -> list:
+    """
+    convert many files over a process pool, largest first so a big file doesn't start last and hold up the batch
+
+    Parameters
+    ----------
+    input_paths: list
+        the files to convert
+    to_type: str
+        the type to convert to
+    output_dir: str, optional, default None
+        folder for the converted files, otherwise next to each input. Their paths under the folder holding all the
+        inputs are kept
+    workers: int, optional, default None
+        number of processes (default: os.cpu_count()), 1 converts in this process
+    force: bool=False
+        convert files that are already up to date
+    verbose: bool=True
+        print each result as it finishes
+
+    Returns
+    -------
+    the convert_one results, in the order they finished
+    """
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    jobs = sorted(input_paths, key=lambda path: os.path.getsize(path), reverse=True)
+    root = input_root(input_paths)
+    jobs = [(path, output_path(path, to_type, output_dir, root)) for path in jobs]
+
+    results = []
+
+    def finished(result):
+        results.append(result)
+        if verbose:
+            print(f"{result['status']:>11} {result['seconds']:8.2f}s {result['input']} {result['error']}".rstrip())
+
+    if workers <= 1:
+        for input_path, converted_path in jobs:
+            finished(convert_one(input_path, converted_path, force))
+        return results
+
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(convert_one, input_path, converted_path, force)
+                   for input_path, converted_path in jobs]
+        for future in as_completed(futures):
+            finished(future.result())
+    return results
+
+
+def summarize(results: list, elapsed: float = None) -> str:
+    """
+    a short report of a batch: counts by status, conversion time and the slowest files
+
+    Parameters
+    ----------
+    results: list
+        from batch_convert
+    elapsed: float, optional, default None
+        wall time of the batch in seconds
+
+    Returns
+    -------
+    the report text
+    """
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    converted = [result for result in results if result['status'] == 'converted']
+    lines = [f'{len(results)} files: ' + ', '.join(f'{count} {status}' for status, count in sorted(counts.items()))]
+    if len(converted) > 0:
+        seconds = sum(result['seconds'] for result in converted)
+        lines.append(f'conversion time {seconds:.2f}s, {seconds / len(converted):.2f}s per file')
+        for result in sorted(converted, key=lambda result: result['seconds'], reverse=True)[:5]:
+            lines.append(f"  {result['seconds']:8.2f}s {result['input']}")
+    if elapsed is not None:
+        lines.append(f'wall time {elapsed:.2f}s')
+    for result in results:
+        if result['status'] == 'failed':
+            lines.append(f"failed {result['input']}: {result['error']}")
+    return '\n'.join(lines)
+
+
+def write_report(results: list, report_path: str):
+    with open(report_path, 'w', newline='') as report_file:
+        writer = csv.DictWriter(report_file, fieldnames=['input', 'output', 'status', 'seconds', 'error'])
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='convert image files through the radlib conversion graph')
+    parser.add_argument("inputs", nargs='+', help="files, folders or glob patterns to convert")
+    parser.add_argument("-t", "--to_type", required=True, help="type to convert to, eg .nii.gz")
+    parser.add_argument("-f", "--from_type",
+                        help="only convert files of this type (default: types that convert to to_type, except .dcm)")
+    parser.add_argument("-o", "--output_dir",
+                        help="folder for the converted files, under their relative paths (default: next to each input)")
+    parser.add_argument("-w", "--workers", type=int, help="number of processes (default: all cores)")
+    parser.add_argument("--force", action='store_true', help="convert files that are already up to date")
+    parser.add_argument("-r", "--report", help="path to write a csv report of every file to")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    start = time.perf_counter()
+    input_paths = find_inputs(args.inputs, args.from_type, args.to_type, args.output_dir)
+    results = batch_convert(input_paths, args.to_type, args.output_dir, args.workers, args.force)
+    print(summarize(results, time.perf_counter() - start))
+    if args.report is not None:
+        write_report(results, args.report)
+    return 1 if any(result['status'] == 'failed' for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
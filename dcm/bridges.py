@@ -0,0 +1,326 @@
+import io
+from collections import OrderedDict
+
+import nibabel
+import numpy as np
+import pydicom
+import pydicom.uid
+import SimpleITK as sitk
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.datadict import dictionary_VR
+from pydicom.multival import MultiValue
+
+from radlib.dcm.readers import sitk_image_from_datasets
+from radlib.dcm.writers import nrrd_types, nrrd_header_affine
+
+# DICOM VRs that sitk metadata strings have to be parsed into numbers for
+_int_vrs = ['US', 'SS', 'UL', 'SL']
+_float_vrs = ['FL', 'FD']
+
+# elements describing the pixel data, always set from the image itself rather than copied from its metadata
+_pixel_tags = [0x00280002, 0x00280004, 0x00280006, 0x00280010, 0x00280011, 0x00280100, 0x00280101, 0x00280102,
+               0x00280103, 0x00280008, 0x7fe00010]
+
+
+def sitk_array_view(image: sitk.Image) -> np.ndarray:
+    """
+    the pixels of an sitk Image in (x, y, z) order, as a read-only view of the image's own buffer (no copy). The image
+    must outlive the view
+
+    Parameters
+    ----------
+    image: sitk.Image
+        the image
+
+    Returns
+    -------
+    an ndarray view, with a trailing component axis for vector images
+    """
+    view = sitk.GetArrayViewFromImage(image)
+    if image.GetNumberOfComponentsPerPixel() > 1:
+        return np.moveaxis(view, -1, 0).T
+    return view.T
+
+
+def nrrd_to_sitk(nrrd_data, nrrd_header: dict) -> sitk.Image:
+    """
+    make an sitk Image from Nrrd data and header in memory
+
+    Parameters
+    ----------
+    nrrd_data: np.ndarray
+        a (x, y, z) matrix of image data
+    nrrd_header: dict
+        a Nrrd header with space directions and space origin
+
+    Returns
+    -------
+    an sitk Image
+    """
+    directions = np.array(nrrd_header['space directions'], dtype=np.float64)
+    spacing = np.linalg.norm(directions, axis=1)
+    # the transpose is a view, sitk copies it into its own buffer once
+    image = sitk.GetImageFromArray(np.asarray(nrrd_data).T)
+    image.SetSpacing(spacing.tolist())
+    image.SetOrigin(np.array(nrrd_header['space origin'], dtype=np.float64).tolist())
+    image.SetDirection((directions / spacing[:, None]).T.ravel().tolist())
+    return image
+
+
+def sitk_to_nrrd(image: sitk.Image, copy: bool = True):
+    """
+    make Nrrd data and header from an sitk Image in memory
+
+    Parameters
+    ----------
+    image: sitk.Image
+        a three dimensional image
+    copy: bool=True
+        copy the pixels, otherwise nrrd_data is a read-only view of the image's buffer (see sitk_array_view)
+
+    Returns
+    -------
+    (nrrd_data, nrrd_header)
+    """
+    nrrd_data = sitk.GetArrayFromImage(image).T if copy else sitk_array_view(image)
+    direction = np.array(image.GetDirection(), dtype=np.float64).reshape(3, 3)
+
+    nrrd_header = OrderedDict()
+    nrrd_header['type'] = nrrd_types.get(nrrd_data.dtype.str[1:], 'double')
+    nrrd_header['dimension'] = 3
+    nrrd_header['space'] = 'left-posterior-superior'
+    nrrd_header['sizes'] = np.array(nrrd_data.shape)
+    nrrd_header['space directions'] = direction.T * np.array(image.GetSpacing())[:, None]
+    nrrd_header['encoding'] = 'gzip'
+    if nrrd_data.dtype.itemsize > 1:
+        nrrd_header['endian'] = 'little'
+    nrrd_header['kinds'] = ('domain', 'domain', 'domain')
+    nrrd_header['space origin'] = np.array(image.GetOrigin(), dtype=np.float64)
+    return nrrd_data, nrrd_header
+
+
+def sitk_to_nibabel(image: sitk.Image) -> nibabel.Nifti1Image:
+    """
+    make a nibabel NIfTI image from an sitk Image in memory, sharing the image's pixel buffer
+
+    Parameters
+    ----------
+    image: sitk.Image
+        a three dimensional image, which must outlive the NIfTI image
+
+    Returns
+    -------
+    a nibabel.Nifti1Image
+    """
+    nrrd_data, nrrd_header = sitk_to_nrrd(image, copy=False)
+    return nibabel.Nifti1Image(nrrd_data, nrrd_header_affine(nrrd_header))
+
+
+def nibabel_to_sitk(nifti: nibabel.Nifti1Image) -> sitk.Image:
+    """
+    make an sitk Image from a nibabel NIfTI image in memory
+
+    Parameters
+    ----------
+    nifti: nibabel.Nifti1Image
+        the NIfTI image
+
+    Returns
+    -------
+    an sitk Image
+    """
+    # RAS to LPS
+    affine = np.diag([-1., -1., 1., 1.]) @ nifti.affine
+    nrrd_header = {'space directions': affine[:3, :3].T, 'space origin': affine[:3, 3]}
+    return nrrd_to_sitk(np.asanyarray(nifti.dataobj), nrrd_header)
+
+
+def _dicom_value(vr: str, value: str):
+    # an sitk metadata string as a pydicom element value
+    value = value.strip()
+    if vr in _int_vrs or vr in _float_vrs:
+        values = [int(v) if vr in _int_vrs else float(v) for v in value.split('\\') if v != '']
+        return values[0] if len(values) == 1 else values
+    return value
+
+
+def sitk_metadata_to_pydicom(image: sitk.Image, ds: Dataset):
+    """
+    copy the DICOM tags in an sitk Image's metadata ("gggg|eeee" keys, as the GDCM reader and
+    utilities.set_sitk_dicom_tag use) into a pydicom Dataset, skipping file meta, pixel description and unknown tags
+
+    Parameters
+    ----------
+    image: sitk.Image
+        the image
+    ds: Dataset
+        the dataset to set the elements on
+    """
+    for key in image.GetMetaDataKeys():
+        try:
+            group, element = key.split('|')
+            tag = int(group, 16) << 16 | int(element, 16)
+            vr = dictionary_VR(tag)
+        except (ValueError, KeyError):
+            continue
+        if tag >> 16 == 0x0002 or tag in _pixel_tags or vr == 'SQ':
+            continue
+        try:
+            ds.add_new(tag, vr, _dicom_value(vr, image.GetMetaData(key)))
+        except ValueError:
+            continue
+
+
+def pydicom_metadata_to_sitk(ds: Dataset, image: sitk.Image):
+    """
+    copy the elements of a pydicom Dataset into an sitk Image's metadata with "gggg|eeee" keys, as the GDCM reader
+    does, leaving out sequences and binary values
+
+    Parameters
+    ----------
+    ds: Dataset
+        the dataset
+    image: sitk.Image
+        the image to set metadata on
+    """
+    for element in ds:
+        if element.VR == 'SQ' or element.tag == 0x7fe00010 or isinstance(element.value, bytes):
+            continue
+        value = element.value
+        if isinstance(value, (list, MultiValue)):
+            value = '\\'.join(str(v) for v in value)
+        image.SetMetaData(f'{element.tag.group:04x}|{element.tag.element:04x}', '' if value is None else str(value))
+
+
+def _pixel_dataset(pixels: np.ndarray, samples: int, image: sitk.Image, series: Dataset = None) -> Dataset:
+    # a single-frame secondary capture dataset holding pixels (rows, columns[, samples])
+    if pixels.dtype.kind not in 'iu' or pixels.dtype.itemsize > 2:
+        raise ValueError(f'cannot store {pixels.dtype} pixels in DICOM, cast to an 8 or 16 bit integer type first')
+
+    ds = Dataset()
+    sitk_metadata_to_pydicom(image, ds)
+
+    ds.SOPClassUID = ds.get('SOPClassUID', pydicom.uid.SecondaryCaptureImageStorage)
+    ds.SOPInstanceUID = pydicom.uid.generate_uid()
+    ds.Modality = ds.get('Modality', 'OT')
+    for uid in ['StudyInstanceUID', 'SeriesInstanceUID', 'FrameOfReferenceUID']:
+        if uid not in ds:
+            setattr(ds, uid, series.get(uid) if series is not None else pydicom.uid.generate_uid())
+
+    ds.SamplesPerPixel = samples
+    ds.PhotometricInterpretation = 'RGB' if samples == 3 else 'MONOCHROME2'
+    if samples > 1:
+        ds.PlanarConfiguration = 0
+    ds.Rows, ds.Columns = pixels.shape[:2]
+    ds.BitsAllocated = pixels.dtype.itemsize * 8
+    ds.BitsStored = ds.BitsAllocated
+    ds.HighBit = ds.BitsAllocated - 1
+    ds.PixelRepresentation = 1 if pixels.dtype.kind == 'i' else 0
+    ds.PixelData = np.ascontiguousarray(pixels, dtype=pixels.dtype.newbyteorder('<')).tobytes()
+
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    return ds
+
+
+def sitk_to_pydicom(image: sitk.Image) -> Dataset:
+    """
+    make a pydicom Dataset from a two dimensional (eg RGB pathology) sitk Image in memory, with the DICOM tags in its
+    metadata, the way sitk.WriteImage then pydicom.dcmread would, without the file
+
+    Parameters
+    ----------
+    image: sitk.Image
+        a 2D image, 8 or 16 bit integer pixels, grayscale or RGB
+
+    Returns
+    -------
+    a Secondary Capture Dataset (unless the metadata says otherwise) ready for pydicom.dcmwrite
+    """
+    if image.GetDimension() != 2:
+        raise ValueError('sitk_to_pydicom takes a 2D image, use sitk_to_pydicom_series for volumes')
+    samples = image.GetNumberOfComponentsPerPixel()
+    ds = _pixel_dataset(sitk.GetArrayViewFromImage(image), samples, image)
+    spacing = image.GetSpacing()
+    ds.PixelSpacing = [spacing[1], spacing[0]]
+    return ds
+
+
+def sitk_to_pydicom_series(image: sitk.Image) -> list:
+    """
+    make one pydicom Dataset per slice of a three dimensional sitk Image in memory, sharing study/series/frame of
+    reference UIDs, with geometry so readers.sitk_image_from_datasets rebuilds the same image
+
+    Parameters
+    ----------
+    image: sitk.Image
+        a 3D image, 8 or 16 bit integer pixels
+
+    Returns
+    -------
+    a list of Datasets in slice order
+    """
+    if image.GetDimension() == 2:
+        return [sitk_to_pydicom(image)]
+    pixels = sitk.GetArrayViewFromImage(image)
+    samples = image.GetNumberOfComponentsPerPixel()
+    direction = np.array(image.GetDirection(), dtype=np.float64).reshape(3, 3)
+    spacing = image.GetSpacing()
+
+    datasets = []
+    for k in range(pixels.shape[0]):
+        ds = _pixel_dataset(pixels[k], samples, image, datasets[0] if len(datasets) > 0 else None)
+        ds.InstanceNumber = k + 1
+        ds.ImagePositionPatient = list(image.TransformIndexToPhysicalPoint((0, 0, k)))
+        ds.ImageOrientationPatient = direction[:, 0].tolist() + direction[:, 1].tolist()
+        ds.PixelSpacing = [spacing[1], spacing[0]]
+        ds.SliceThickness = spacing[2]
+        datasets.append(ds)
+    return datasets
+
+
+def pydicom_to_sitk(datasets) -> sitk.Image:
+    """
+    make an sitk Image from pydicom Datasets in memory, with the first dataset's elements as metadata, the way
+    writing the files out and sitk.ReadImage would
+
+    Parameters
+    ----------
+    datasets: Dataset or list
+        one 2D (eg RGB) dataset, or the slices of one series
+
+    Returns
+    -------
+    an sitk Image
+    """
+    if isinstance(datasets, Dataset):
+        datasets = [datasets]
+    first = datasets[0]
+    if len(datasets) == 1 and 'ImagePositionPatient' not in first:
+        image = sitk.GetImageFromArray(first.pixel_array, isVector=int(first.get('SamplesPerPixel', 1)) > 1)
+        spacing = first.get('PixelSpacing', first.get('NominalScannedPixelSpacing', [1.0, 1.0]))
+        image.SetSpacing([float(spacing[1]), float(spacing[0])])
+    else:
+        image = sitk_image_from_datasets(datasets)
+    pydicom_metadata_to_sitk(first, image)
+    return image
+
+
+def dataset_bytes(ds: Dataset) -> bytes:
+    """
+    a Dataset encoded as a DICOM file, in memory, eg to add to a zip archive without a temporary file
+
+    Parameters
+    ----------
+    ds: Dataset
+        the dataset, with file_meta
+
+    Returns
+    -------
+    the file bytes
+    """
+    with io.BytesIO() as dicom_file:
+        pydicom.dcmwrite(dicom_file, ds, enforce_file_format=True)
+        return dicom_file.getvalue()
@@ -1,8 +1,11 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pydicom
-from numpy import ma
 from scipy import ndimage
-from skimage import draw, measure
+from skimage import measure
 
 
 def parse_volume_parameters(origin: np.ndarray = None,
@@ -57,6 +60,164 @@ def parse_volume_parameters(origin: np.ndarray = None,
     # make sure directions is an array because python gets crabby about multidimensional lists
     directions = np.asarray(directions)
 
+    return origin, directions, sizes
+
+
+class VolumeGeometry:
+    """
+    The parsed origin, directions and sizes of a voxel volume, with the inverse directions worked out once, so
+    batches of points can be moved between voxel (index) and image (physical) space with one matrix product
+
+    directions follow the Nrrd 'space directions' convention: row i is the physical step of voxel axis i, so
+    image = origin + voxel @ directions. A 1D directions (spacing) is taken as the diagonal
+
+    """
+    def __init__(self, origin: np.ndarray = None,
+                 directions: np.ndarray = None,
+                 sizes: np.ndarray = None,
+                 nrrd_header: dict = None):
+        origin, directions, sizes = parse_volume_parameters(origin, directions, sizes, nrrd_header)
+        self.origin = np.asarray(origin, dtype=np.float64).reshape(3)
+        directions = np.asarray(directions, dtype=np.float64)
+        self.directions = np.diag(directions) if directions.ndim == 1 else directions.reshape(3, 3)
+        self.sizes = np.asarray(sizes)
+        self.inverse = np.linalg.inv(self.directions)
+
+    def voxels_to_image(self, voxels: np.ndarray, reverse_z: bool = False) -> np.ndarray:
+        """
+        Convert points from voxel (index) to image (physical) space
+
+        Parameters
+        ----------
+        voxels : array-like of float
+            (N, 3) points in voxel space [x, y, z]
+        reverse_z : bool
+            Reverse the slices relative to the origin
+
+        Returns
+        -------
+        ndarray of float
+            (N, 3) points in image space
+
+        """
+        voxels = np.asarray(voxels, dtype=np.float64).reshape(-1, 3)
+        if reverse_z:
+            voxels = voxels.copy()
+            voxels[:, 2] = self.sizes[2] - voxels[:, 2]
+        return self.origin + voxels @ self.directions
+
+    def image_to_voxels(self, points: np.ndarray, rounded: bool = True) -> np.ndarray:
+        """
+        Convert points from image (physical) to voxel (index) space
+
+        Parameters
+        ----------
+        points : array-like of float
+            (N, 3) points in image space [x, y, z]
+        rounded : bool
+            Round to the nearest voxel index (default), otherwise return continuous indexes
+
+        Returns
+        -------
+        ndarray of int (or float)
+            (N, 3) points in voxel space, can be negative or past sizes for points outside the volume
+
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        voxels = (points - self.origin) @ self.inverse
+        return np.rint(voxels).astype(int) if rounded else voxels
+
+
+# geometries parsed by volume_geometry, keyed by the raw parameters
+_volume_geometries = OrderedDict()
+_volume_geometries_max = 32
+
+
+def volume_geometry(origin: np.ndarray = None,
+                    directions: np.ndarray = None,
+                    sizes: np.ndarray = None,
+                    nrrd_header: dict = None) -> VolumeGeometry:
+    """
+    Get the VolumeGeometry for a set of volume parameters, reusing the one parsed last time for the same values
+
+    Parameters
+    ----------
+    origin, directions, sizes, nrrd_header:
+        As for parse_volume_parameters, origin may also be a VolumeGeometry, which is returned as is
+
+    Returns
+    -------
+    VolumeGeometry
+
+    """
+    if isinstance(origin, VolumeGeometry):
+        return origin
+    origin, directions, sizes = parse_volume_parameters(origin, directions, sizes, nrrd_header)
+    key = tuple(np.asarray(value, dtype=np.float64).tobytes() for value in (origin, directions, sizes))
+    geometry = _volume_geometries.get(key)
+    if geometry is None:
+        geometry = VolumeGeometry(origin, directions, sizes)
+        _volume_geometries[key] = geometry
+        if len(_volume_geometries) > _volume_geometries_max:
+            _volume_geometries.popitem(last=False)
+    else:
+        _volume_geometries.move_to_end(key)
+    return geometry
+
+
+def voxels_to_image(voxels: np.ndarray,
+                    origin: np.ndarray = None,
+                    directions: np.ndarray = None,
+                    sizes: np.ndarray = None,
+                    nrrd_header: dict = None,
+                    reverse_z: bool = False):
+    """
+    Batched voxel_to_image: convert (N, 3) points from voxel (index) to image (physical) space
+
+    Parameters
+    ----------
+    voxels : array-like of float
+        (N, 3) points in voxel space
+    origin, directions, sizes, nrrd_header:
+        The volume, as for volume_geometry (directions is the full 3x3)
+    reverse_z: bool
+        Reverse the slices relative to the origin
+
+    Returns
+    -------
+    ndarray of float
+        (N, 3) points in image space
+
+    """
+    return volume_geometry(origin, directions, sizes, nrrd_header).voxels_to_image(voxels, reverse_z)
+
+
+def image_to_voxels(points: np.ndarray,
+                    origin: np.ndarray = None,
+                    directions: np.ndarray = None,
+                    sizes: np.ndarray = None,
+                    nrrd_header: dict = None,
+                    rounded: bool = True):
+    """
+    Batched image_to_voxel: convert (N, 3) points from image (physical) to voxel (index) space
+
+    Parameters
+    ----------
+    points : array-like of float
+        (N, 3) points in image space
+    origin, directions, sizes, nrrd_header:
+        The volume, as for volume_geometry (directions is the full 3x3)
+    rounded : bool
+        Round to the nearest voxel index (default), otherwise return continuous indexes
+
+    Returns
+    -------
+    ndarray of int (or float)
+        (N, 3) points in voxel space
+
+    """
+    return volume_geometry(origin, directions, sizes, nrrd_header).image_to_voxels(points, rounded)
+
 
 def voxel_to_image(voxel: np.ndarray,
                    origin: np.ndarray = None,
@@ -65,7 +226,7 @@ def voxel_to_image(voxel: np.ndarray,
                    nrrd_header: dict = None,
                    reverse_z: bool = False):
     """
-    Convert from voxel (index) to image (physical) space coordinates
+    Convert from voxel (index) to image (physical) space coordinates, use voxels_to_image for more than one point
 
     Parameters
     ----------
@@ -75,7 +236,7 @@ def voxel_to_image(voxel: np.ndarray,
     origin : array-like of float, optional
         The origin of the matrix in image space [ox, oy, oz]
     directions : array-like of float, optional
-        The directions of the matrix in image space, 3x3 (TODO: handle rotation)
+        The directions of the matrix in image space, 3x3
     sizes : array-like of float
         The shape of the matrix
     nrrd_header : Dictionary
@@ -89,20 +250,7 @@ def voxel_to_image(voxel: np.ndarray,
         The converted point in image space [x, y, z]
 
     """
-
-    # image parameters
-    origin, directions, sizes = parse_volume_parameters(origin, directions, sizes, nrrd_header)
-
-    # directions is 2D, make sure it is an array
-    directions = np.asarray(directions)
-
-    # transform
-    xf = (origin[0] + directions[0, 0] * voxel[0])
-    yf = (origin[1] + directions[1, 1] * voxel[1])
-    z = (sizes[2] - voxel[2]) if reverse_z else voxel[2]
-    zf = origin[2] + directions[2, 2] * z
-
-    return [xf, yf, zf]
+    return voxels_to_image(voxel, origin, directions, sizes, nrrd_header, reverse_z)[0].tolist()
 
 
 def image_to_voxel(point: np.ndarray,
@@ -111,7 +259,7 @@ def image_to_voxel(point: np.ndarray,
                    sizes: np.ndarray = None,
                    nrrd_header: np.ndarray = None):
     """
-    Convert from image (physical) space to voxel (index)
+    Convert from image (physical) space to voxel (index), use image_to_voxels for more than one point
 
     Parameters
     ----------
@@ -121,7 +269,7 @@ def image_to_voxel(point: np.ndarray,
     origin : array-like of float, optional
         The origin of the matrix in image space [ox, oy, oz]
     directions : array-like of float, optional
-        The directions of the matrix in image space, 3x3 (TODO: handle rotation)
+        The directions of the matrix in image space, 3x3 or the diagonal
     sizes : array-like of float
         The shape of the matrix
     nrrd_header : Dictionary
@@ -137,30 +285,215 @@ def image_to_voxel(point: np.ndarray,
     This function can return negative indexes to denote points that are not within a given matrix!
 
     """
+    return image_to_voxels(point, origin, directions, sizes, nrrd_header)[0].tolist()
 
-    # image parameters
-    origin, directions, sizes = parse_volume_parameters(origin, directions, sizes, nrrd_header=nrrd_header)
 
-    # directions is 2D, make sure it is an array
-    directions = np.asarray(directions)
-    if len(directions.shape) == 1:
-        directions3d = np.zeros((3, 3))
-        directions3d[0][0] = directions[0]
-        directions3d[1][1] = directions[1]
-        directions3d[2][2] = directions[2]
-        directions = directions3d
+# (3006,0050) ContourData
+_contour_data_tag = 0x30060050
 
-    # transform
-    xf = int(round((point[0] - origin[0]) / directions[0, 0]))
-    yf = int(round((point[1] - origin[1]) / directions[1, 1]))
-    zf = int(round((point[2] - origin[2]) / directions[2, 2]))
 
-    return [xf, yf, zf]
+def _contour_data_values(contour: pydicom.Dataset) -> tuple:
+    # the ContourData of one contour item: raw DS bytes when the element hasn't been converted yet (the usual case for
+    # a file that was just read), otherwise the converted values
+    element = contour.get_item(_contour_data_tag) if _contour_data_tag in contour else None
+    if element is None or element.value is None:
+        return None, None
+    if isinstance(element, pydicom.dataelem.RawDataElement):
+        raw = bytes(element.value).strip(b' \x00')
+        return (raw, None) if len(raw) > 0 else (None, None)
+    return None, np.asarray(element.value, dtype=np.float64)
+
+
+class ContourSet:
+    """
+    The contours of a structure set in flat arrays instead of a dict of lists of floats: one float32 (N, 3) points
+    buffer, per-contour offsets into it, and per-contour ROI numbers and slice indexes (into slice_positions, the
+    sorted distinct z of the contours)
+
+    It can be used wherever the old dict of ROI -> list of flat [x1, y1, z1, x2, ...] contours is: iterating gives
+    the ROI numbers, and get/[] give the ROI's contours as flat float32 views into the points buffer
+
+    """
+    def __init__(self, points: np.ndarray, offsets: np.ndarray, rois: np.ndarray, roi_numbers: list = None):
+        """
+        Parameters
+        ----------
+        points : ndarray of float
+            (N, 3) contour points in image space, all contours back to back
+        offsets : ndarray of int
+            (C + 1) start of each contour in points, the last one is N
+        rois : ndarray of int
+            (C) ROI number of each contour
+        roi_numbers : list, optional
+            All ROI numbers in order, including ones without contours (default: the order they appear in rois)
+        """
+        self.points = np.ascontiguousarray(points, dtype=np.float32).reshape(-1, 3)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.rois = np.asarray(rois, dtype=np.int64)
+        if roi_numbers is None:
+            roi_numbers = list(dict.fromkeys(self.rois.tolist()))
+        self.roi_numbers = list(roi_numbers)
+
+        # slice of each contour from the z of its first point
+        # TODO: assume z is the same for the contour, because this is what we have seen so far
+        first_z = self.points[self.offsets[:-1], 2] if len(self.rois) > 0 else np.zeros(0, dtype=np.float32)
+        self.slice_positions, self.slices = np.unique(first_z, return_inverse=True)
+        self.slices = self.slices.reshape(-1)
+        self._roi_index = None
+
+    @classmethod
+    def from_arrays(cls, contours: list, rois: list, roi_numbers: list = None):
+        """
+        Build from a list of per-contour (M, 3) (or flat) point arrays and their ROI numbers, empty contours are
+        dropped
+        """
+        keep = [i for i, contour in enumerate(contours) if len(contour) >= 3]
+        arrays = [np.asarray(contours[i], dtype=np.float32).reshape(-1, 3) for i in keep]
+        lengths = np.array([len(array) for array in arrays], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        points = np.concatenate(arrays) if len(arrays) > 0 else np.zeros((0, 3), dtype=np.float32)
+        if roi_numbers is None:
+            roi_numbers = list(dict.fromkeys(rois))
+        return cls(points, offsets, np.asarray([rois[i] for i in keep], dtype=np.int64), roi_numbers)
+
+    @classmethod
+    def from_dict(cls, contour_list: dict):
+        """
+        Build from a dict of ROI -> list of flat [x1, y1, z1, ...] contours (a ContourSet is returned as is)
+        """
+        if isinstance(contour_list, ContourSet):
+            return contour_list
+        contours = []
+        rois = []
+        for roi in contour_list:
+            for contour in contour_list.get(roi):
+                contours.append(contour)
+                rois.append(roi)
+        return cls.from_arrays(contours, rois, list(contour_list))
+
+    @classmethod
+    def from_pydicom(cls, data_set: pydicom.Dataset):
+        """
+        Build from the ROIContourSequence of an RTSTRUCT, ContourData of every contour is joined and parsed in one
+        go rather than value by value
+        """
+        roi_numbers = []
+        rois = []
+        raw_values = []
+        lengths = []
+        converted = {}
+        for contourSequence in data_set.ROIContourSequence:
+            roi = int(contourSequence.ReferencedROINumber)
+            if roi not in roi_numbers:
+                roi_numbers.append(roi)
+            for roiContour in contourSequence.get('ContourSequence', []):
+                raw, values = _contour_data_values(roiContour)
+                if raw is not None:
+                    raw_values.append(raw)
+                    lengths.append(raw.count(b'\\') + 1)
+                elif values is not None and len(values) > 0:
+                    converted[len(lengths)] = values
+                    lengths.append(len(values))
+                else:
+                    continue
+                rois.append(roi)
+
+        # one parse for all the raw DS strings, then slot in any already converted contours
+        parsed = np.fromstring(b' '.join(raw_values).replace(b'\\', b' ').decode('ascii'), dtype=np.float64,
+                               sep=' ') if len(raw_values) > 0 else np.zeros(0)
+        if len(parsed) != sum(lengths) - sum(len(values) for values in converted.values()):
+            raise ValueError('could not parse ContourData')
+        if len(converted) > 0:
+            lengths_array = np.asarray(lengths, dtype=np.int64)
+            raw_mask = np.ones(len(lengths), dtype=bool)
+            raw_mask[list(converted)] = False
+            values = np.empty(lengths_array.sum(), dtype=np.float64)
+            starts = np.concatenate(([0], np.cumsum(lengths_array)))
+            raw_positions = np.concatenate([np.arange(starts[i], starts[i + 1]) for i in np.flatnonzero(raw_mask)]) \
+                if raw_mask.any() else np.zeros(0, dtype=np.int64)
+            values[raw_positions] = parsed
+            for i, contour_values in converted.items():
+                values[starts[i]:starts[i + 1]] = contour_values
+            parsed = values
+
+        counts = np.asarray(lengths, dtype=np.int64) // 3
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        return cls(parsed.reshape(-1, 3), offsets, np.asarray(rois, dtype=np.int64), roi_numbers)
+
+    def __len__(self):
+        return len(self.roi_numbers)
+
+    def __iter__(self):
+        return iter(self.roi_numbers)
+
+    def __contains__(self, roi):
+        return roi in self.roi_numbers
+
+    def keys(self):
+        return list(self.roi_numbers)
+
+    def values(self):
+        return [self.get(roi) for roi in self.roi_numbers]
+
+    def items(self):
+        return [(roi, self.get(roi)) for roi in self.roi_numbers]
+
+    def __getitem__(self, roi):
+        if roi not in self.roi_numbers:
+            raise KeyError(roi)
+        return self.get(roi)
+
+    def get(self, roi, default=None):
+        """
+        The ROI's contours as a list of flat [x1, y1, z1, ...] float32 views, as the old dict gave
+        """
+        if roi not in self.roi_numbers:
+            return default
+        return [self.contour(i).reshape(-1) for i in self.roi_contours(roi)]
+
+    @property
+    def contour_count(self):
+        return len(self.rois)
+
+    def contour(self, index: int) -> np.ndarray:
+        # (M, 3) view of one contour
+        return self.points[self.offsets[index]:self.offsets[index + 1]]
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def roi_contours(self, roi) -> np.ndarray:
+        """
+        Indexes of the ROI's contours, in order
+        """
+        if self._roi_index is None:
+            order = np.argsort(self.rois, kind='stable')
+            split = np.flatnonzero(np.diff(self.rois[order])) + 1
+            self._roi_index = {int(group[0]): indexes for group, indexes in
+                               zip(np.split(self.rois[order], split), np.split(order, split)) if len(group) > 0}
+        return self._roi_index.get(int(roi), np.zeros(0, dtype=np.int64))
+
+    def slice_contours(self, slice_index: int, roi=None) -> np.ndarray:
+        """
+        Indexes of the contours on a slice (an index into slice_positions), optionally only for one ROI
+        """
+        mask = self.slices == slice_index
+        if roi is not None:
+            mask &= self.rois == roi
+        return np.flatnonzero(mask)
+
+    def point_rois(self) -> np.ndarray:
+        # ROI number of every point
+        return np.repeat(self.rois, self.lengths())
+
+    def to_dict(self) -> dict:
+        # the old dict of ROI -> list of flat float lists
+        return {roi: [contour.tolist() for contour in self.get(roi)] for roi in self.roi_numbers}
 
 
 def pydicom_to_contours(data_set: pydicom.Dataset):
     """
-    Convert a pydicom sequence of contours (MultiValue) into a dictionary of lists of arrays (double)
+    Convert a pydicom sequence of contours (MultiValue) into a ContourSet
 
     Parameters
     ----------
@@ -169,32 +502,11 @@ def pydicom_to_contours(data_set: pydicom.Dataset):
 
     Returns
     -------
-    Dictionary of ndarray of ndarray
-        Dictionary indexed by ROI of contour lists, each contour list is a list of sets of contour points
+    ContourSet
+        Contours by ROI, usable like the old dict of ROI -> list of flat [x1, y1, z1, ...] contours
 
     """
-
-    # output
-    contours = dict()
-
-    # for each contour set
-    for contourSequence in data_set.ROIContourSequence:
-        roi = contourSequence.ReferencedROINumber
-        if roi in contours:
-            contour_list = contours.get(roi)
-        else:
-            contour_list = list()
-            contours[roi] = contour_list
-
-        # each ROI can have one or more contours, which each has one or more points associated with it
-        for roiContour in contourSequence.ContourSequence:
-            contour_data = roiContour.ContourData
-            contour_array = []
-            for value in contour_data:
-                contour_array.append(float(value))
-            contour_list.append(contour_array)
-
-    return contours
+    return ContourSet.from_pydicom(data_set)
 
 
 def max_voxel_for_contours(contour_list,
@@ -205,7 +517,7 @@ def max_voxel_for_contours(contour_list,
 
     Parameters
     ----------
-    contour_list : ndarray of ndarray of float
+    contour_list : ContourSet, or dictionary of ndarray of ndarray of float
         Data for a set of contours, each ROI has a list, each list contains a 1-dimensional array of x, y, z points.
     origin : ndarray of float
         The origin of the contour list in image space
@@ -218,28 +530,12 @@ def max_voxel_for_contours(contour_list,
         1x3 dimensional array of the maximum voxel index for all three dimensions
 
     """
-    # return value
-    voxel_max = [0, 0, 0]
-
-    # for each ROI
-    for roi in contour_list:
-        contours = contour_list.get(roi)
-        for contour in contours:
-            # get max point for this contour
-            xm = np.max(contour[0::3])
-            ym = np.max(contour[1::3])
-            zm = np.max(contour[2::3])
-
-            # store current max for the whole set
-            contour_voxel_max = image_to_voxel(np.asarray((xm, ym, zm)), origin, directions)
-            if contour_voxel_max[0] >= voxel_max[0]:
-                voxel_max[0] = contour_voxel_max[0] + 1
-            if contour_voxel_max[1] >= voxel_max[1]:
-                voxel_max[1] = contour_voxel_max[1] + 1
-            if contour_voxel_max[2] >= voxel_max[2]:
-                voxel_max[2] = contour_voxel_max[2] + 1
-
-    return voxel_max
+    # every point in voxel space at once, the max is taken there so it also holds for oblique/negative directions
+    contour_set = ContourSet.from_dict(contour_list)
+    if len(contour_set.points) == 0:
+        return [0, 0, 0]
+    voxels = image_to_voxels(contour_set.points, origin, directions)
+    return np.maximum(voxels.max(axis=0) + 1, 0).tolist()
 
 
 def parameters_for_contours(contour_list):
@@ -248,7 +544,7 @@ def parameters_for_contours(contour_list):
 
     Parameters
     ----------
-    contour_list : ndarray of ndarray of float
+    contour_list : ContourSet, or dictionary of ndarray of ndarray of float
         Data for a set of contours, each ROI has a list, each list contains a 1-dimensional array of x, y, z points.
 
     Returns
@@ -257,55 +553,123 @@ def parameters_for_contours(contour_list):
         origin (minimum point), spacing (voxel size), sizes (array size), maximum point
 
     """
+    contour_set = ContourSet.from_dict(contour_list)
+    if len(contour_set.points) == 0:
+        raise ValueError('no contour points to find volume parameters for')
+    points = contour_set.points.astype(np.float64)
+
     # min and max points
-    min_point = [10000, 10000, 10000]
-    max_point = [0, 0, 0]
-    spacing = [10000, 10000, 10000]
-    min_z = 10000
-    z_last = 0
-
-    # for each ROI
-    for roi in contour_list:
-        contours = contour_list.get(roi)
-        for contour in contours:
-            # get min and max point for this contour
-            x_points = contour[0::3]
-            y_points = contour[1::3]
-            z_points = contour[2::3]
-            x_min = np.min(x_points)
-            y_min = np.min(y_points)
-            z_min = np.min(z_points)
-            x_max = np.max(x_points)
-            y_max = np.max(y_points)
-            z_max = np.max(z_points)
-            x_diff = np.abs(np.diff(x_points))
-            x_diff = np.ma.MaskedArray(x_diff, x_diff == 0)
-            y_diff = np.abs(np.diff(y_points))
-            y_diff = np.ma.MaskedArray(y_diff, y_diff == 0)
-            z_diff = np.abs(z_points[0]-z_last)
-            z_last = z_points[0]
-            if 0 < z_diff < min_z:
-                min_z = z_diff
-
-            # store current max for the whole set
-            min_point = np.minimum(min_point, np.asarray((x_min, y_min, z_min)))
-            max_point = np.maximum(max_point, np.asarray((x_max, y_max, z_max)))
-            spacing = np.asarray(np.minimum(spacing, np.asarray((np.min(x_diff), np.min(y_diff), min_z))))
+    min_point = points.min(axis=0)
+    max_point = points.max(axis=0)
+
+    # in-plane spacing: smallest non-zero step between consecutive points of a contour (not across contours)
+    steps = np.abs(np.diff(points[:, 0:2], axis=0))
+    steps[contour_set.offsets[1:-1] - 1] = 0
+    steps = np.where(steps > 0, steps, np.inf).min(axis=0)
+    steps[~np.isfinite(steps)] = 1.0
+
+    # slice spacing: smallest gap between contour slices
+    z_steps = np.diff(contour_set.slice_positions.astype(np.float64))
+    z_step = z_steps[z_steps > 0].min() if np.any(z_steps > 0) else 1.0
+    spacing = np.array((steps[0], steps[1], z_step))
 
     # size of the voxel array
-    extents = np.asarray(np.subtract(max_point, min_point))
-    sizes = np.add(np.divide(extents, spacing), 1)
-    sizes = np.asarray(sizes, dtype=int)
-    spacing3d = np.zeros((3, 3))
-    spacing3d[0][0] = spacing[0]
-    spacing3d[1][1] = spacing[1]
-    spacing3d[2][2] = spacing[2]
+    extents = max_point - min_point
+    sizes = np.asarray(extents / spacing + 1, dtype=int)
     return min_point, spacing, sizes, max_point
 
 
+def _slice_label_contours(task):
+    # module level so it can run in a process pool: find_contours for every label crop of one slice
+    slice_index, crops, level, zoom = task
+    found = []
+    for label, crop, offset in crops:
+        mask = crop == label
+        if not mask.any():
+            continue
+        if zoom != 1:
+            mask = ndimage.zoom(mask, zoom, order=0)
+        found.append((label, [contour + offset for contour in measure.find_contours(mask, level)]))
+    return slice_index, found
+
+
+def label_slice_contours(volume: np.ndarray, level: float = 0.8, zoom: float = 1, workers: int = None) -> list:
+    """
+    Find the contours of every label on every slice of a label volume
+
+    The bounding box of each label is found once with ndimage.find_objects, so only the slices a label is on are
+    looked at, and only a crop around the label (one voxel bigger so contours still close) goes to
+    measure.find_contours. Slices are spread over a process pool
+
+    Parameters
+    ----------
+    volume : ndarray
+        The label volume, labels > 0, slices on the last axis
+    level : float
+        The find_contours level for the label masks (default: 0.8)
+    zoom : float
+        Zoom each slice mask (order 0) before finding contours, as for resampled output. The whole slice is zoomed
+        so the result matches zooming the full slice (default: 1, no zoom)
+    workers : int, optional
+        Number of processes, 1 to run in this process (default: None, the number of cores)
+
+    Returns
+    -------
+    list
+        (slice index, label, list of (M, 2) contour arrays in voxel coordinates of the (zoomed) slice), ordered by
+        slice then label, for every label present on a slice
+
+    """
+    labels = volume if np.issubdtype(volume.dtype, np.integer) else volume.astype(np.int32)
+    shape = labels.shape
+
+    # which labels are on which slices, and the crop to look at for each
+    tasks = {}
+    for index, box in enumerate(ndimage.find_objects(labels)):
+        if box is None:
+            continue
+        label = index + 1
+        if zoom == 1:
+            x0, x1 = max(box[0].start - 1, 0), min(box[0].stop + 1, shape[0])
+            y0, y1 = max(box[1].start - 1, 0), min(box[1].stop + 1, shape[1])
+        else:
+            x0, x1, y0, y1 = 0, shape[0], 0, shape[1]
+        for slice_index in range(box[2].start, box[2].stop):
+            tasks.setdefault(slice_index, []).append((label, (x0, x1, y0, y1)))
+
+    task_list = []
+    for slice_index in sorted(tasks):
+        if zoom == 1:
+            crops = [(label, labels[x0:x1, y0:y1, slice_index], np.array((x0, y0)))
+                     for label, (x0, x1, y0, y1) in tasks[slice_index]]
+        else:
+            # the same full slice for every label, pickled once per task
+            image_slice = labels[:, :, slice_index]
+            crops = [(label, image_slice, np.zeros(2)) for label, _ in tasks[slice_index]]
+        task_list.append((slice_index, crops, level, zoom))
+
+    workers = os.cpu_count() if workers is None else workers
+    if workers <= 1 or len(task_list) <= 1:
+        results = map(_slice_label_contours, task_list)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(_slice_label_contours, task_list, chunksize=max(1, len(task_list) // (4 * workers)))
+
+    found = []
+    try:
+        for slice_index, slice_found in results:
+            for label, contour_arrays in slice_found:
+                found.append((slice_index, label, contour_arrays))
+    finally:
+        if workers > 1 and len(task_list) > 1:
+            executor.shutdown()
+    return found
+
+
 def image_to_contour(volume: np.ndarray,
                      origin: np.ndarray,
-                     directions: np.ndarray):
+                     directions: np.ndarray,
+                     workers: int = None):
     """
     Given a volume matrix, generate a dictionary of contours grouped by "roi" (value that is used in the matrix)
 
@@ -316,127 +680,269 @@ def image_to_contour(volume: np.ndarray,
     origin : ndarray of float
         A three dimensional point of the orgin of the volume in image space
     directions : ndarray of float
-        A three dimensional array of the voxel dimensions in each direction
-        TODO: handle rotations
+        The voxel directions, 3x3 (rows are the voxel axes as in Nrrd 'space directions') or the diagonal
+    workers : int, optional
+        Number of processes finding contours, see label_slice_contours
 
     Returns
     -------
-    Dictionary of ndarray of ndarray
-        A dictionary of contour lists by ROI name
+    ContourSet
+        The contours by ROI (value in the matrix), usable like a dictionary of contour lists by ROI
 
     """
+    # contours of every ROI on every slice (ignore 0)
+    found = label_slice_contours(volume, 0.8, workers=workers)
+
+    arrays = []
+    rois = []
+    for slice_index, roi, contour_arrays in found:
+        for arr in contour_arrays:
+            arrays.append(np.column_stack((arr, np.full(len(arr), slice_index))))
+            rois.append(roi)
+
+    # convert all contour points to image space at once
+    lengths = np.array([len(arr) for arr in arrays], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    points = volume_geometry(origin, directions).voxels_to_image(np.concatenate(arrays)) \
+        if len(arrays) > 0 else np.zeros((0, 3))
+    roi_numbers = list(dict.fromkeys(roi for _, roi, _ in found))
+    return ContourSet(points, offsets, np.asarray(rois, dtype=np.int64), roi_numbers)
 
-    # return value
-    contours = dict()
 
-    # for each slice, get all ROIs present (ignore 0)
-    for slice_index in range(volume.shape[2]):
-        image_slice = volume[:, :, slice_index]
-        rois = np.unique(image_slice)
-        rois = np.delete(rois, 0).astype(int)
+# fill rules for rasterize_polygons:
+#   nonzero: a pixel is inside when the polygons wind around it, so a hole is a contour drawn in the opposite
+#            orientation to the one around it
+#   evenodd: a pixel is inside when it is enclosed an odd number of times, any nested contour is a hole
+fill_rules = ['nonzero', 'evenodd']
 
-        # for each ROI in the slice, generate contour(s)
-        for roi in rois:
-            if roi in contours:
-                contour_list = contours.get(roi)
-            else:
-                contour_list = list()
-                contours[roi] = contour_list
 
-            # find the contour(s) for this roi
-            roi_slice = (image_slice == roi)
+def rasterize_polygons(polygons: list, shape: tuple, fill_rule: str = 'nonzero'):
+    """
+    Scanline fill of a set of closed polygons in one pass, all edges of all polygons are crossed with every pixel row
+    at once and the inside spans come from the running winding number (or crossing parity) along each row
+
+    Pixels are filled when their center is inside, or exactly on the boundary of, the filled region (the same pixels
+    skimage.draw.polygon gives for a single polygon)
 
-            generated_contours = measure.find_contours(roi_slice, 0.8)
+    Parameters
+    ----------
+    polygons : list of ndarray of float
+        The polygons, each an (M, 2) array of (row, column) pixel coordinates, implicitly closed
+    shape : tuple of int
+        The (rows, columns) shape to clip to
+    fill_rule : str
+        "nonzero" (default) or "evenodd", see fill_rules
 
-            for arr in generated_contours:
-                contour_array = []
-                for point in range(0, arr.shape[0]):
-                    v = np.append(arr[point], slice_index)
-                    contour_point = voxel_to_image(v, origin, directions)
-                    contour_array.append(contour_point[0])
-                    contour_array.append(contour_point[1])
-                    contour_array.append(contour_point[2])
-                contour_list.append(contour_array)
+    Returns
+    -------
+    ndarray of int, ndarray of int
+        The row and column indexes of the filled pixels, as for skimage.draw.polygon (may repeat boundary pixels)
 
-    return contours
+    """
+    if fill_rule not in fill_rules:
+        raise ValueError(f'unknown fill rule {fill_rule}, use one of {fill_rules}')
+
+    polygons = [np.asarray(polygon, dtype=np.float64).reshape(-1, 2) for polygon in polygons]
+    polygons = [polygon for polygon in polygons if len(polygon) > 0]
+    if len(polygons) == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+
+    # edges vertex -> next vertex, each polygon wraps back to its first vertex
+    vertices = np.concatenate(polygons)
+    lengths = np.array([len(polygon) for polygon in polygons])
+    ends = np.cumsum(lengths)
+    following = np.arange(1, len(vertices) + 1)
+    following[ends - 1] = ends - lengths
+    r0, c0 = vertices[:, 0], vertices[:, 1]
+    r1, c1 = vertices[following, 0], vertices[following, 1]
+
+    # every (edge, row) crossing, rows are half open [top, bottom) so shared vertices cross once
+    dr = r1 - r0
+    sloped = dr != 0
+    row_lo = np.clip(np.ceil(np.minimum(r0, r1)), 0, shape[0]).astype(np.intp)
+    row_hi = np.clip(np.ceil(np.maximum(r0, r1)), 0, shape[0]).astype(np.intp)
+    counts = np.where(sloped, row_hi - row_lo, 0)
+    edge = np.repeat(np.arange(len(r0)), counts)
+    rows = row_lo[edge] + np.arange(len(edge)) - np.repeat(np.cumsum(counts) - counts, counts)
+    crossing = c0[edge] + (rows - r0[edge]) * (c1[edge] - c0[edge]) / dr[edge]
+
+    # sort crossings along each row, the winding (or parity) after a crossing says whether the span up to the next
+    # crossing is inside. Closed polygons cross every row a net zero times, so one running sum serves all rows
+    order = np.lexsort((crossing, rows))
+    rows, crossing = rows[order], crossing[order]
+    if fill_rule == 'nonzero':
+        inside = np.cumsum(np.sign(dr[edge[order]]).astype(np.intp)) != 0
+    else:
+        inside = np.arange(1, len(rows) + 1) % 2 == 1
+    span = inside[:-1] & (rows[:-1] == rows[1:])
+    span_rows = rows[:-1][span]
+    col_lo = np.clip(np.ceil(crossing[:-1][span]), 0, shape[1]).astype(np.intp)
+    col_hi = np.clip(np.ceil(crossing[1:][span]), 0, shape[1]).astype(np.intp)
+    widths = np.maximum(col_hi - col_lo, 0)
+    rr = np.repeat(span_rows, widths)
+    cc = np.repeat(col_lo, widths) + np.arange(widths.sum()) - np.repeat(np.cumsum(widths) - widths, widths)
+
+    # pixel centers exactly on the boundary: the lattice points of each edge, only possible for integer vertices
+    if np.array_equal(vertices, np.round(vertices)):
+        dr_int = np.abs(r1 - r0).astype(np.int64)
+        dc_int = np.abs(c1 - c0).astype(np.int64)
+        steps = np.maximum(np.gcd(dr_int, dc_int), 1)
+        step_edge = np.repeat(np.arange(len(r0)), steps)
+        t = (np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)) / steps[step_edge]
+        boundary_r = np.round(r0[step_edge] + t * (r1 - r0)[step_edge]).astype(np.intp)
+        boundary_c = np.round(c0[step_edge] + t * (c1 - c0)[step_edge]).astype(np.intp)
+        keep = (boundary_r >= 0) & (boundary_r < shape[0]) & (boundary_c >= 0) & (boundary_c < shape[1])
+        rr = np.concatenate((rr, boundary_r[keep]))
+        cc = np.concatenate((cc, boundary_c[keep]))
+
+    return rr, cc
+
+
+def label_dtype(labels) -> np.dtype:
+    """
+    The smallest unsigned integer type that holds every label (ROI number), for compact label volumes
+
+    Parameters
+    ----------
+    labels : array-like of int
+        The labels
+
+    Returns
+    -------
+    numpy dtype
+        uint8, uint16, uint32 or uint64
+
+    """
+    labels = np.asarray(labels)
+    return np.min_scalar_type(max(int(labels.max()), 1) if labels.size > 0 else 1)
+
+
+def _contour_slice_groups(contour_set, geometry, slice_count: int):
+    # voxel coordinates of every contour point (in one go) and, per slice, the contour indexes of each ROI in ROI order
+    voxels = geometry.image_to_voxels(contour_set.points)
+    starts = contour_set.offsets[:-1]
+
+    # TODO: assume z is the same for the contour, because this is what we have seen so far
+    slice_indexes = voxels[starts, 2].tolist()
+
+    rank = {roi: index for index, roi in enumerate(contour_set.roi_numbers)}
+    rois = contour_set.rois.tolist()
+    groups = {}
+    for index in sorted(range(len(rois)), key=lambda i: rank[rois[i]]):
+        zv = slice_indexes[index]
+        if zv < 0 or zv >= slice_count:
+            # contours on planes outside the reference volume have nothing to fill
+            continue
+        groups.setdefault(zv, {}).setdefault(rois[index], []).append(index)
+    return voxels, groups
+
+
+def _fill_label_slice(label_slice: np.ndarray, slice_groups: dict, voxels: np.ndarray, offsets: np.ndarray,
+                      fill_rule: str):
+    # fill each ROI's contours on one slice, all of them together so holes are respected, later ROIs win
+    for roi, indexes in slice_groups.items():
+        polygons = [voxels[offsets[i]:offsets[i + 1], 0:2] for i in indexes]
+        rr, cc = rasterize_polygons(polygons, label_slice.shape, fill_rule)
+        label_slice[rr, cc] = roi
 
 
 def contours_to_image(contour_list,
                       origin: np.ndarray = None,
                       spacing: np.ndarray = None,
-                      sizes: np.ndarray = None):
+                      sizes: np.ndarray = None,
+                      fill_rule: str = 'nonzero',
+                      labels: np.ndarray = None,
+                      dtype=np.float64):
     """
     Generate a voxel volume from a set of contours
 
+    All contour points are converted to voxel space in one operation, then the contours of each ROI are filled slice
+    by slice with rasterize_polygons and written straight into the label volume. Holes are contours of the same ROI
+    on the same slice, see fill_rules. Where ROIs overlap the later one wins
+
     Parameters
     ----------
-    contour_list: ndarray of ndarry of float
-        A list of arrays of contour points[x1, y1, z1, x2, y2, z2 ...]
+    contour_list: ContourSet, or dictionary of ndarray of ndarry of float
+        A list of arrays of contour points[x1, y1, z1, x2, y2, z2 ...] by ROI
     origin : ndarray of float
         Origin of the grid [px, py, pz]
     spacing : ndarray of float
         Voxel volume size [vx, vy, vz] or [[vxx, vxy, vxz], [vyx, vyy, vzy], [vzx, vzy, vzz]]
     sizes : ndarray of int, optional
         If provided, use as the maximum size of the matrix, otherwise calculate
+    fill_rule : str, optional
+        "nonzero" (default) or "evenodd", see fill_rules
+    labels : ndarray, optional
+        A preallocated label volume of shape sizes to write into, otherwise one is allocated
+    dtype : optional
+        The data type of an allocated label volume (default: np.float64), see label_dtype for a compact one
     """
 
     # figure out parameters for the volume
-    originp, spacingp, sizesp, max_point = parameters_for_contours(contour_list)
-    if origin is None:
-        origin = originp
-    if spacing is None:
-        spacing = spacingp
-    if sizes is None:
-        sizes = sizesp
+    if origin is None or spacing is None or sizes is None:
+        originp, spacingp, sizesp, max_point = parameters_for_contours(contour_list)
+        if origin is None:
+            origin = originp
+        if spacing is None:
+            spacing = spacingp
+        if sizes is None:
+            sizes = sizesp
 
-    img = np.zeros(sizes)
+    img = np.zeros(sizes, dtype=dtype) if labels is None else labels
 
     # force to 3D:
-    if spacing.ndim == 1:
-        spacing3d = np.zeros((3, 3))
-        spacing3d[0, 0] = spacing[0]
-        spacing3d[1, 1] = spacing[1]
-        spacing3d[2, 2] = spacing[2]
-        spacing = spacing3d
-
-    # now place each contour on the matrix
-    for roi in contour_list:
-        contours = contour_list.get(roi)
-        for contour in contours:
-            x = contour[0::3]
-            y = contour[1::3]
-
-            # TODO: assume z is the same for the contour, because this is what we have seen so far
-            z = contour[2::3]
-            zv = image_to_voxel(contour[0:3], origin, spacing)[2]
-            if zv > img.shape[2]:
-                print(zv, '>', img.shape[2])
-                continue
-
-            # area to determine if this is a 'fill' or a 'hole'
-            area = 0.5 * (np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
-
-            coords_x = []
-            coords_y = []
-
-            for index in range(0, len(x)):
-                voxel_point = image_to_voxel(np.asarray((x[index], y[index], z[index])), origin, spacing)
-                # add the point
-                coords_x.append(voxel_point[1])
-                coords_y.append(voxel_point[0])
-
-            fill_coords_x, fill_coords_y = draw.polygon(coords_x, coords_y, img.shape[0:2])
-            contour_outline = np.zeros(img.shape[0:2], dtype=np.bool)
-            contour_outline[fill_coords_y, fill_coords_x] = True  # sitk is xyz, numpy is zyx
-
-            contour_filled = ndimage.binary_fill_holes(contour_outline)
-            contour_masked = ma.masked_array(data=img[:, :, zv], mask=False)
-
-            index = 9
-            if area > 0:
-                index = roi
-
-            contour_masked.mask = contour_filled
-            img[:, :, zv] = ma.filled(contour_masked, index)
+    geometry = volume_geometry(origin, spacing, sizes)
+    spacing = geometry.directions
+
+    contour_set = ContourSet.from_dict(contour_list)
+    if contour_set.contour_count == 0:
+        return img, origin, spacing
+
+    voxels, groups = _contour_slice_groups(contour_set, geometry, img.shape[2])
+    for zv, slice_groups in groups.items():
+        _fill_label_slice(img[:, :, zv], slice_groups, voxels, contour_set.offsets, fill_rule)
 
     return img, origin, spacing
+
+
+def contour_label_slices(contour_list,
+                         origin: np.ndarray,
+                         spacing: np.ndarray,
+                         sizes: np.ndarray,
+                         fill_rule: str = 'nonzero',
+                         dtype=None):
+    """
+    Generate the label volume of a set of contours one slice at a time, as contours_to_image but without holding the
+    whole volume, eg to stream it into a file writer
+
+    Parameters
+    ----------
+    contour_list: ContourSet, or dictionary of ndarray of ndarry of float
+        The contours by ROI
+    origin : ndarray of float
+        Origin of the grid [px, py, pz]
+    spacing : ndarray of float
+        Voxel volume size [vx, vy, vz] or 3x3
+    sizes : ndarray of int
+        The shape of the volume
+    fill_rule : str, optional
+        "nonzero" (default) or "evenodd", see fill_rules
+    dtype : optional
+        The data type of the slices (default: label_dtype of the ROI numbers)
+
+    Returns
+    -------
+    generator
+        (slice index, (sizes[0], sizes[1]) label slice) for every slice in order, including empty ones
+
+    """
+    contour_set = ContourSet.from_dict(contour_list)
+    dtype = label_dtype(contour_set.roi_numbers) if dtype is None else dtype
+    geometry = volume_geometry(origin, spacing, sizes)
+
+    voxels, groups = _contour_slice_groups(contour_set, geometry, int(sizes[2]))
+    for zv in range(int(sizes[2])):
+        label_slice = np.zeros((int(sizes[0]), int(sizes[1])), dtype=dtype)
+        if zv in groups:
+            _fill_label_slice(label_slice, groups[zv], voxels, contour_set.offsets, fill_rule)
+        yield zv, label_slice
@@ -3,19 +3,18 @@ from collections import OrderedDict
 import datetime
 import nrrd
 import numpy as np
-import numpy.ma as ma
 import os
 import pydicom
 import pydicom.uid
 import skimage
 from pydicom.sequence import Sequence
 from pydicom.dataset import Dataset
-import scipy.ndimage
 from scipy import ndimage
 import SimpleITK as SimpleITK
-from skimage import measure
 
-from radlib.dcm import contours
+from radlib.dcm import contours, readers, writers
+from radlib.dcm.bridges import nrrd_to_sitk, sitk_to_nrrd
+from radlib.dcm.writers import nrrd_types
 
 
 class InvalidDicomDateFormatException(Exception):
@@ -95,7 +94,9 @@ def pet_suv_factor(pet_slice: pydicom.FileDataset):
 
 
 def load_dicom(path: str,
-               resample: np.ndarray = None):
+               resample: np.ndarray = None,
+               workers: int = None,
+               policy: str = 'io'):
     """
     load a directory of DICOM slices into an array
 
@@ -107,6 +108,10 @@ def load_dicom(path: str,
     resample : np.ndarray of float, optional
         A three-dimensional array of the shape that the slices should be reshaped to
         TODO: currently we assume a square slice with x and y equal
+    workers : int, optional
+        Number of threads reading files concurrently (default: readers.default_read_workers())
+    policy : str, optional
+        'io' or 'cpu', see readers.read_dicom_files (default: 'io')
 
     Returns
     --------
@@ -117,8 +122,7 @@ def load_dicom(path: str,
     files = []
     slice_zoom = -1
 
-    for fname in glob.glob(path+"\\*", recursive=False):
-        file = pydicom.dcmread(fname)
+    for file in readers.read_dicom_files(glob.glob(path+"\\*", recursive=False), workers=workers, policy=policy):
         # figure out orientation
         # TODO: Remove if not needed. Uncomment if needed.
         # if file.PatientPosition == "HFS":  # head first supine, need to transpose
@@ -144,57 +148,90 @@ def load_dicom(path: str,
 
 
 def generate_array_from_dicom(slices: pydicom.FileDataset,
-                              resample: np.ndarray = None):
+                              resample: np.ndarray = None,
+                              dtype=np.float32):
     """
     Given an array of "slices" usually from DICOM files, convert to an image volume matrix
 
+    Slices are decoded into one preallocated buffer in their native pixel type, then rescale slope/intercept
+    (and SUV for PET) are applied to the whole stack at once with per-slice vectors
+
     Parameters
     ----------
     slices : array-like of FileDataset
         An ordered array of pydicom slices each coresponding to a 2D slice of image information
     resample : array-like of float, optional
-        A three-dimensional array of the shape that the slices should be reshaped to
-        TODO: currently this is not working
+        A three-dimensional array of the shape that the slices should be reshaped to, the third dimension must
+        match the number of slices. All slices are resized together
+    dtype : optional
+        The (floating point) data type of the returned matrix (default: np.float32)
 
     Returns
     -------
-    ndarray of float
+    ndarray of dtype
         A three dimensional matrix of image data from all of the slices
 
     """
-    # create 3D array
-    slice_shape = slices[0].pixel_array.shape
-    img_shape = [slice_shape[0], slice_shape[1], len(slices)]
+    # decode every slice into one buffer in the native pixel type, slices first so each slice is contiguous
+    first_slice = slices[0].pixel_array
+    buffer = np.empty((len(slices), first_slice.shape[0], first_slice.shape[1]), dtype=first_slice.dtype)
+    buffer[0] = first_slice
+    for i, s in enumerate(slices[1:], start=1):
+        buffer[i] = s.pixel_array
+
+    # rescale values from metadata, one slope/intercept per slice broadcast over the stack
+    rescale_slope = np.array([float(s.get('RescaleSlope', 1.0)) for s in slices])
+    rescale_intercept = np.array([float(s.get('RescaleIntercept', 0.0)) for s in slices])
+    img3d = buffer.astype(dtype)
+    del buffer
+    img3d *= rescale_slope[:, None, None]
+    img3d += rescale_intercept[:, None, None]
+
+    # if PET, convert to SUV
+    if slices[0].Modality == 'PT':
+        img3d *= pet_suv_factor(slices[0])
 
-    if resample is not None:
-        img3d = np.zeros(resample)
-    else:
-        img3d = np.zeros(img_shape)
+    # slices last, the same layout as before
+    img3d = np.moveaxis(img3d, 0, -1)
 
-    rescale_suv = 1.0
-    if slices[0].Modality == 'PT':
-        rescale_suv = pet_suv_factor(slices[0])
+    # resample to another shape, all slices in one call (the slice axis is not resized)
+    if resample is not None:
+        img3d = skimage.transform.resize(img3d, (resample[0], resample[1], len(slices))).astype(dtype)
 
-    # fill 3D array with the images from the files
-    for i, s in enumerate(slices):
-        img2d = s.pixel_array
+    return img3d
 
-        # rescale values from metadata
-        rescale_slope = s.RescaleSlope
-        rescale_intercept = s.RescaleIntercept
-        img2d = img2d * rescale_slope + rescale_intercept
 
-        # if PET, convert to SUV
-        if s.Modality == 'PT':
-            img2d = img2d * rescale_suv
+def generate_slabs_from_dicom(slices: pydicom.FileDataset,
+                              dtype=np.float32,
+                              slab_size: int = 16):
+    """
+    Given an array of "slices", generate the image volume matrix a few slices at a time, with the same values as
+    generate_array_from_dicom, so it can be written out while the rest of the slices are still being decoded
 
-        # resample to another shape
-        if resample is not None:
-            img2d = skimage.transform.resize(img2d, (resample[0], resample[1]))
+    Parameters
+    ----------
+    slices : array-like of FileDataset
+        An ordered array of pydicom slices each coresponding to a 2D slice of image information
+    dtype : optional
+        The (floating point) data type of the slabs (default: np.float32)
+    slab_size : int, optional
+        The number of slices in each slab (default: 16)
 
-        img3d[:, :, i] = img2d
+    Returns
+    -------
+    generator of ndarray of dtype
+        (rows, columns, up to slab_size) matrices of image data, in slice order
 
-    return img3d
+    """
+    suv_factor = pet_suv_factor(slices[0]) if slices[0].Modality == 'PT' else None
+    for start in range(0, len(slices), slab_size):
+        slab_slices = slices[start:start + slab_size]
+        slab = np.stack([s.pixel_array for s in slab_slices]).astype(dtype)
+        slab *= np.array([float(s.get('RescaleSlope', 1.0)) for s in slab_slices])[:, None, None]
+        slab += np.array([float(s.get('RescaleIntercept', 0.0)) for s in slab_slices])[:, None, None]
+        if suv_factor is not None:
+            slab *= suv_factor
+        yield np.moveaxis(slab, 0, -1)
 
 
 def new_dicom_dataset(source_data_set: Dataset = None,
@@ -327,14 +364,18 @@ def nrrd_to_dicomrt_file(nrrd_path, dicomrt_path):
     nrrd_data, nrrd_header = nrrd.read(nrrd_path)
     nrrd_to_dicomrt(nrrd_data, nrrd_header, file_path=dicomrt_path)
 
-    # validate
+    # validate, rasterizing the written contours back onto the Nrrd grid a slice at a time
     dicom_slice = pydicom.dcmread(dicomrt_path)
-    nrrd_comp, nrrd_comp_header = dicomrt_to_nrrd(dicom_slice)
-    return (np.square(nrrd_comp - nrrd_data)).mean(axis=None)
+    contour_list = contours.pydicom_to_contours(dicom_slice)
+    squared_error = 0.0
+    for slice_index, label_slice in contours.contour_label_slices(contour_list, nrrd_header['space origin'],
+                                                                   nrrd_header['space directions'], nrrd_data.shape):
+        squared_error += np.square(label_slice - nrrd_data[:, :, slice_index], dtype=np.float64).sum()
+    return squared_error / nrrd_data.size
 
 
 def nrrd_to_dicomrt(nrrd_data, nrrd_header: dict, ref_dicom_data: list = None, reverse_z: bool = False,
-                    resampled: bool = False, file_path: str = ""):
+                    resampled: bool = False, file_path: str = "", workers: int = None):
     """
     Given a set of one or more dicom files and an NRRD file of segmentations, generate a dicom-RT
        structure set file
@@ -353,6 +394,8 @@ def nrrd_to_dicomrt(nrrd_data, nrrd_header: dict, ref_dicom_data: list = None, r
         Resample nrrd data to match dimensions of the dicom data before contouring (default False)
     file_path : str, optional
         Path to write the resulting structure set file
+    workers : int, optional
+        Number of processes finding contours, see contours.label_slice_contours (default: the number of cores)
 
     Returns
     -------
@@ -376,7 +419,7 @@ def nrrd_to_dicomrt(nrrd_data, nrrd_header: dict, ref_dicom_data: list = None, r
     if resampled:
         slice_zoom = dicom_ref.pixel_array.shape[0] / nrrd_data.shape[0]
     nrrd_origin = nrrd_header['space origin']
-    nrrd_directions = nrrd_header['space directions']
+    nrrd_directions = np.array(nrrd_header['space directions'], dtype=np.float64)
 
     if resampled:
         nrrd_directions[0] /= slice_zoom
@@ -468,78 +511,61 @@ def nrrd_to_dicomrt(nrrd_data, nrrd_header: dict, ref_dicom_data: list = None, r
     roi_contour_sequence = Sequence()
     ds.ROIContourSequence = roi_contour_sequence
 
-    for slice_index in range(slice_count):
-        # for each slice, get all ROIs present (ignore 0)
-        image_slice = nrrd_data[:, :, slice_index]
-        rois = np.unique(image_slice)
-        rois = np.delete(rois, 0).astype(int)
-
-        # for each ROI in the slice, generate contour(s)
-        for roi in rois:
-
-            # find the ROI for this contour and create it if it wasn't already seen
-            if roi not in image_rois:
-                # Structure Set ROI Sequence: Structure Set ROI
-                structure_set_roi = Dataset()
-                structure_set_roi.ROINumber = str(roi)
-                structure_set_roi.ReferencedFrameOfReferenceUID = dicom_ref.FrameOfReferenceUID # pydicom.uid.generate_uid()
-                structure_set_roi.ROIName = 'ROI ' + str(roi)
-                structure_set_roi.ROIGenerationAlgorithm = "AUTOMATIC"
-                structure_set_roi_sequence.append(structure_set_roi)
-                image_rois.append(roi)
-
-            # ROI Contour Sequence
-            roi_contour = Dataset()
-            roi_contour.ROIDisplayColor = ['128', '174', '128']
+    # contours of every ROI on every slice (ignore 0), only where each ROI is, spread over processes
+    found = contours.label_slice_contours(nrrd_data, 0.8, zoom=slice_zoom, workers=workers)
+
+    # all contour points to (truncated) image coordinates at once
+    geometry = contours.VolumeGeometry(nrrd_origin, nrrd_directions, nrrd_data.shape)
+    arrays = [np.column_stack((arr, np.full(len(arr), slice_index)))
+              for slice_index, _, contour_arrays in found for arr in contour_arrays]
+    if len(arrays) > 0:
+        points = np.trunc(geometry.voxels_to_image(np.concatenate(arrays), reverse_z)).astype(int)
+        points = np.split(points, np.cumsum([len(arr) for arr in arrays])[:-1])
+    contour_index = 0
+
+    for slice_index, roi, contour_arrays in found:
+        # find the ROI for this contour and create it if it wasn't already seen
+        if roi not in image_rois:
+            # Structure Set ROI Sequence: Structure Set ROI
+            structure_set_roi = Dataset()
+            structure_set_roi.ROINumber = str(roi)
+            structure_set_roi.ReferencedFrameOfReferenceUID = dicom_ref.FrameOfReferenceUID # pydicom.uid.generate_uid()
+            structure_set_roi.ROIName = 'ROI ' + str(roi)
+            structure_set_roi.ROIGenerationAlgorithm = "AUTOMATIC"
+            structure_set_roi_sequence.append(structure_set_roi)
+            image_rois.append(roi)
+
+        # ROI Contour Sequence
+        roi_contour = Dataset()
+        roi_contour.ROIDisplayColor = ['128', '174', '128']
+
+        # Contour Sequence
+        contour_sequence = Sequence()
+        roi_contour.ContourSequence = contour_sequence
+
+        for _ in contour_arrays:
+            contour_points = points[contour_index]
+            contour_index += 1
 
             # Contour Sequence
-            contour_sequence = Sequence()
-            roi_contour.ContourSequence = contour_sequence
-
-            # find the contour(s) for this roi
-            roi_slice = (image_slice == roi)
-
-            if resampled:
-                roi_slice = scipy.ndimage.zoom(roi_slice, slice_zoom, order=0)
-
-            contours = measure.find_contours(roi_slice, 0.8)
-
-            for arr in contours:
-
-                # Contour Sequence
-                contour = Dataset()
-
-                # Contour Image Sequence
-                contour_image_sequence = Sequence()
-                contour.ContourImageSequence = contour_image_sequence
-                # Contour Image
-                contour_image = Dataset()
-                contour_image.ReferencedSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
-                contour_image.ReferencedSOPInstanceUID = image_uids[slice_index]
-                contour_image_sequence.append(contour_image)
-
-                contour.ContourGeometricType = 'CLOSED_PLANAR'
-                contour_point_count = 0
-                points_string = []
-                for point in range(0, arr.shape[0]):
-                    xf = (nrrd_origin[0] + nrrd_directions[0, 0] * arr[point, 0])
-                    yf = (nrrd_origin[1] + nrrd_directions[1, 1] * arr[point, 1])
-                    z = (slice_count - slice_index) if reverse_z else slice_index
-                    zf = nrrd_origin[2] + nrrd_directions[2, 2] * z
-                    xf = int(xf)
-                    yf = int(yf)
-                    zf = int(zf)
-                    points_string.append(xf)
-                    points_string.append(yf)
-                    points_string.append(zf)
-                    contour_point_count += 1
-
-                contour.NumberOfContourPoints = contour_point_count
-                contour.ContourData = points_string
-                contour_sequence.append(contour)
-
-            roi_contour.ReferencedROINumber = str(roi)
-            roi_contour_sequence.append(roi_contour)
+            contour = Dataset()
+
+            # Contour Image Sequence
+            contour_image_sequence = Sequence()
+            contour.ContourImageSequence = contour_image_sequence
+            # Contour Image
+            contour_image = Dataset()
+            contour_image.ReferencedSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+            contour_image.ReferencedSOPInstanceUID = image_uids[slice_index]
+            contour_image_sequence.append(contour_image)
+
+            contour.ContourGeometricType = 'CLOSED_PLANAR'
+            contour.NumberOfContourPoints = len(contour_points)
+            contour.ContourData = contour_points.ravel().tolist()
+            contour_sequence.append(contour)
+
+        roi_contour.ReferencedROINumber = str(roi)
+        roi_contour_sequence.append(roi_contour)
 
     # RT ROI Observations Sequence
     rtroi_observations_sequence = Sequence()
@@ -555,23 +581,42 @@ def nrrd_to_dicomrt(nrrd_data, nrrd_header: dict, ref_dicom_data: list = None, r
     rtroi_observations_sequence.append(rtroi_observations)
 
     if len(file_path) > 0:
-        # File meta info data elements
-        file_meta = Dataset()
-        file_meta.FileMetaInformationVersion = b'\x00\x01'
-        file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.481.3'
-        file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
-        file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
-        file_meta.ImplementationClassUID = '1.2.276.0.7230010.3.0.3.6.3'
-        file_meta.ImplementationVersionName = 'OFFIS_DCMTK_363'
-        file_meta_length = 2 + 29 + 19 + 27 + 15 + len(file_meta.MediaStorageSOPInstanceUID)
-        file_meta.FileMetaInformationGroupLength = file_meta_length
-        ds.file_meta = file_meta
-        ds.is_implicit_VR = False
-        ds.is_little_endian = True
-        ds.save_as(file_path, write_like_original=False)
+        save_dicomrt(ds, file_path)
     return ds
 
 
+def save_dicomrt(ds: Dataset, file_path: str):
+    """
+    Write a DICOM-RT structure set dataset (eg from nrrd_to_dicomrt) to a file
+
+    Parameters
+    ----------
+    ds : Dataset
+        The structure set
+    file_path : str
+        Path to write the structure set file to
+
+    Returns
+    -------
+    None
+
+    """
+    # File meta info data elements
+    file_meta = Dataset()
+    file_meta.FileMetaInformationVersion = b'\x00\x01'
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.481.3'
+    file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+    file_meta.ImplementationClassUID = '1.2.276.0.7230010.3.0.3.6.3'
+    file_meta.ImplementationVersionName = 'OFFIS_DCMTK_363'
+    file_meta_length = 2 + 29 + 19 + 27 + 15 + len(file_meta.MediaStorageSOPInstanceUID)
+    file_meta.FileMetaInformationGroupLength = file_meta_length
+    ds.file_meta = file_meta
+    ds.is_implicit_VR = False
+    ds.is_little_endian = True
+    ds.save_as(file_path, write_like_original=False)
+
+
 def dicomrt_to_nrrd_file(dicom_path, nrrd_path):
     """
     Convert a DICOM-RT file to a Nrrd file including header (assume one slice)
@@ -588,20 +633,31 @@ def dicomrt_to_nrrd_file(dicom_path, nrrd_path):
 
     """
     dicom_slice = pydicom.dcmread(dicom_path)
-    nrrd_data, nrrd_header = dicomrt_to_nrrd(dicom_slice, file_path=nrrd_path)
-    nrrd.write(nrrd_path, nrrd_data, nrrd_header)
+    dicomrt_to_nrrd(dicom_slice, file_path=nrrd_path, stream=True)
 
 
-def dicomrt_to_nrrd(dicom_data, file_path=None):
+def dicomrt_to_nrrd(dicom_data, file_path=None, dtype=None, fill_rule='nonzero', stream=False, workers=None):
     """
     Given a dicomrt file, generate a nrrd structure from it
 
+    Contours are rasterized once, slice by slice, with holes handled by the fill rule (see contours.fill_rules), into
+    a compact integer label volume
+
     Parameters
     ----------
     dicom_data : Dataset
         A python list of pydicom-read images
     file_path : str, optional
-        Path to write the resulting structure set file
+        Path to write the resulting label file, Nrrd or NIfTI (.nii, .nii.gz)
+    dtype : optional
+        The data type of the label matrix (default: the smallest unsigned type for the ROI numbers)
+    fill_rule : str, optional
+        "nonzero" (default) or "evenodd"
+    stream : bool, optional
+        Write the label slices straight to file_path as they are filled instead of building the whole matrix, the
+        returned nrrd_data is then None (default False)
+    workers : int, optional
+        Number of threads compressing the file (default: writers.default_compression_workers())
 
     Returns
     -------
@@ -612,76 +668,48 @@ def dicomrt_to_nrrd(dicom_data, file_path=None):
 
       """
     # dimensions of the resulting matrix
-    dimensions = (dicom_data.Rows, dicom_data.Columns, dicom_data.NumberOfSlices)
+    dimensions = (int(dicom_data.Rows), int(dicom_data.Columns), int(dicom_data.NumberOfSlices))
 
     ds = dicom_data
 
-    ds_origin = ds.ImagePosition
-    ds_directions = ds.PixelSpacing
-    ds_directions.append(ds.SpacingBetweenSlices)
-    directions = np.array((ds_directions[0], ds_directions[1], ds_directions[2]))  # convert from pydicom multivalue
+    ds_origin = np.array(ds.ImagePosition, dtype=np.float64)
+    directions = np.array((ds.PixelSpacing[0], ds.PixelSpacing[1], ds.SpacingBetweenSlices), dtype=np.float64)
 
-    # add contours
+    # contours and the label type that holds every ROI number
     contour_list = contours.pydicom_to_contours(ds)
-    nrrd_data = contours.contours_to_image(contour_list, ds_origin, directions, sizes=dimensions)
-
-    for contourSequence in ds.ROIContourSequence:
-        roi = contourSequence.ReferencedROINumber
-        for roiContour in contourSequence.ContourSequence:
-            contour = roiContour.ContourData
-
-            contour_slice = np.zeros((dimensions[0], dimensions[1]))
-            x = contour[0::3]
-            y = contour[1::3]
-
-            # area to figure out if it is a shape contour (positive) or a hole contour (negative)
-            area = 0.5 * (np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
-            zf = int(round((contour[2] - ds_origin[2]) / ds_directions[2]))  # z always same
-
-            # convert each point
-            for index in range(0, len(x)):
-                xf = int(round((x[index] + 0.5 - ds_origin[0]) / ds_directions[0]))
-                yf = int(round((y[index] + 0.5 - ds_origin[1]) / ds_directions[1]))
-                contour_slice[xf, yf] = 1
-
-            # mask it
-            contour_filled = ndimage.binary_fill_holes(contour_slice)
-            contour_masked = ma.masked_array(data=nrrd_data[:, :, zf], mask=False)
-
-            if area > 0:
-                contour_masked.mask = contour_filled
-                nrrd_data[:, :, zf] = ma.filled(contour_masked, roi)
-
-            else:
-                contour_masked.mask = (contour_filled - contour_slice)
-                nrrd_data[:, :, zf] = ma.filled(contour_masked, 0)
+    dtype = contours.label_dtype(contour_list.roi_numbers) if dtype is None else np.dtype(dtype)
 
     # build the Nrrd header
     nrrd_header = OrderedDict()
-    nrrd_header['type'] = 'double'
+    nrrd_header['type'] = nrrd_types[dtype.str[1:]]
     nrrd_header['dimension'] = 3
     nrrd_header['space'] = 'left-posterior-superior'
 
     nrrd_header['sizes'] = np.array(dimensions)
-    nrrd_header['space directions'] = np.array(((float(dicom_data.PixelSpacing[0]), 0., 0.),
-                                                (0., float(dicom_data.PixelSpacing[1]), 0.),
-                                                (0., 0., float(dicom_data.SpacingBetweenSlices)))
-                                               )
+    nrrd_header['space directions'] = np.diag(directions)
     nrrd_header['encoding'] = 'gzip'
-    nrrd_header['endian'] = 'little'
+    if dtype.itemsize > 1:
+        nrrd_header['endian'] = 'little'
     nrrd_header['kinds'] = ('domain', 'domain', 'domain')
-    nrrd_header['space origin'] = np.array((float(dicom_data.ImagePosition[0]),
-                                            float(dicom_data.ImagePosition[1]),
-                                            float(dicom_data.ImagePosition[2])))
+    nrrd_header['space origin'] = ds_origin
+
+    if stream and file_path is not None:
+        slices = contours.contour_label_slices(contour_list, ds_origin, directions, dimensions, fill_rule, dtype)
+        writers.write_volume_slabs(file_path, nrrd_header, (label_slice[:, :, None] for _, label_slice in slices),
+                                   workers)
+        return None, nrrd_header
+
+    nrrd_data, _, _ = contours.contours_to_image(contour_list, ds_origin, directions, sizes=dimensions,
+                                                 fill_rule=fill_rule, dtype=dtype)
 
     # write to file(s)
     if file_path is not None:
-        nrrd.write(file_path, nrrd_data, nrrd_header)
+        writers.write_volume_slabs(file_path, nrrd_header, [nrrd_data], workers)
 
     return nrrd_data, nrrd_header
 
 
-def dicom_to_nrrd(dicom_data, file_path=None):
+def dicom_to_nrrd(dicom_data, file_path=None, dtype=np.float32, cache=None, stream=False, workers=None):
     """
     Given a dicom file, generate a nrrd structure from it
 
@@ -690,7 +718,17 @@ def dicom_to_nrrd(dicom_data, file_path=None):
     dicom_data : Dataset
         A python list of pydicom-read images
     file_path : str, optional
-        Path to write the resulting structure set file
+        Path to write the resulting image file, Nrrd or NIfTI (.nii, .nii.gz)
+    dtype : optional
+        The data type of the image matrix (default: np.float32)
+    cache : VolumeCache, optional
+        A volume_cache.VolumeCache to map the decoded matrix from, or store it in (default: None). Only used when
+        every slice has a filename to key it by
+    stream : bool, optional
+        Write slabs of slices to file_path as they are decoded instead of building the whole matrix, the returned
+        nrrd_data is then None (default False, ignored with a cache)
+    workers : int, optional
+        Number of threads compressing the file (default: writers.default_compression_workers())
 
     Returns
     -------
@@ -706,16 +744,19 @@ def dicom_to_nrrd(dicom_data, file_path=None):
 
     ds = dicom_data[0]
 
-    # ds_origin = ds.ImagePosition
-    ds_directions = ds.PixelSpacing
-    ds_directions.append(ds.SliceThickness)
-
-    # add contours
-    nrrd_data = contours.generate_array_from_dicom(dicom_data)
+    # image data, from the volume cache when we have one
+    paths = [getattr(s, 'filename', None) for s in dicom_data]
+    if cache is not None and all(isinstance(path, str) for path in paths):
+        key = cache.key(paths, ds.get('SeriesInstanceUID'), f'array|{np.dtype(dtype).str}')
+        nrrd_data, _ = cache.get_or_put(key, lambda: (generate_array_from_dicom(dicom_data, dtype=dtype), None))
+    elif stream and file_path is not None:
+        nrrd_data = None
+    else:
+        nrrd_data = generate_array_from_dicom(dicom_data, dtype=dtype)
 
     # build the Nrrd header
     nrrd_header = OrderedDict()
-    nrrd_header['type'] = 'double'
+    nrrd_header['type'] = nrrd_types.get(np.dtype(dtype if nrrd_data is None else nrrd_data.dtype).str[1:], 'double')
     nrrd_header['dimension'] = 3
     nrrd_header['space'] = 'left-posterior-superior'
 
@@ -732,8 +773,10 @@ def dicom_to_nrrd(dicom_data, file_path=None):
                                             float(ds.ImagePositionPatient[2])))
 
     # write to file(s)
-    if file_path is not None:
-        nrrd.write(file_path, nrrd_data, nrrd_header)
+    if nrrd_data is None:
+        writers.write_volume_slabs(file_path, nrrd_header, generate_slabs_from_dicom(dicom_data, dtype), workers)
+    elif file_path is not None:
+        writers.write_volume_slabs(file_path, nrrd_header, [nrrd_data], workers)
 
     return nrrd_data, nrrd_header
 
@@ -833,35 +876,184 @@ def nifti_to_nrrd_file(nifti_path, nrrd_path):
     sitk_converter('NiftiImageIO', nifti_path, 'NrrdImageIO', nrrd_path)
 
 
-def convert_file(from_path, from_type, to_path, to_type, logger):
-    if from_type == '.nrrd':
-        if to_type == '.nii':
-            nrrd_to_nifti_file(from_path, to_path)
-        if to_type == '.dcm':
-            nrrd_to_dicomrt_file(from_path, to_path)
-
-    elif from_type == '.nii':
-        if to_type == '.nrrd':
-            nrrd_to_nifti_file(from_path, to_path)
-        if to_type == '.dcm':
-            if logger is not None:
-                logger.log_info("still working on this")
-            else:
-                print("still working on this")
-
-    elif from_type == '.dcm':
-        if to_type == '.nrrd':
-            dicomrt_to_nrrd_file(from_path, to_path)
-        if to_type == '.nii':
-            if logger is not None:
-                logger.log_info("still working on this")
-            else:
-                print("still working on this")
+def _save_nrrd(volume, file_path):
+    nrrd_data, nrrd_header = volume
+    nrrd_header = OrderedDict(nrrd_header)
+    nrrd_header['type'] = nrrd_types.get(nrrd_data.dtype.str[1:], 'double')
+    nrrd_header['encoding'] = 'gzip'
+    nrrd_header.pop('endian', None)
+    if nrrd_data.dtype.itemsize > 1:
+        nrrd_header['endian'] = 'little'
+    writers.write_nrrd_slabs(file_path, nrrd_header, [nrrd_data])
 
-    else:
+
+# file types the conversion graph can read and write, type -> (load(path), save(data, path)). The data passed along
+# the graph is (nrrd_data, nrrd_header) for .nrrd, a SimpleITK image for NIfTI and a pydicom Dataset for DICOM-RT
+conversion_formats = {
+    '.nrrd': (nrrd.read, _save_nrrd),
+    '.nii': (SimpleITK.ReadImage, lambda image, file_path: SimpleITK.WriteImage(image, file_path)),
+    '.nii.gz': (SimpleITK.ReadImage, lambda image, file_path: SimpleITK.WriteImage(image, file_path)),
+    '.dcm': (pydicom.dcmread, save_dicomrt),
+}
+
+# in-memory conversions between them, from type -> {to type: function(data) -> data}
+conversion_graph = {}
+
+
+def register_conversion(from_type: str, to_type: str, function=None):
+    """
+    Add an in-memory conversion to the conversion graph, as a function or a decorator
+
+    Parameters
+    ----------
+    from_type : str
+        The file type (see image_file_type) the function takes data for
+    to_type : str
+        The file type the function returns data for
+    function : callable, optional
+        function(data) -> data, if not given register_conversion returns a decorator
+
+    Returns
+    -------
+    function, or a decorator
+
+    """
+    def register(function):
+        conversion_graph.setdefault(from_type, {})[to_type] = function
+        return function
+
+    if function is None:
+        return register
+    return register(function)
+
+
+def register_format(file_type: str, load, save):
+    """
+    Add a file type to the conversion graph
+
+    Parameters
+    ----------
+    file_type : str
+        The file type, as from image_file_type
+    load : callable
+        load(path) -> data
+    save : callable
+        save(data, path)
+
+    Returns
+    -------
+    None
+
+    """
+    conversion_formats[file_type] = (load, save)
+
+
+def conversion_plan(from_type: str, to_type: str):
+    """
+    Find the shortest chain of registered conversions between two file types
+
+    Parameters
+    ----------
+    from_type : str
+        The file type to start from
+    to_type : str
+        The file type to end at
+
+    Returns
+    -------
+    list of str
+        The file types along the way, from_type first and to_type last, or None when there is no path
+
+    """
+    previous = {from_type: None}
+    queue = [from_type]
+    for file_type in queue:
+        if file_type == to_type:
+            plan = []
+            while file_type is not None:
+                plan.append(file_type)
+                file_type = previous[file_type]
+            return plan[::-1]
+        for next_type in conversion_graph.get(file_type, {}):
+            if next_type not in previous:
+                previous[next_type] = file_type
+                queue.append(next_type)
+    return None
+
+
+def convert_data(data, from_type: str, to_type: str):
+    """
+    Convert loaded data between file types in memory, through as many hops of the conversion graph as needed
+
+    Parameters
+    ----------
+    data :
+        The data, as loaded for from_type (see conversion_formats)
+    from_type : str
+        The file type of the data
+    to_type : str
+        The file type to convert to
+
+    Returns
+    -------
+    The data for to_type
+
+    """
+    plan = conversion_plan(from_type, to_type)
+    if plan is None:
+        raise ValueError(f'cannot convert {from_type} to {to_type}')
+    for step_from, step_to in zip(plan[:-1], plan[1:]):
+        data = conversion_graph[step_from][step_to](data)
+    return data
+
+
+register_conversion('.nrrd', '.nii', lambda volume: nrrd_to_sitk(*volume))
+register_conversion('.nrrd', '.nii.gz', lambda volume: nrrd_to_sitk(*volume))
+register_conversion('.nii', '.nrrd', sitk_to_nrrd)
+register_conversion('.nii.gz', '.nrrd', sitk_to_nrrd)
+register_conversion('.nii', '.nii.gz', lambda image: image)
+register_conversion('.nii.gz', '.nii', lambda image: image)
+register_conversion('.dcm', '.nrrd', dicomrt_to_nrrd)
+# no .nrrd -> .dcm edge: nrrd_to_dicomrt needs the reference DICOM series (frame of reference, geometry), which a lone
+# label file doesn't carry, call it directly with ref_dicom_data instead
+
+
+def convert_file(from_path, from_type=None, to_path=None, to_type=None, logger=None):
+    """
+    Convert a file to another type through the conversion graph, any intermediate types stay in memory
+
+    Parameters
+    ----------
+    from_path : str
+        The file to convert
+    from_type : str, optional
+        Its type (default: image_file_type(from_path))
+    to_path : str
+        The file to write
+    to_type : str, optional
+        Its type (default: image_file_type(to_path))
+    logger : optional
+        Logger with log_info, or None to print
+
+    Returns
+    -------
+    bool
+        True if the file was converted
+
+    """
+    from_type = image_file_type(from_path) if from_type is None else from_type
+    to_type = image_file_type(to_path) if to_type is None else to_type
+
+    plan = conversion_plan(from_type, to_type)
+    if plan is None or from_type not in conversion_formats or to_type not in conversion_formats:
+        message = "cannot convert " + from_type + " to " + to_type + "(yet)"
         if logger is not None:
-            logger.log_info("cannot convert " + from_type + " to " + to_type + "(yet)")
+            logger.log_info(message)
         else:
-            print("cannot convert " + from_type + " to " + to_type + "(yet)")
+            print(message)
+        return False
 
-        logger.log_info("cannot convert " + from_type + " to " + to_type + "(yet)")
+    data = conversion_formats[from_type][0](from_path)
+    data = convert_data(data, from_type, to_type)
+    conversion_formats[to_type][1](data, to_path)
+    return True
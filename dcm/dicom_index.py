@@ -0,0 +1,404 @@
+import os
+import sqlite3
+import threading
+import time
+
+# tables: every input file with its header UIDs and where it was sorted to (or why it couldn't be), every sorted
+# series folder with when it was last sorted into, converted and moved, and every scanned input folder with its mtime
+# and subfolders so unchanged folders don't have to be listed again
+_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sop_instance_uid TEXT,
+    series_instance_uid TEXT,
+    study_instance_uid TEXT,
+    patient_id TEXT,
+    sorted_path TEXT,
+    sorted_ns INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS files_sorted ON files (sorted_ns);
+CREATE INDEX IF NOT EXISTS files_sorted_path ON files (sorted_path);
+CREATE TABLE IF NOT EXISTS series (
+    series_dir TEXT PRIMARY KEY,
+    series_instance_uid TEXT,
+    study_instance_uid TEXT,
+    patient_id TEXT,
+    series_description TEXT,
+    slices INTEGER DEFAULT 0,
+    sorted_ns INTEGER,
+    converted_ns INTEGER,
+    converted_path TEXT,
+    selected INTEGER,
+    moved_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS series_patient ON series (patient_id);
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    subfolders TEXT
+);
+"""
+
+# the header elements kept for each file
+index_tags = ['SOPInstanceUID', 'SeriesInstanceUID', 'StudyInstanceUID', 'PatientID']
+
+
+class DicomIndex:
+    """
+    A persistent (SQLite) index of the DICOM files a DicomSorter has seen: file path, size, mtime and header UIDs,
+    where each file was sorted to, and the pipeline stage of each sorted series folder. Lookups are by primary key
+    so checking a file is O(1) whatever the size of the study, state survives restarts, and questions like "which
+    series of patient X are not converted yet" are answered without touching the filesystem
+
+    """
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        if os.path.dirname(index_path) != '':
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        self.connection = sqlite3.connect(index_path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        if len(self.connection.execute("SELECT name FROM sqlite_master WHERE name = 'files'").fetchall()) > 0 and \
+                'error' not in [row['name'] for row in self.connection.execute('PRAGMA table_info(files)')]:
+            # indexes made before unreadable files were recorded
+            self.connection.execute('ALTER TABLE files ADD COLUMN error TEXT')
+        self.connection.executescript(_schema)
+        self.lock = threading.RLock()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _execute(self, sql, parameters=()):
+        with self.lock, self.connection:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    # files
+
+    def file_states(self, prefix: str = None) -> dict:
+        """
+        size, mtime and sorted time of every known file, for O(1) membership checks over a whole scan
+
+        Parameters
+        ----------
+        prefix: str, optional, default None
+            only files whose path starts with this
+
+        Returns
+        -------
+        dict of path: (size, mtime_ns, sorted_ns)
+        """
+        if prefix is None:
+            rows = self._execute('SELECT path, size, mtime_ns, sorted_ns FROM files')
+        else:
+            rows = self._execute('SELECT path, size, mtime_ns, sorted_ns FROM files WHERE substr(path, 1, ?) = ?',
+                                 (len(prefix), prefix))
+        return {row['path']: (row['size'], row['mtime_ns'], row['sorted_ns']) for row in rows}
+
+    def file(self, path: str):
+        rows = self._execute('SELECT * FROM files WHERE path = ?', (path,))
+        return dict(rows[0]) if len(rows) > 0 else None
+
+    def is_sorted(self, path: str, size: int = None, mtime_ns: int = None) -> bool:
+        """
+        whether a file was sorted, and hasn't changed since when size/mtime are given
+
+        Parameters
+        ----------
+        path: str
+            the input file
+        size: int, optional, default None
+            its current size
+        mtime_ns: int, optional, default None
+            its current modification time
+
+        Returns
+        -------
+        bool
+        """
+        row = self.file(path)
+        if row is None or row['sorted_ns'] is None:
+            return False
+        return (size is None or row['size'] == size) and (mtime_ns is None or row['mtime_ns'] == mtime_ns)
+
+    def record_files(self, files: list):
+        """
+        add or update input files that are waiting to be sorted, files that changed are sorted again (and ones that
+        couldn't be read are retried)
+
+        Parameters
+        ----------
+        files: list
+            (path, size, mtime_ns) tuples
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT INTO files (path, size, mtime_ns) VALUES (?, ?, ?) '
+                'ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, sorted_ns = NULL, '
+                'error = NULL WHERE files.size IS NOT excluded.size OR files.mtime_ns IS NOT excluded.mtime_ns', files)
+
+    def record_sorted(self, sorted_files: list):
+        """
+        record files as sorted, with their header UIDs and sorted path, and update their series folders
+
+        Parameters
+        ----------
+        sorted_files: list
+            (input path, header Dataset, sorted path) tuples
+        """
+        now = time.time_ns()
+        file_rows = []
+        series_rows = {}
+        for path, meta, sorted_path in sorted_files:
+            try:
+                stat = os.stat(path)
+                size, mtime_ns = stat.st_size, stat.st_mtime_ns
+            except OSError:
+                # zip members are tracked by their archive
+                size, mtime_ns = None, None
+            values = [str(meta.get(tag, '')) for tag in index_tags]
+            file_rows.append((path, size, mtime_ns, *values, sorted_path, now))
+
+            series_dir = os.path.dirname(sorted_path)
+            series_rows[series_dir] = (series_dir, *values[1:], str(meta.get('SeriesDescription', '')))
+
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO files (path, size, mtime_ns, sop_instance_uid, series_instance_uid, '
+                'study_instance_uid, patient_id, sorted_path, sorted_ns) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                file_rows)
+            self.connection.executemany(
+                'INSERT INTO series (series_dir, series_instance_uid, study_instance_uid, patient_id, '
+                'series_description, sorted_ns) VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(series_dir) DO UPDATE SET sorted_ns = excluded.sorted_ns',
+                [(*row, now) for row in series_rows.values()])
+            # count the distinct files sorted into each folder (not into its subfolders), so files sorted again
+            # after they changed, or onto the same sorted path, aren't counted twice
+            self.connection.executemany(
+                "UPDATE series SET slices = (SELECT count(DISTINCT sorted_path) FROM files "
+                "WHERE sorted_path > series_dir || '/' AND sorted_path < series_dir || '0' "
+                "AND instr(substr(sorted_path, length(series_dir) + 2), '/') = 0) WHERE series_dir = ?",
+                [(series_dir,) for series_dir in series_rows])
+
+    def record_failed(self, failed_files: list):
+        """
+        record files that couldn't be read or sorted, with their size and mtime, so they are left alone until they
+        change (see record_files) instead of being retried on every pass
+
+        Parameters
+        ----------
+        failed_files: list
+            (input path, error message) tuples
+        """
+        file_rows = []
+        for path, error in failed_files:
+            try:
+                stat = os.stat(path)
+                size, mtime_ns = stat.st_size, stat.st_mtime_ns
+            except OSError:
+                # zip members are retried when their archive changes
+                size, mtime_ns = None, None
+            file_rows.append((path, size, mtime_ns, error))
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT INTO files (path, size, mtime_ns, error) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, sorted_ns = NULL, '
+                'error = excluded.error', file_rows)
+
+    def failed_files(self, prefix: str = None) -> dict:
+        # files recorded by record_failed that haven't changed since, path: error message
+        rows = self._execute('SELECT path, error FROM files WHERE error IS NOT NULL AND substr(path, 1, ?) = ?',
+                             (len(prefix or ''), prefix or ''))
+        return {row['path']: row['error'] for row in rows}
+
+    def mark_sorted(self, paths: list):
+        # record files (eg zip archives whose members were sorted) as sorted without header information
+        now = time.time_ns()
+        with self.lock, self.connection:
+            self.connection.executemany('UPDATE files SET sorted_ns = ? WHERE path = ?', [(now, path) for path in paths])
+
+    def forget_files(self, paths: list):
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in paths])
+
+    def unsorted_files(self, prefix: str = None) -> list:
+        """
+        files recorded but not (or no longer) sorted, leaving out ones that failed and haven't changed since
+
+        Parameters
+        ----------
+        prefix: str, optional, default None
+            only files whose path starts with this
+
+        Returns
+        -------
+        a sorted list of paths
+        """
+        rows = self._execute('SELECT path FROM files WHERE sorted_ns IS NULL AND error IS NULL '
+                             'AND substr(path, 1, ?) = ? ORDER BY path', (len(prefix or ''), prefix or ''))
+        return [row['path'] for row in rows]
+
+    # folders
+
+    def scan(self, root: str, suffixes: tuple) -> list:
+        """
+        find the files under root ending with one of suffixes that still need sorting. Folders are only listed when
+        their mtime changed since the last scan (adding or removing a file changes it), otherwise their files and
+        subfolders come from the index, so a rescan of an unchanged tree is one stat per folder
+
+        Parameters
+        ----------
+        root: str
+            the input folder
+        suffixes: tuple
+            file name endings to index, eg ('.dcm', 'dicom.zip')
+
+        Returns
+        -------
+        a sorted list of paths that are new, changed or not yet sorted (files that failed are only listed again once
+        they change)
+        """
+        root = os.path.normpath(root)
+        known_folders = {row['path']: (row['mtime_ns'], row['subfolders'])
+                         for row in self._execute('SELECT path, mtime_ns, subfolders FROM folders')}
+        known_files = self.file_states(root)
+        unsorted_by_folder = {}
+        for path, (_, _, sorted_ns) in known_files.items():
+            if sorted_ns is None:
+                unsorted_by_folder.setdefault(os.path.dirname(path), []).append(path)
+        new_files = []
+        vanished_files = []
+        folder_rows = []
+
+        folders = [root]
+        while len(folders) > 0:
+            folder = folders.pop()
+            try:
+                mtime_ns = os.stat(folder).st_mtime_ns
+            except OSError:
+                continue
+            known = known_folders.get(folder)
+            if known is not None and known[0] == mtime_ns:
+                folders.extend(subfolder for subfolder in known[1].split('\n') if subfolder != '')
+                continue
+
+            subfolders = []
+            present = set()
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subfolders.append(entry.path)
+                    elif entry.name.endswith(suffixes):
+                        present.add(entry.path)
+                        stat = entry.stat()
+                        state = known_files.get(entry.path)
+                        if state is None or state[0] != stat.st_size or state[1] != stat.st_mtime_ns:
+                            new_files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+            # files that went away before they were sorted
+            vanished_files.extend(path for path in unsorted_by_folder.get(folder, []) if path not in present)
+            folders.extend(subfolders)
+            folder_rows.append((folder, mtime_ns, '\n'.join(subfolders)))
+
+        # files that failed are few, stat them every time: rewriting a file in place doesn't change its folder's mtime
+        for path in self.failed_files(root):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            state = known_files[path]
+            if state[0] != stat.st_size or state[1] != stat.st_mtime_ns:
+                new_files.append((path, stat.st_size, stat.st_mtime_ns))
+
+        self.record_files(new_files)
+        self.forget_files(vanished_files)
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO folders (path, mtime_ns, subfolders) VALUES (?, ?, ?)',
+                                        folder_rows)
+        return self.unsorted_files(root)
+
+    # series
+
+    def series(self, patient_id: str = None, study_instance_uid: str = None, converted: bool = None,
+               moved: bool = None) -> list:
+        """
+        sorted series folders, filtered by patient, study and stage
+
+        Parameters
+        ----------
+        patient_id: str, optional, default None
+            only this patient's series
+        study_instance_uid: str, optional, default None
+            only this study's series
+        converted: bool, optional, default None
+            True for series converted since they were last sorted into, False for ones that are not (including ones
+            filtered out of conversion)
+        moved: bool, optional, default None
+            True for series uploaded since they last changed, False for ones that are not
+
+        Returns
+        -------
+        a list of dicts with the series table columns, ordered by folder
+        """
+        clauses = []
+        parameters = []
+        if patient_id is not None:
+            clauses.append('patient_id = ?')
+            parameters.append(patient_id)
+        if study_instance_uid is not None:
+            clauses.append('study_instance_uid = ?')
+            parameters.append(study_instance_uid)
+        if converted is not None:
+            clauses.append(('' if converted else 'NOT ') + 'coalesce(selected = 1 AND converted_ns >= sorted_ns, 0)')
+        if moved is not None:
+            clauses.append(('' if moved else 'NOT ') +
+                           'coalesce(moved_ns >= max(sorted_ns, coalesce(converted_ns, 0)), 0)')
+        where = f' WHERE {" AND ".join(clauses)}' if len(clauses) > 0 else ''
+        return [dict(row) for row in self._execute(f'SELECT * FROM series{where} ORDER BY series_dir', parameters)]
+
+    def series_folder(self, series_dir: str):
+        rows = self._execute('SELECT * FROM series WHERE series_dir = ?', (series_dir,))
+        return dict(rows[0]) if len(rows) > 0 else None
+
+    def pending_conversion(self) -> list:
+        """
+        series folders sorted into since they were last converted or checked against the conversion filter
+
+        Returns
+        -------
+        a list of folder paths
+        """
+        rows = self._execute('SELECT series_dir FROM series WHERE selected IS NULL OR sorted_ns > converted_ns '
+                             'ORDER BY series_dir')
+        return [row['series_dir'] for row in rows]
+
+    def record_converted(self, series_dir: str, converted_path: str = None, selected: bool = True,
+                         converted_ns: int = None):
+        """
+        record a series folder as converted, or as passed over by the conversion filter
+
+        Parameters
+        ----------
+        series_dir: str
+            the sorted series folder
+        converted_path: str, optional, default None
+            the converted file
+        selected: bool=True
+            False when the filter passed over the series
+        converted_ns: int, optional, default None
+            when the conversion started, defaults to now. Files sorted into the series after it are still pending
+        """
+        converted_ns = time.time_ns() if converted_ns is None else converted_ns
+        self._execute('UPDATE series SET converted_ns = ?, converted_path = ?, selected = ? WHERE series_dir = ?',
+                      (converted_ns, converted_path, int(selected), series_dir))
+
+    def record_moved(self, series_dir: str):
+        self._execute('UPDATE series SET moved_ns = ? WHERE series_dir = ?', (time.time_ns(), series_dir))
@@ -1,12 +1,12 @@
 import glob
 import matplotlib.pyplot as plt
 import numpy as np
-import pydicom
 import SimpleITK as sitk
-import tempfile
-from zipfile import ZipFile
 
 from radlib.dcm.converters import pet_suv_factor
+from radlib.dcm.readers import read_dicom_files, scan_dicom_headers, group_dicom_series, ZipDicomArchive, \
+    sitk_image_from_datasets
+from radlib.dcm.volume_cache import sitk_image_from_cache
 
 
 # load the DICOM files
@@ -16,29 +16,178 @@ def debug_print(message, debug_flag):
     if debug_flag:
         print(message)
 
-def load_dicom_series_pydicom(dicom_root, debug=False, pet_suv = False):
+def load_dicom_series_pydicom(dicom_root, debug=False, pet_suv = False, workers=None, policy='io', cache=None):
     # TODO: csk add support for multiple series in one folder
-    files = []
     if not '*' in dicom_root:
         dicom_root = f'{dicom_root}/*'
     debug_print(f"glob: {dicom_root}", debug)
-    for fname in glob.glob(dicom_root, recursive=False):
-        debug_print(f"loading: {fname}", debug)
-        files.append(pydicom.dcmread(fname))
+    # phase one: headers only, so scouts etc are dropped before any pixel data is read
+    headers = scan_dicom_headers(glob.glob(dicom_root, recursive=False), workers=workers)
 
-    debug_print(f"file count: {len(files)}", debug)
+    debug_print(f"file count: {len(headers)}", debug)
 
     # skip files with no SliceLocation (eg scout views)
-    slices = []
-    skipcount = 0
-    for f in files:
-        if hasattr(f, "SliceLocation"):
-            slices.append(f)
-        else:
-            skipcount = skipcount + 1
+    paths = [header.filename for header in headers if hasattr(header, "SliceLocation")]
+    debug_print(f"skipped, no SliceLocation: {len(headers) - len(paths)}", debug)
 
-    debug_print(f"skipped, no SliceLocation: {skipcount}", debug)
-    return load_dicom_series_from_slices(slices, pet_suv)
+    # decoded volumes can come from a volume_cache.VolumeCache, the slices returned are then header only
+    if cache is not None and len(paths) > 0:
+        key = cache.key(paths, headers[0].get('SeriesInstanceUID'), f'pydicom|{pet_suv}')
+        cached = cache.get(key)
+        if cached is not None:
+            debug_print(f"volume cache hit: {key}", debug)
+            kept = sorted([h for h in headers if hasattr(h, "SliceLocation")], key=lambda s: s.SliceLocation)
+            return cached[0], cached[1], kept
+
+    # phase two: read the kept files concurrently, see readers.read_dicom_files for workers/policy
+    slices = read_dicom_files(paths, workers=workers, policy=policy)
+    img3d, metadata, slices = load_dicom_series_from_slices(slices, pet_suv)
+    if cache is not None:
+        img3d, metadata = cache.put(key, img3d, metadata)
+    return img3d, metadata, slices
+
+
+class LazyDicomVolume:
+    """
+    a DICOM series as a (rows, cols, slices) volume that only decodes the slices it is indexed with
+
+    built from header-only datasets (see readers.scan_dicom_headers), so shape, metadata and slice positions are
+    available without touching pixel data. Indexing reads the files of the selected slices concurrently and returns
+    a regular numpy array, rescaled (and SUV-scaled for PET if asked) the same way as load_dicom_series_from_slices
+    """
+    def __init__(self, headers, rescale=True, pet_suv=False, dtype=np.float32, workers=None, policy='io'):
+        """
+        Parameters
+        ----------
+        headers: list
+            header-only (or full) pydicom Datasets of one series, already in slice order, each with filename set
+        rescale: bool=True
+            apply RescaleSlope/RescaleIntercept
+        pet_suv: bool=False
+            scale PET slices to SUV, see converters.pet_suv_factor
+        dtype: numpy dtype=np.float32
+            dtype of the returned pixel data
+        workers: int, optional, default None
+            threads reading files, see readers.read_dicom_files
+        policy: str='io'
+            read policy, see readers.read_policies
+        """
+        if len(headers) == 0:
+            raise ValueError('LazyDicomVolume needs at least one slice')
+        self.headers = list(headers)
+        self.paths = [header.filename for header in self.headers]
+        self.rescale = rescale
+        self.pet_suv = pet_suv
+        self.dtype = np.dtype(dtype)
+        self.workers = workers
+        self.policy = policy
+
+        first = self.headers[0]
+        self.shape = (int(first.Rows), int(first.Columns), len(self.headers))
+        self.slopes = np.array([float(h.get('RescaleSlope', 1) if rescale else 1) for h in self.headers])
+        self.intercepts = np.array([float(h.get('RescaleIntercept', 0) if rescale else 0) for h in self.headers])
+        if pet_suv and first.get('Modality') == 'PT':
+            self.slopes = self.slopes * pet_suv_factor(first)
+
+    def __len__(self):
+        return self.shape[2]
+
+    @property
+    def metadata(self):
+        # same keys as load_dicom_series_from_slices, from the headers only
+        first = self.headers[0]
+        return {'spacing': np.array([first.PixelSpacing[0], first.PixelSpacing[1], first.SliceThickness]),
+                'origin': np.array(first.ImagePositionPatient),
+                'direction': np.array(first.ImageOrientationPatient),
+                'size': np.array(self.shape)}
+
+    def read_slices(self, indices):
+        """
+        decode the given slices
+
+        Parameters
+        ----------
+        indices: list
+            slice indices, in the order wanted
+
+        Returns
+        -------
+        a (rows, cols, len(indices)) array of self.dtype
+        """
+        indices = list(indices)
+        slab = np.empty((self.shape[0], self.shape[1], len(indices)), dtype=self.dtype)
+        if len(indices) == 0:
+            return slab
+        datasets = read_dicom_files([self.paths[i] for i in indices], workers=self.workers, policy=self.policy)
+        for n, ds in enumerate(datasets):
+            slab[:, :, n] = ds.pixel_array
+        slab *= self.slopes[indices].astype(self.dtype)
+        slab += self.intercepts[indices].astype(self.dtype)
+        return slab
+
+    def slab(self, start, stop):
+        # contiguous run of slices [start, stop)
+        return self.read_slices(range(start, stop))
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        # identity checks, `in`/`index` compare with == which is ambiguous for array indices
+        ellipses = [i for i, k in enumerate(key) if k is Ellipsis]
+        if ellipses:
+            e = ellipses[0]
+            key = key[:e] + (slice(None),) * (3 - len(key) + 1) + key[e + 1:]
+        key = key + (slice(None),) * (3 - len(key))
+        if len(key) != 3:
+            raise IndexError(f'too many indices for a 3D volume: {len(key)}')
+
+        # only the third (slice) index decides what gets read
+        z = key[2]
+        if isinstance(z, (int, np.integer)):
+            return self.read_slices([range(self.shape[2])[z]])[:, :, 0][key[0], key[1]]
+        indices = np.arange(self.shape[2])[z]
+        return self.read_slices(indices)[key[0], key[1], :]
+
+    def __array__(self, dtype=None, copy=None):
+        volume = self.slab(0, self.shape[2])
+        return volume if dtype is None else volume.astype(dtype)
+
+
+def load_dicom_series_lazy(dicom_root, debug=False, pet_suv=False, sort_by='SliceLocation', workers=None,
+                           policy='io'):
+    """
+    two-phase series load: scan headers only, filter, group by series and order, then return lazy volumes that
+    decode pixel data only when indexed
+
+    Parameters
+    ----------
+    dicom_root: str
+        a folder or glob of DICOM files
+    debug: bool=False
+        print progress
+    pet_suv: bool=False
+        scale PET volumes to SUV
+    sort_by: str='SliceLocation'
+        slice ordering, see readers.slice_position. Slices without the tag (eg scout views) are skipped
+    workers: int, optional, default None
+        threads reading files, see readers.read_dicom_files
+    policy: str='io'
+        read policy for the pixel phase, see readers.read_policies
+
+    Returns
+    -------
+    a dict of SeriesInstanceUID to LazyDicomVolume
+    """
+    if not '*' in dicom_root:
+        dicom_root = f'{dicom_root}/*'
+    debug_print(f"glob: {dicom_root}", debug)
+    headers = scan_dicom_headers(glob.glob(dicom_root, recursive=False), workers=workers)
+    debug_print(f"file count: {len(headers)}", debug)
+
+    series = group_dicom_series(headers, sort_by=sort_by)
+    debug_print(f"series: {len(series)}, skipped: {len(headers) - sum(len(s) for s in series.values())}", debug)
+    return {uid: LazyDicomVolume(slices, pet_suv=pet_suv, workers=workers, policy=policy)
+            for uid, slices in series.items()}
 
 
 def load_dicom_series_from_slices(slices, pet_suv = False):
@@ -76,41 +225,46 @@ def load_dicom_series_from_slices(slices, pet_suv = False):
               'size': np.array(img_shape)}
     return img3d, metadata, slices
 
-def load_dicom_series_sitk(dicom_root, debug=False):
+def load_dicom_series_sitk(dicom_root, debug=False, cache=None):
     reader = sitk.ImageSeriesReader()
     dicom_paths = reader.GetGDCMSeriesFileNames(dicom_root)
+
+    # decoded volumes can come from a volume_cache.VolumeCache
+    if cache is not None and len(dicom_paths) > 0:
+        key = cache.key(dicom_paths, variant='sitk')
+        cached = cache.get(key)
+        if cached is not None:
+            debug_print(f"volume cache hit: {key}", debug)
+            return sitk_image_from_cache(*cached), np.transpose(cached[0], (1, 2, 0)), cached[1]
+
     reader.SetFileNames(dicom_paths)
     image_sitk = reader.Execute()
 
     # TODO: this is mainly for comparisons
     img3d = sitk.GetArrayFromImage(image_sitk)
-    img3d = np.transpose(img3d, (1, 2, 0))
     metadata={'spacing': image_sitk.GetSpacing(),
               'origin': image_sitk.GetOrigin(),
               'direction': image_sitk.GetDirection(),
               'size': image_sitk.GetSize()}
+    if cache is not None and len(dicom_paths) > 0:
+        img3d, metadata = cache.put(key, img3d, metadata)
+    img3d = np.transpose(img3d, (1, 2, 0))
 
     return image_sitk, img3d, metadata
 
 
 def load_dicom_zip_sitk(zip_path, debug=False):
-    zipdir = tempfile.gettempdir()
-    with ZipFile(zip_path) as zip:
-        zipdir = tempfile.TemporaryDirectory()
-        with zipdir as tempdir:
-            zip.extractall(tempdir)
-            dcm_paths = glob.glob(f'{tempdir}/*/dicom/*.dcm')
-            reader = sitk.ImageSeriesReader()
-            reader.SetFileNames(dcm_paths)
-            image_sitk = reader.Execute()
-
-        # TODO: this is mainly for comparisons
-        img3d = sitk.GetArrayFromImage(image_sitk)
-        img3d = np.transpose(img3d, (1, 2, 0))
-        metadata={'spacing': image_sitk.GetSpacing(),
-                  'origin': image_sitk.GetOrigin(),
-                  'direction': image_sitk.GetDirection(),
-                  'size': image_sitk.GetSize()}
+    # slices are read straight from the archive, see readers.ZipDicomArchive
+    with ZipDicomArchive(zip_path) as archive:
+        image_sitk = sitk_image_from_datasets(archive.read_datasets(archive.members('*/dicom/*.dcm')))
+
+    # TODO: this is mainly for comparisons
+    img3d = sitk.GetArrayFromImage(image_sitk)
+    img3d = np.transpose(img3d, (1, 2, 0))
+    metadata={'spacing': image_sitk.GetSpacing(),
+              'origin': image_sitk.GetOrigin(),
+              'direction': image_sitk.GetDirection(),
+              'size': image_sitk.GetSize()}
 
     return image_sitk, img3d, metadata
 
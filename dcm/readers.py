@@ -0,0 +1,559 @@
+import fnmatch
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from io import BytesIO
+from zipfile import ZipFile
+
+import numpy as np
+import pydicom
+import SimpleITK as sitk
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where place_dicom_file never reflinks
+    fcntl = None
+
+# read policies for read_dicom_files:
+#   io: everything happens in the thread pool, pixel data stays encoded until it is used (best when latency bound,
+#       eg network shares)
+#   cpu: files are still fetched by the thread pool, but compressed transfer syntaxes are decoded up front in a
+#       process pool so decoding runs on every core
+read_policies = ['io', 'cpu']
+
+# members of a zip archive are addressed as "<archive path>::<member name>" so they can be passed around (and read
+# by everything in this module) like file paths, without extracting the archive
+zip_member_separator = '::'
+
+
+def default_read_workers() -> int:
+    """
+    number of threads to fetch files with, reading is latency bound so use more threads than cores
+
+    Returns
+    -------
+    thread count
+    """
+    return min(32, (os.cpu_count() or 1) + 4)
+
+
+def zip_member_path(zip_path: str, member: str) -> str:
+    return f'{zip_path}{zip_member_separator}{member}'
+
+
+def split_zip_member_path(path: str) -> tuple:
+    """
+    split a zip member path into archive path and member name
+
+    Parameters
+    ----------
+    path: str
+        a file path, or a "<archive path>::<member name>" zip member path
+
+    Returns
+    -------
+    (archive path, member name), or (path, None) for a plain file path
+    """
+    if zip_member_separator not in path:
+        return path, None
+    zip_path, member = path.split(zip_member_separator, 1)
+    return zip_path, member
+
+
+def is_zip_member_path(path: str) -> bool:
+    return split_zip_member_path(path)[1] is not None
+
+
+_open_zips = OrderedDict()
+_open_zips_lock = threading.Lock()
+open_zips_max = 8
+
+
+def _open_zip(zip_path: str, size: int, mtime_ns: int) -> ZipFile:
+    # archives opened for zip member paths stay open (keyed by size/mtime so changed archives are reopened), ZipFile
+    # serializes reads of its shared file handle so these can be used from the read threads. evicted archives are closed,
+    # members already opened from them keep the file open until they are closed themselves
+    key = (zip_path, size, mtime_ns)
+    with _open_zips_lock:
+        if key in _open_zips:
+            _open_zips.move_to_end(key)
+            return _open_zips[key]
+        archive = ZipFile(zip_path)
+        _open_zips[key] = archive
+        while len(_open_zips) > open_zips_max:
+            _open_zips.popitem(last=False)[1].close()
+        return archive
+
+
+def open_zip(zip_path: str) -> ZipFile:
+    stat = os.stat(zip_path)
+    return _open_zip(os.path.abspath(zip_path), stat.st_size, stat.st_mtime_ns)
+
+
+def close_zips():
+    # close every archive held open for zip member paths
+    with _open_zips_lock:
+        while _open_zips:
+            _open_zips.popitem()[1].close()
+
+
+def read_dicom_bytes(path: str) -> bytes:
+    zip_path, member = split_zip_member_path(path)
+    if member is not None:
+        return open_zip(zip_path).read(member)
+    with open(path, 'rb') as dicom_file:
+        return dicom_file.read()
+
+
+def read_dicom_file(path: str, stop_before_pixels: bool = False) -> pydicom.Dataset:
+    """
+    pydicom.dcmread for a file path or a zip member path (see zip_member_path), the member is streamed straight from
+    the archive
+
+    Parameters
+    ----------
+    path: str
+        the file or zip member path
+    stop_before_pixels: bool=False
+        only read the header
+
+    Returns
+    -------
+    a pydicom Dataset with filename set to path
+    """
+    zip_path, member = split_zip_member_path(path)
+    if member is None:
+        return pydicom.dcmread(path, stop_before_pixels=stop_before_pixels)
+    with open_zip(zip_path).open(member) as member_file:
+        ds = pydicom.dcmread(BytesIO(member_file.read()), stop_before_pixels=stop_before_pixels)
+    ds.filename = path
+    return ds
+
+
+def copy_dicom_file(path: str, destination: str):
+    """
+    shutil.copy for a file path or a zip member path, members are written straight from the archive
+
+    Parameters
+    ----------
+    path: str
+        the file or zip member path
+    destination: str
+        the file path to write
+    """
+    zip_path, member = split_zip_member_path(path)
+    if member is None:
+        shutil.copy(path, destination)
+        return
+    with open_zip(zip_path).open(member) as member_file, open(destination, 'wb') as destination_file:
+        shutil.copyfileobj(member_file, destination_file)
+
+
+# ways place_dicom_file can put a file in its sorted location, "auto" tries them in order
+place_methods = ['auto', 'reflink', 'hardlink', 'copy']
+
+# Linux FICLONE ioctl, a copy-on-write clone of a whole file on filesystems that support it (btrfs, xfs, ...)
+_ficlone = 0x40049409
+
+
+def _reflink_file(path: str, destination: str):
+    if fcntl is None:
+        raise OSError('reflinks are not supported on this platform')
+    with open(path, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), _ficlone, source_file.fileno())
+            return
+        except OSError:
+            pass
+    os.remove(destination)
+    raise OSError(f'cannot reflink {path} to {destination}')
+
+
+def place_dicom_file(path: str, destination: str, method: str = 'auto') -> str:
+    """
+    put a copy of a file (or zip member) at destination as cheaply as possible: a reflink (copy-on-write clone) or a
+    hardlink when source and destination are on the same filesystem, a real copy otherwise. Zip members are always
+    written out from the archive. An existing destination is replaced
+
+    Parameters
+    ----------
+    path: str
+        the file or zip member path
+    destination: str
+        the file path to create, its folder must exist
+    method: str='auto'
+        one of place_methods, "auto" tries reflink, then hardlink, then copy
+
+    Returns
+    -------
+    the method used
+    """
+    if method not in place_methods:
+        raise ValueError(f'unknown method {method}, use one of {place_methods}')
+    if os.path.lexists(destination):
+        os.remove(destination)
+    if method == 'copy' or is_zip_member_path(path):
+        copy_dicom_file(path, destination)
+        return 'copy'
+
+    if method == 'auto' and os.stat(path).st_dev != os.stat(os.path.dirname(destination) or '.').st_dev:
+        shutil.copy(path, destination)
+        return 'copy'
+
+    if method in ['auto', 'reflink']:
+        try:
+            _reflink_file(path, destination)
+            return 'reflink'
+        except OSError:
+            if method == 'reflink':
+                raise
+    if method in ['auto', 'hardlink']:
+        try:
+            os.link(path, destination)
+            return 'hardlink'
+        except OSError:
+            if method == 'hardlink':
+                raise
+    shutil.copy(path, destination)
+    return 'copy'
+
+
+def _decode_dicom_bytes(raw: bytes) -> pydicom.Dataset:
+    # module level so it can run in a process pool: parse and decompress the pixel data of one file
+    ds = pydicom.dcmread(BytesIO(raw))
+    ds.decompress()
+    return ds
+
+
+def read_dicom_files(paths: list,
+                     stop_before_pixels: bool = False,
+                     workers: int = None,
+                     policy: str = 'io',
+                     decode_workers: int = None) -> list:
+    """
+    read a list of DICOM files concurrently with pydicom
+
+    Parameters
+    ----------
+    paths: list
+        the file paths to read
+    stop_before_pixels: bool=False
+        only read the headers, as pydicom.dcmread
+    workers: int, optional, default None
+        number of threads fetching files, defaults to default_read_workers()
+    policy: str='io'
+        "io" or "cpu", see read_policies. Ignored when stop_before_pixels
+    decode_workers: int, optional, default None
+        number of processes decoding compressed pixel data for the "cpu" policy, defaults to the number of cores
+
+    Returns
+    -------
+    a list of pydicom Datasets in the same order as paths, each with filename set to its path. Paths can be zip member
+    paths, see zip_member_path
+    """
+    if policy not in read_policies:
+        raise ValueError(f'unknown read policy {policy}, use one of {read_policies}')
+
+    workers = default_read_workers() if workers is None else workers
+
+    if stop_before_pixels or policy == 'io':
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda path: read_dicom_file(path, stop_before_pixels=stop_before_pixels),
+                                     paths))
+
+    # cpu policy: fetch raw bytes with threads, parse headers as they arrive and send compressed files to the
+    # process pool, uncompressed files don't need any decoding
+    datasets = [None] * len(paths)
+    with ThreadPoolExecutor(max_workers=workers) as io_executor, \
+            ProcessPoolExecutor(max_workers=decode_workers) as decode_executor:
+        decoding = {}
+        for index, raw in enumerate(io_executor.map(read_dicom_bytes, paths)):
+            ds = pydicom.dcmread(BytesIO(raw))
+            transfer_syntax = ds.file_meta.get('TransferSyntaxUID') if hasattr(ds, 'file_meta') else None
+            if transfer_syntax is not None and transfer_syntax.is_compressed and 'PixelData' in ds:
+                decoding[index] = decode_executor.submit(_decode_dicom_bytes, raw)
+            else:
+                datasets[index] = ds
+
+        for index, future in decoding.items():
+            datasets[index] = future.result()
+
+    for path, ds in zip(paths, datasets):
+        ds.filename = path
+
+    return datasets
+
+
+def _read_dicom_header(path: str):
+    # header only read, None for files that aren't DICOM
+    try:
+        return read_dicom_file(path, stop_before_pixels=True)
+    except pydicom.errors.InvalidDicomError:
+        return None
+
+
+def scan_dicom_headers(paths: list, workers: int = None, skip_invalid: bool = True) -> list:
+    """
+    first phase of a two-phase series load: read only the headers (stop_before_pixels) of a list of files,
+    concurrently, so filtering, grouping and ordering never touch pixel data
+
+    Parameters
+    ----------
+    paths: list
+        the file (or zip member) paths to scan
+    workers: int, optional, default None
+        number of threads reading headers, defaults to default_read_workers()
+    skip_invalid: bool=True
+        leave out files that are not DICOM rather than raising
+
+    Returns
+    -------
+    a list of header-only pydicom Datasets, in the same order as paths, each with filename set to its path
+    """
+    workers = default_read_workers() if workers is None else workers
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if not skip_invalid:
+            return list(executor.map(lambda path: read_dicom_file(path, stop_before_pixels=True), paths))
+        return [header for header in executor.map(_read_dicom_header, paths) if header is not None]
+
+
+def slice_position(ds: pydicom.Dataset, sort_by: str = 'ImagePositionPatient') -> float:
+    """
+    the position used to order a slice in its series
+
+    Parameters
+    ----------
+    ds: pydicom.Dataset
+        the slice (header)
+    sort_by: str='ImagePositionPatient'
+        'ImagePositionPatient' for the z of ImagePositionPatient, 'SliceLocation' for SliceLocation
+
+    Returns
+    -------
+    the slice position as a float
+    """
+    if sort_by == 'SliceLocation':
+        return float(ds.SliceLocation)
+    return float(ds.ImagePositionPatient[2])
+
+
+def sort_dicom_slices(headers: list, sort_by: str = 'ImagePositionPatient') -> list:
+    """
+    order slices of a series, see slice_position
+
+    Parameters
+    ----------
+    headers: list
+        pydicom Datasets (headers or full) of one series
+    sort_by: str='ImagePositionPatient'
+        'ImagePositionPatient' or 'SliceLocation'
+
+    Returns
+    -------
+    a new, sorted list
+    """
+    return sorted(headers, key=lambda ds: slice_position(ds, sort_by))
+
+
+def group_dicom_series(headers: list, sort_by: str = 'ImagePositionPatient', require: list = None) -> dict:
+    """
+    group slice headers by SeriesInstanceUID and order each series
+
+    Parameters
+    ----------
+    headers: list
+        pydicom Datasets (headers or full)
+    sort_by: str='ImagePositionPatient'
+        'ImagePositionPatient' or 'SliceLocation', see slice_position
+    require: list, optional, default None
+        tag names a slice must have to be kept, eg ['SliceLocation'] to drop scout views. The sort_by tag is always
+        required
+
+    Returns
+    -------
+    a dict of SeriesInstanceUID to sorted lists of headers, in the order the series were first seen
+    """
+    require = [sort_by] if require is None else list(require) + [sort_by]
+    series = {}
+    for header in headers:
+        if not all(hasattr(header, tag) for tag in require):
+            continue
+        series.setdefault(header.get('SeriesInstanceUID'), []).append(header)
+    return {uid: sort_dicom_slices(slices, sort_by) for uid, slices in series.items()}
+
+
+class ZipDicomArchive:
+    """
+    Random access to the DICOM members of a zip archive (eg a .dicom.zip) without extracting it: members are read
+    by name straight into pydicom, so a study is never written to and read back from temp disk. Datasets read
+    through the archive have filename set to their zip member path, which works with read_dicom_files,
+    scan_dicom_headers and copy_dicom_file
+
+    """
+    def __init__(self, zip_path: str):
+        self.zip_path = zip_path
+        self.zip_file = ZipFile(zip_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.zip_file.close()
+
+    def members(self, pattern: str = '*.dcm') -> list:
+        """
+        member names matching a pattern
+
+        Parameters
+        ----------
+        pattern: str='*.dcm'
+            fnmatch pattern for the full member name, "*" also matches "/" so the default finds .dcm files in any
+            folder of the archive
+
+        Returns
+        -------
+        a list of member names in archive order, folders left out
+        """
+        return [info.filename for info in self.zip_file.infolist()
+                if not info.is_dir() and fnmatch.fnmatch(info.filename, pattern)]
+
+    def paths(self, pattern: str = '*.dcm') -> list:
+        # zip member paths for members(pattern)
+        return [zip_member_path(self.zip_path, member) for member in self.members(pattern)]
+
+    def read_bytes(self, member: str) -> bytes:
+        return self.zip_file.read(member)
+
+    def read(self, member: str, stop_before_pixels: bool = False) -> pydicom.Dataset:
+        """
+        read one member with pydicom
+
+        Parameters
+        ----------
+        member: str
+            the member name
+        stop_before_pixels: bool=False
+            only read the header
+
+        Returns
+        -------
+        a pydicom Dataset with filename set to the member's zip member path
+        """
+        with self.zip_file.open(member) as member_file:
+            ds = pydicom.dcmread(BytesIO(member_file.read()), stop_before_pixels=stop_before_pixels)
+        ds.filename = zip_member_path(self.zip_path, member)
+        return ds
+
+    def read_datasets(self, members: list = None, stop_before_pixels: bool = False, workers: int = None) -> list:
+        """
+        read members concurrently
+
+        Parameters
+        ----------
+        members: list, optional, default None
+            member names, defaults to members()
+        stop_before_pixels: bool=False
+            only read the headers
+        workers: int, optional, default None
+            number of threads, defaults to default_read_workers()
+
+        Returns
+        -------
+        a list of pydicom Datasets in the same order as members
+        """
+        members = self.members() if members is None else members
+        workers = default_read_workers() if workers is None else workers
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda member: self.read(member, stop_before_pixels=stop_before_pixels),
+                                     members))
+
+    def scan_headers(self, members: list = None, workers: int = None, skip_invalid: bool = True) -> list:
+        """
+        header-only scan of the members, as scan_dicom_headers
+
+        Parameters
+        ----------
+        members: list, optional, default None
+            member names, defaults to members()
+        workers: int, optional, default None
+            number of threads, defaults to default_read_workers()
+        skip_invalid: bool=True
+            leave out members that are not DICOM rather than raising
+
+        Returns
+        -------
+        a list of header-only pydicom Datasets
+        """
+        members = self.members() if members is None else members
+        workers = default_read_workers() if workers is None else workers
+
+        def read_header(member):
+            try:
+                return self.read(member, stop_before_pixels=True)
+            except pydicom.errors.InvalidDicomError:
+                if not skip_invalid:
+                    raise
+                return None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return [header for header in executor.map(read_header, members) if header is not None]
+
+
+def sitk_image_from_datasets(datasets: list) -> sitk.Image:
+    """
+    build an sitk Image from the in-memory slices of one series, the SimpleITK path for series read from zip archives
+    (or anywhere else sitk.ReadImage can't get at). Slices are ordered along the slice normal, geometry comes from
+    ImagePositionPatient/ImageOrientationPatient/PixelSpacing and RescaleSlope/RescaleIntercept are applied. Pixels
+    stay integer (int16, or int32 if needed) when the rescale is integral, like the sitk/GDCM reader, float32 otherwise
+
+    Parameters
+    ----------
+    datasets: list
+        pydicom Datasets with pixel data, all from one series
+
+    Returns
+    -------
+    an sitk Image
+    """
+    first = datasets[0]
+    orientation = np.array(first.ImageOrientationPatient, dtype=np.float64)
+    row_direction, column_direction = orientation[:3], orientation[3:]
+    normal = np.cross(row_direction, column_direction)
+    positions = np.array([np.array(ds.ImagePositionPatient, dtype=np.float64) for ds in datasets])
+    order = np.argsort(positions @ normal, kind='stable')
+    datasets = [datasets[i] for i in order]
+    positions = positions[order]
+
+    slopes = np.array([float(ds.get('RescaleSlope', 1)) for ds in datasets])
+    intercepts = np.array([float(ds.get('RescaleIntercept', 0)) for ds in datasets])
+    integral = np.all(slopes == np.round(slopes)) and np.all(intercepts == np.round(intercepts))
+
+    volume = np.empty((len(datasets), int(first.Rows), int(first.Columns)),
+                      dtype=np.int32 if integral else np.float32)
+    for i, ds in enumerate(datasets):
+        volume[i] = ds.pixel_array
+    if integral:
+        volume *= slopes.astype(np.int32)[:, None, None]
+        volume += intercepts.astype(np.int32)[:, None, None]
+        if volume.min(initial=0) >= np.iinfo(np.int16).min and volume.max(initial=0) <= np.iinfo(np.int16).max:
+            volume = volume.astype(np.int16)
+    else:
+        volume *= slopes.astype(np.float32)[:, None, None]
+        volume += intercepts.astype(np.float32)[:, None, None]
+
+    # slice spacing from the positions, SliceThickness for single slices
+    if len(datasets) > 1:
+        slice_spacing = float((positions[-1] - positions[0]) @ normal) / (len(datasets) - 1)
+    else:
+        slice_spacing = float(first.get('SliceThickness', 1.0))
+
+    image = sitk.GetImageFromArray(volume)
+    image.SetOrigin([float(v) for v in positions[0]])
+    image.SetSpacing([float(first.PixelSpacing[1]), float(first.PixelSpacing[0]), slice_spacing])
+    image.SetDirection([float(v) for v in np.column_stack([row_direction, column_direction, normal]).ravel()])
+    return image
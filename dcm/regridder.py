@@ -1,34 +1,118 @@
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from typing import Union
 
 import numpy as np
 import SimpleITK as sitk
 
-def generate_grid(img: sitk.Image)-> np.ndarray:
+# regridding engines for generate_regridded_volume: "vectorized" maps the whole output grid at once, "reference"
+# is the original per-voxel sitk loop, kept around so results can be compared
+regrid_engines = ['vectorized', 'reference']
+
+# number of output voxels the vectorized engine handles at a time, keeps the temporary index/weight arrays bounded
+regrid_chunk_voxels = 1 << 22
+
+# rough working memory of the vectorized engine per output voxel (points, indices, weights, gathered values), used
+# to size slabs from a memory budget
+regrid_bytes_per_voxel = 256
+
+def generate_grid_slab(img: sitk.Image,
+                       k_start: int = 0,
+                       k_stop: int = None,
+                       dtype=np.float64) -> np.ndarray:
     """
-    given an sitk Image, generate a grid of physical points based on the size/indices of the image
+    given an sitk Image, generate the physical points for a slab of k planes of the image's index space
+
+    Points are computed from the image's origin, spacing and direction in one step,
+    origin + direction * diag(spacing) * index, the same thing TransformIndexToPhysicalPoint does for one index
 
     Parameters
     ----------
     img: sitk.Image
         the image to grid
+    k_start: int=0
+        the first k index of the slab
+    k_stop: int, optional, default None
+        one past the last k index of the slab, if not provided use the full size of the image
+    dtype: default np.float64
+        dtype of the returned points, np.float32 halves the memory of the grid
 
     Returns
     -------
-    a numpy array with x, y, z, 3 dimensions, for every x, y, z in the image's index space (GetSize()), there
-    is a 3-d point in the image's physical space
+    a numpy array with x, y, z, 3 dimensions, for every x, y and k_start <= z < k_stop in the image's index space
+    there is a 3-d point in the image's physical space
+    """
+    size = img.GetSize()
+    k_stop = size[2] if k_stop is None else min(k_stop, size[2])
+    return _physical_grid(image_geometry(img), size, k_start, k_stop, dtype)
+
+
+def _physical_grid(geometry: tuple, size: tuple, k_start: int, k_stop: int, dtype=np.float64) -> np.ndarray:
+    # physical points for k planes of an image grid, from (origin, spacing, direction) so it can run in a worker
+    origin, spacing, direction = geometry
+    index_to_physical = direction * spacing
+
+    # each index axis steps along one column of direction * diag(spacing)
+    grid = np.empty((size[0], size[1], k_stop - k_start, 3), dtype=dtype)
+    grid[...] = origin
+    grid += (np.arange(size[0])[:, None] * index_to_physical[:, 0])[:, None, None, :]
+    grid += (np.arange(size[1])[:, None] * index_to_physical[:, 1])[None, :, None, :]
+    grid += (np.arange(k_start, k_stop)[:, None] * index_to_physical[:, 2])[None, None, :, :]
+    return grid
+
 
+def iterate_grid(img: sitk.Image,
+                 slab_depth: int = None,
+                 dtype=np.float64):
     """
+    lazily generate the grid of physical points of an sitk Image, one slab of k planes at a time, so the full
+    (x, y, z, 3) grid never has to be held in memory
 
-    # use the image's GetSize() to initialize the output grid
-    grid = np.zeros((img.GetSize()[0], img.GetSize()[1],  img.GetSize()[2], 3))
+    Parameters
+    ----------
+    img: sitk.Image
+        the image to grid
+    slab_depth: int, optional, default None
+        number of k planes in each slab, if not provided size the slabs with regrid_chunk_voxels
+    dtype: default np.float64
+        dtype of the generated points
 
-    for kk in range(0, grid.shape[2]):
-        for jj in range(0, grid.shape[1]):
-            for ii in range(0, grid.shape[0]):
-                # for each indexed point in the image, generate the physical point
-                grid[ii, jj, kk] = img.TransformIndexToPhysicalPoint((ii, jj, kk))
+    Returns
+    -------
+    a generator of (k_start, k_stop, slab) tuples, see generate_grid_slab for the slab layout
+    """
+    size = img.GetSize()
+    slab_depth = _slab_depth(size) if slab_depth is None else slab_depth
+    for k_start in range(0, size[2], slab_depth):
+        k_stop = min(k_start + slab_depth, size[2])
+        yield k_start, k_stop, generate_grid_slab(img, k_start, k_stop, dtype)
 
-    return grid
+
+def generate_grid(img: sitk.Image, dtype=np.float64)-> np.ndarray:
+    """
+    given an sitk Image, generate a grid of physical points based on the size/indices of the image
+
+    Parameters
+    ----------
+    img: sitk.Image
+        the image to grid
+    dtype: default np.float64
+        dtype of the grid, np.float32 halves the memory of the grid
+
+    Returns
+    -------
+    a numpy array with x, y, z, 3 dimensions, for every x, y, z in the image's index space (GetSize()), there
+    is a 3-d point in the image's physical space
+
+    Notes
+    -----
+    For large images, use iterate_grid, or pass the image itself as the grid to generate_regridded_volume,
+    rather than building the full grid
+
+    """
+    return generate_grid_slab(img, dtype=dtype)
 
 
 def evaluate_at_continuous_index_wrapper(img:sitk.Image,
@@ -65,10 +149,565 @@ def evaluate_at_continuous_index_wrapper(img:sitk.Image,
     return new_value
 
 
+def image_geometry(img: sitk.Image) -> tuple:
+    """
+    get the geometry of an sitk Image as numpy arrays
+
+    Parameters
+    ----------
+    img: sitk.Image
+        the image to get geometry from
+
+    Returns
+    -------
+    origin (3,), spacing (3,) and direction (3, 3) arrays, in sitk's x, y, z order
+    """
+    origin = np.asarray(img.GetOrigin(), dtype=np.float64)
+    spacing = np.asarray(img.GetSpacing(), dtype=np.float64)
+    direction = np.asarray(img.GetDirection(), dtype=np.float64).reshape(3, 3)
+    return origin, spacing, direction
+
+
+def physical_to_continuous_index(points: np.ndarray,
+                                 origin: np.ndarray,
+                                 spacing: np.ndarray,
+                                 direction: np.ndarray) -> np.ndarray:
+    """
+    batched version of sitk TransformPhysicalPointToContinuousIndex
+
+    Parameters
+    ----------
+    points: np.ndarray
+        physical points with (x, y, z) in the last dimension, any leading shape
+    origin: np.ndarray
+        the image origin
+    spacing: np.ndarray
+        the image spacing
+    direction: np.ndarray
+        the image direction as a 3x3 matrix
+
+    Returns
+    -------
+    an array the same shape as points, with continuous (i, j, k) indices in the last dimension
+    """
+    # sitk: physical = origin + direction * diag(spacing) * index, so invert that affine
+    physical_to_index = np.linalg.inv(direction * spacing)
+    return (points - origin) @ physical_to_index.T
+
+
+def interpolate_at_continuous_indices(volume: np.ndarray,
+                                      indices: np.ndarray,
+                                      default_value: float = 0,
+                                      mode=sitk.sitkLinear,
+                                      size: np.ndarray = None,
+                                      offset: np.ndarray = None) -> np.ndarray:
+    """
+    batched version of evaluate_at_continuous_index_wrapper, evaluate a volume at many continuous indices at once
+
+    Parameters
+    ----------
+    volume: np.ndarray
+        the image volume, in sitk.GetArrayFromImage (k, j, i) order
+    indices: np.ndarray
+        continuous (i, j, k) indices in the last dimension, any leading shape
+    default_value: float=0
+        the value to use for indices outside of the volume, same as evaluate_at_continuous_index_wrapper
+    mode:
+        the interpolation mode to use, from sitk constants. Possible values are sitk.sitkNearest, sitk.sitkLinear.
+        detaults to sitk.sitkLinear
+    size: np.ndarray, optional, default None
+        (i, j, k) size of the full image when volume is only a block of it, defaults to the size of volume
+    offset: np.ndarray, optional, default None
+        (i, j, k) index of the first voxel of volume within the full image, defaults to 0. The block must cover every
+        voxel the interpolation touches (floor(index) to floor(index) + 1 for linear)
+
+    Returns
+    -------
+    a float64 array of interpolated values, with the leading shape of indices
+    """
+    size = np.asarray(volume.shape[::-1]) if size is None else np.asarray(size)
+    offset = np.zeros(3, dtype=np.int64) if offset is None else np.asarray(offset)
+    flat_indices = indices.reshape(-1, 3)
+
+    inside, gather, fraction = interpolation_gather(flat_indices, volume.shape[::-1], mode, size, offset)
+    values = np.full(flat_indices.shape[0], default_value, dtype=np.float64)
+    values[inside] = gather_interpolated_values(volume.reshape(-1), gather, fraction)
+    return values.reshape(indices.shape[:-1])
+
+
+def interpolation_gather(indices: np.ndarray,
+                         block_size: np.ndarray,
+                         mode=sitk.sitkLinear,
+                         size: np.ndarray = None,
+                         offset: np.ndarray = None) -> tuple:
+    """
+    work out which voxels (and weights) interpolation at a set of continuous indices reads, without reading them.
+    This is the part of interpolate_at_continuous_indices that only depends on geometry, so it can be reused for
+    every image with the same geometry (see RegridPlan)
+
+    Parameters
+    ----------
+    indices: np.ndarray
+        (n, 3) continuous (i, j, k) indices
+    block_size: np.ndarray
+        (i, j, k) size of the volume (or block of it) that will be read from
+    mode:
+        the interpolation mode to use, sitk.sitkNearestNeighbor or sitk.sitkLinear
+    size: np.ndarray, optional, default None
+        (i, j, k) size of the full image, defaults to block_size
+    offset: np.ndarray, optional, default None
+        (i, j, k) index of the first voxel of the block within the full image, defaults to 0
+
+    Returns
+    -------
+    inside: (n,) bool mask of the indices that fall inside the image
+    gather: (m, 1) for nearest or (m, 8) for linear flat indices into the block, for the m inside indices
+    fraction: (m, 3) fractional part of the inside indices for linear, None for nearest
+    """
+    block_size = np.asarray(block_size)
+    size = block_size if size is None else np.asarray(size)
+    offset = np.zeros(3, dtype=np.int64) if offset is None else np.asarray(offset)
+    strides = np.array((1, block_size[0], block_size[0] * block_size[1]))
+
+    # sitk treats anything within half a voxel of the outer voxel centers as inside the image
+    inside = np.all((indices >= -0.5) & (indices <= size - 0.5), axis=1)
+    inside_indices = indices[inside]
+
+    if mode == sitk.sitkNearestNeighbor:
+        # itk rounds half up for the nearest neighbor, nudge exact half voxel ties so round off error in the
+        # index transform doesn't flip them down
+        nearest = np.clip(np.floor(inside_indices + 0.5 + 1e-9).astype(np.int64), 0, size - 1)
+        return inside, ((nearest - offset) @ strides)[:, None], None
+
+    if mode == sitk.sitkLinear:
+        # trilinear interpolation, neighbors past the edge of the volume are clamped back onto it like itk does
+        base = np.floor(inside_indices)
+        fraction = inside_indices - base
+        base = base.astype(np.int64)
+        low = np.clip(base, 0, size - 1) - offset
+        high = np.clip(base + 1, 0, size - 1) - offset
+
+        gather = np.empty((inside_indices.shape[0], 8), dtype=np.int64)
+        for corner in range(8):
+            gather[:, corner] = np.where(_corner_uses_high(corner), high, low) @ strides
+        return inside, gather, fraction
+
+    raise ValueError(f'unsupported interpolation mode {mode}, use sitk.sitkNearestNeighbor or sitk.sitkLinear')
+
+
+def _corner_uses_high(corner: int) -> np.ndarray:
+    # which axes of a trilinear corner (bit 0 = i, bit 1 = j, bit 2 = k) take the upper neighbor
+    return np.array(((corner >> 0) & 1, (corner >> 1) & 1, (corner >> 2) & 1), dtype=bool)
+
+
+def gather_interpolated_values(flat_volume: np.ndarray,
+                               gather: np.ndarray,
+                               fraction: np.ndarray = None) -> np.ndarray:
+    """
+    read interpolated values from a flattened volume with the output of interpolation_gather
+
+    Parameters
+    ----------
+    flat_volume: np.ndarray
+        the volume (or block) flattened in sitk (k, j, i) order
+    gather: np.ndarray
+        (m, 1) or (m, 8) flat indices from interpolation_gather
+    fraction: np.ndarray, optional, default None
+        (m, 3) fractional indices from interpolation_gather, None for nearest
+
+    Returns
+    -------
+    (m,) float64 array of interpolated values
+    """
+    if fraction is None:
+        return flat_volume[gather[:, 0]].astype(np.float64)
+
+    values = np.zeros(gather.shape[0], dtype=np.float64)
+    for corner in range(8):
+        weight = np.prod(np.where(_corner_uses_high(corner), fraction, 1 - fraction), axis=1)
+        values += weight * flat_volume[gather[:, corner]]
+    return values
+
+
+def orthographic_grid_size(img: sitk.Image) -> tuple:
+    """
+    size of the default "orthographic projection" grid that generate_regridded_volume uses when no grid is given
+
+    Parameters
+    ----------
+    img: sitk.Image
+        the image to project
+
+    Returns
+    -------
+    (i, j, k) size of the orthogonal grid, padded in k to account for oblique images in 3d space
+    """
+    # find padded k index length to account for oblique images in 3d space
+    # TODO: 202502 csk can we/ do we need to do this for x and y too??
+    extent_z = img.TransformIndexToPhysicalPoint((0, 0, img.GetSize()[2]-1))[2] - img.TransformIndexToPhysicalPoint((0, 0, 0))[2]
+    index_z = int((extent_z-img.GetOrigin()[2])/img.GetSpacing()[2])
+    return img.GetSize()[0], img.GetSize()[1], index_z
+
+
+def _slab_depth(grid_size: tuple, workers: int = 1, memory_budget: int = None) -> int:
+    # how many k planes fit into one slab, either a fixed chunk of voxels or a share of the memory budget per worker
+    plane_voxels = max(1, grid_size[0] * grid_size[1])
+    if memory_budget is None:
+        depth = regrid_chunk_voxels // plane_voxels
+    else:
+        depth = memory_budget // (max(1, workers) * regrid_bytes_per_voxel * plane_voxels)
+    return max(1, min(grid_size[2], depth))
+
+
+def _grid_spec(img: sitk.Image, grid: Union[np.ndarray, sitk.Image] = None) -> tuple:
+    # picklable description of the output grid: (kind, geometry, size), kind is "orthographic", "image" or "points"
+    if grid is None:
+        return 'orthographic', image_geometry(img), orthographic_grid_size(img)
+    if isinstance(grid, sitk.Image):
+        return 'image', image_geometry(grid), grid.GetSize()
+    return 'points', None, grid.shape[0:3]
+
+
+def _grid_points(grid_spec: tuple, k_start: int, k_stop: int) -> np.ndarray:
+    # physical points for a slab of an orthographic or image grid, point grids are sliced by the caller
+    kind, (origin, spacing, direction), size = grid_spec
+    if kind == 'image':
+        return _physical_grid((origin, spacing, direction), size, k_start, k_stop)
+
+    # "force" origin + index * spacing, the same as the orthogonal grid in the reference loop
+    xx = origin[0] + np.arange(size[0]) * spacing[0]
+    yy = origin[1] + np.arange(size[1]) * spacing[1]
+    zz = origin[2] + np.arange(k_start, k_stop) * spacing[2]
+    return np.stack(np.meshgrid(xx, yy, zz, indexing='ij'), axis=-1)
+
+
+def _source_block(points: np.ndarray, geometry: tuple, size: np.ndarray) -> tuple:
+    # the block of source voxels a slab of physical points can touch. the transform is affine so the corners of the
+    # points' bounding box bound the continuous indices, then pad by a voxel so linear interpolation has both
+    # neighbors at the block border
+    flat_points = points.reshape(-1, 3)
+    low_point, high_point = flat_points.min(axis=0), flat_points.max(axis=0)
+    corners = np.array([[(high_point if (corner >> axis) & 1 else low_point)[axis] for axis in range(3)]
+                        for corner in range(8)])
+    corner_indices = physical_to_continuous_index(corners, *geometry)
+    low = np.clip(np.floor(corner_indices.min(axis=0)).astype(np.int64) - 1, 0, size - 1)
+    high = np.clip(np.floor(corner_indices.max(axis=0)).astype(np.int64) + 2, 1, size)
+    return low, np.maximum(high, low + 1)
+
+
+def _regrid_slab(task: tuple) -> tuple:
+    # regrid one slab of k planes: physical points -> continuous indices -> interpolated values
+    # module level so it can run in a process pool, everything it needs is passed in the task
+    block, offset, size, geometry, grid_spec, points, k_start, k_stop, default_value, mode, dtype = task
+    if points is None:
+        points = _grid_points(grid_spec, k_start, k_stop)
+    indices = physical_to_continuous_index(points, *geometry)
+    values = interpolate_at_continuous_indices(block, indices, default_value, mode, size=size, offset=offset)
+
+    # output is built in sitk (k, j, i) order, which is what the reference loop ends up with after swapaxes
+    return k_start, k_stop, np.transpose(values, (2, 1, 0)).astype(dtype)
+
+
+def _regrid_slab_tasks(volume: np.ndarray,
+                       geometry: tuple,
+                       grid_spec: tuple,
+                       grid: np.ndarray,
+                       depth: int,
+                       default_value: float,
+                       mode,
+                       split_source: bool):
+    # generate the slab tasks for the vectorized engine, when split_source only the block of the source volume
+    # each slab needs is sent along with it
+    size = np.asarray(volume.shape[::-1])
+    grid_size = grid_spec[2]
+    for k_start in range(0, grid_size[2], depth):
+        k_stop = min(k_start + depth, grid_size[2])
+        points = None if grid is None else grid[:, :, k_start:k_stop]
+        block, offset = volume, np.zeros(3, dtype=np.int64)
+        if split_source:
+            slab_points = _grid_points(grid_spec, k_start, k_stop) if points is None else points
+            low, high = _source_block(slab_points, geometry, size)
+            block, offset = volume[low[2]:high[2], low[1]:high[1], low[0]:high[0]], low
+        yield block, offset, size, geometry, grid_spec, points, k_start, k_stop, default_value, mode, volume.dtype
+
+
+def _generate_regridded_volume_vectorized(img: sitk.Image,
+                                          grid: Union[np.ndarray, sitk.Image] = None,
+                                          default_value: float = 0,
+                                          mode=sitk.sitkLinear,
+                                          workers: int = 1,
+                                          memory_budget: int = None) -> np.ndarray:
+    # regrid a slab of k planes at a time, in this process or across a pool of worker processes
+    volume = sitk.GetArrayFromImage(img)
+    geometry = image_geometry(img)
+    grid_spec = _grid_spec(img, grid)
+    grid_points = grid if grid_spec[0] == 'points' else None
+    grid_size = grid_spec[2]
+
+    workers = os.cpu_count() if workers is None else workers
+    depth = _slab_depth(grid_size, workers, memory_budget)
+    new_volume = np.zeros(grid_size[::-1], dtype=volume.dtype)
+
+    tasks = _regrid_slab_tasks(volume, geometry, grid_spec, grid_points, depth, default_value, mode,
+                               split_source=workers > 1)
+    if workers <= 1:
+        for task in tasks:
+            k_start, k_stop, values = _regrid_slab(task)
+            new_volume[k_start:k_stop] = values
+        return new_volume
+
+    # keep a couple of slabs per worker in flight so the source blocks and results waiting in the pool stay bounded
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for task in tasks:
+            pending.add(executor.submit(_regrid_slab, task))
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    k_start, k_stop, values = future.result()
+                    new_volume[k_start:k_stop] = values
+        for future in pending:
+            k_start, k_stop, values = future.result()
+            new_volume[k_start:k_stop] = values
+
+    return new_volume
+
+
+class RegridPlan:
+    """
+    The geometry-only part of regridding one source geometry onto one output grid: which output voxels fall inside
+    the source, which source voxels each of them reads and the linear interpolation fractions. Applying a plan to an
+    image with the source geometry only costs a gather, so it can be reused for every image that shares that geometry
+    (eg every modality of a co-registered session)
+
+    """
+    def __init__(self, key, source_size, grid_size, mode, inside, gather, fraction=None):
+        self.key = key
+        self.source_size = tuple(int(x) for x in source_size)
+        self.grid_size = tuple(int(x) for x in grid_size)
+        self.mode = int(mode)
+        self.inside = inside
+        self.gather = gather
+        self.fraction = fraction
+
+    @property
+    def nbytes(self):
+        return self.inside.nbytes + self.gather.nbytes + (0 if self.fraction is None else self.fraction.nbytes)
+
+    def apply(self, img: sitk.Image, default_value: float = 0) -> np.ndarray:
+        """
+        regrid an image with this plan
+
+        Parameters
+        ----------
+        img: sitk.Image
+            the image to regrid, must have the source size the plan was built for
+        default_value: float=0
+            the value to use for output voxels outside of the image
+
+        Returns
+        -------
+        a np.ndarray of "regridded" image volume data, the same as generate_regridded_volume
+        """
+        if tuple(img.GetSize()) != self.source_size:
+            raise ValueError(f'plan is for images of size {self.source_size}, not {img.GetSize()}')
+
+        volume = sitk.GetArrayFromImage(img)
+        values = np.full(self.inside.shape, default_value, dtype=np.float64)
+        values[self.inside] = gather_interpolated_values(volume.reshape(-1), self.gather, self.fraction)
+        return values.astype(volume.dtype).reshape(self.grid_size[::-1])
+
+    def save(self, path: str):
+        # write to a temp name and move it in place, so a reader never sees half a plan
+        temp_path = f'{path}.{os.getpid()}.tmp.npz'
+        arrays = {'key': np.array(self.key), 'source_size': np.array(self.source_size),
+                  'grid_size': np.array(self.grid_size), 'mode': np.array(self.mode),
+                  'inside': self.inside, 'gather': self.gather}
+        if self.fraction is not None:
+            arrays['fraction'] = self.fraction
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def load(path: str):
+        with np.load(path) as arrays:
+            return RegridPlan(str(arrays['key']), arrays['source_size'], arrays['grid_size'], arrays['mode'],
+                              arrays['inside'], arrays['gather'],
+                              arrays['fraction'] if 'fraction' in arrays else None)
+
+
+def regrid_plan_key(img: sitk.Image, grid: Union[np.ndarray, sitk.Image] = None, mode=sitk.sitkLinear) -> str:
+    """
+    key a regrid plan by everything it depends on: source size/origin/spacing/direction, the output grid and the
+    interpolation mode
+
+    Parameters
+    ----------
+    img: sitk.Image
+        the source image
+    grid: np.ndarray or sitk.Image, optional, default None
+        the output grid, as for generate_regridded_volume
+    mode:
+        the interpolation mode
+
+    Returns
+    -------
+    a hex digest string
+    """
+    kind, geometry, grid_size = _grid_spec(img, grid)
+    key = hashlib.sha1()
+    key.update(np.asarray(img.GetSize(), dtype=np.int64).tobytes())
+    for item in image_geometry(img):
+        key.update(item.tobytes())
+    key.update(f'{kind}|{mode}|{tuple(grid_size)}'.encode())
+    if kind == 'points':
+        key.update(np.ascontiguousarray(grid, dtype=np.float64).tobytes())
+    else:
+        for item in geometry:
+            key.update(item.tobytes())
+    return key.hexdigest()
+
+
+def build_regrid_plan(img: sitk.Image, grid: Union[np.ndarray, sitk.Image] = None, mode=sitk.sitkLinear) -> RegridPlan:
+    """
+    compute the index mapping and interpolation weights for regridding img's geometry onto a grid
+
+    Parameters
+    ----------
+    img: sitk.Image
+        an image with the source geometry, its pixel data is not used
+    grid: np.ndarray or sitk.Image, optional, default None
+        the output grid, as for generate_regridded_volume
+    mode:
+        the interpolation mode to use, sitk.sitkNearestNeighbor or sitk.sitkLinear
+
+    Returns
+    -------
+    a RegridPlan
+    """
+    geometry = image_geometry(img)
+    grid_spec = _grid_spec(img, grid)
+    grid_size = grid_spec[2]
+    source_size = np.asarray(img.GetSize())
+
+    # smallest index type that can address the source volume
+    gather_dtype = np.int32 if np.prod(source_size) < np.iinfo(np.int32).max else np.int64
+
+    insides, gathers, fractions = [], [], []
+    for k_start in range(0, grid_size[2], _slab_depth(grid_size)):
+        k_stop = min(k_start + _slab_depth(grid_size), grid_size[2])
+        points = _grid_points(grid_spec, k_start, k_stop) if grid_spec[0] != 'points' else grid[:, :, k_start:k_stop]
+
+        # put the points in output (k, j, i) order so the plan's flat order matches the output volume
+        points = np.transpose(points, (2, 1, 0, 3)).reshape(-1, 3)
+        inside, gather, fraction = interpolation_gather(physical_to_continuous_index(points, *geometry),
+                                                        source_size, mode)
+        insides.append(inside)
+        gathers.append(gather.astype(gather_dtype))
+        if fraction is not None:
+            fractions.append(fraction)
+
+    return RegridPlan(regrid_plan_key(img, grid, mode), source_size, grid_size, mode,
+                      np.concatenate(insides), np.concatenate(gathers),
+                      np.concatenate(fractions) if len(fractions) > 0 else None)
+
+
+class RegridPlanCache:
+    """
+    A bounded LRU cache of RegridPlans keyed by source/target geometry, optionally persisted to a folder so plans
+    survive between runs. Keeps hit/miss counts so the savings on multi-modality runs can be checked
+
+    """
+    def __init__(self, max_plans=8, max_bytes=None, cache_dir=None):
+        self.max_plans = max_plans
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.plans = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def plan_path(self, key):
+        return None if self.cache_dir is None else os.path.join(self.cache_dir, f'regrid_plan_{key}.npz')
+
+    def get_plan(self, img: sitk.Image, grid: Union[np.ndarray, sitk.Image] = None, mode=sitk.sitkLinear) -> RegridPlan:
+        """
+        get the plan for regridding img's geometry onto grid, from memory, then disk, building it if needed
+
+        Parameters
+        ----------
+        img: sitk.Image
+            an image with the source geometry
+        grid: np.ndarray or sitk.Image, optional, default None
+            the output grid, as for generate_regridded_volume
+        mode:
+            the interpolation mode
+
+        Returns
+        -------
+        a RegridPlan
+        """
+        key = regrid_plan_key(img, grid, mode)
+        if key in self.plans:
+            self.hits += 1
+            self.plans.move_to_end(key)
+            return self.plans[key]
+
+        plan_path = self.plan_path(key)
+        if plan_path is not None and os.path.exists(plan_path):
+            self.disk_hits += 1
+            plan = RegridPlan.load(plan_path)
+        else:
+            self.misses += 1
+            plan = build_regrid_plan(img, grid, mode)
+            if plan_path is not None:
+                plan.save(plan_path)
+
+        self.plans[key] = plan
+        self.evict()
+        return plan
+
+    def evict(self):
+        # drop least recently used plans until within bounds, always keep the newest one
+        while len(self.plans) > 1 and (len(self.plans) > self.max_plans or
+                                       (self.max_bytes is not None and self.nbytes() > self.max_bytes)):
+            self.plans.popitem(last=False)
+            self.evictions += 1
+
+    def nbytes(self):
+        return sum(plan.nbytes for plan in self.plans.values())
+
+    def clear(self):
+        self.plans.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns
+        -------
+        a dict of hits (memory), disk_hits, misses (built), evictions, the number of cached plans and their bytes
+        """
+        lookups = self.hits + self.disk_hits + self.misses
+        return {'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': 0.0 if lookups == 0 else (self.hits + self.disk_hits) / lookups,
+                'plans': len(self.plans),
+                'bytes': self.nbytes()}
+
+
 def generate_regridded_volume(img:sitk.Image,
-                              grid:np.ndarray=None,
+                              grid:Union[np.ndarray, sitk.Image]=None,
                               default_value:float=0,
-                              mode=sitk.sitkLinear) -> np.ndarray:
+                              mode=sitk.sitkLinear,
+                              engine:str='vectorized',
+                              workers:int=1,
+                              memory_budget:int=None,
+                              plan_cache:RegridPlanCache=None) -> np.ndarray:
     """
     given a sitk Image, generate a volume projection onto a new grid.
 
@@ -76,10 +715,12 @@ def generate_regridded_volume(img:sitk.Image,
     ----------
     img: sitk.Image
         The image to take volume information from
-    grid: np.ndarray, optional, default None
+    grid: np.ndarray or sitk.Image, optional, default None
         The grid of physical points to take volume information from,
         must be in the form [i, j, k, (x, y, z)] where i, j, and k are image index values, and x, y, z are
         corresponding image physical values
+        if an sitk.Image is passed, regrid onto that image's grid, generating its physical points a slab at a time
+        instead of holding the full grid in memory
         if not provided, will regrid as an "orthographic projection" on the size of the image data,
         attempting to pad for oblique images
     default_value: float=0
@@ -87,6 +728,20 @@ def generate_regridded_volume(img:sitk.Image,
     mode:
         the interpolation mode to use, from sitk constants. Possible values are sitk.sitkNearest, sitk.sitkLinear.
         detaults to sitk.sitkLinear
+    engine: str='vectorized'
+        "vectorized" to map the whole grid to continuous indices and interpolate in bulk, "reference" to use the
+        per-voxel sitk EvaluateAtContinuousIndex loop. Both give the same volume, reference is much slower and
+        is kept for comparing results
+    workers: int=1
+        number of processes for the vectorized engine. With more than one, the output is split into slabs of k
+        planes that are regridded in a process pool, each slab only gets the block of source voxels (plus a one voxel
+        border for linear interpolation) that it needs. None uses every core
+    memory_budget: int, optional, default None
+        approximate bytes of working memory for the vectorized engine across all workers, used to size the slabs.
+        if not provided, slabs are sized with regrid_chunk_voxels
+    plan_cache: RegridPlanCache, optional, default None
+        if provided, get the index mapping and interpolation weights for this image geometry and grid from the cache
+        (building them the first time), so regridding only costs a gather. Only used by the vectorized engine
 
 
     Returns
@@ -95,6 +750,19 @@ def generate_regridded_volume(img:sitk.Image,
 
 
     """
+    if engine not in regrid_engines:
+        raise ValueError(f'unknown regrid engine {engine}, use one of {regrid_engines}')
+
+    if engine == 'vectorized' and plan_cache is not None:
+        return plan_cache.get_plan(img, grid, mode).apply(img, default_value)
+
+    if engine == 'vectorized':
+        return _generate_regridded_volume_vectorized(img, grid, default_value, mode, workers, memory_budget)
+
+    # the reference loop needs the full grid of physical points
+    if isinstance(grid, sitk.Image):
+        grid = generate_grid(grid)
+
     # use dtypw of the source image
     dtyp = sitk.GetArrayFromImage(img).dtype
 
@@ -105,13 +773,8 @@ def generate_regridded_volume(img:sitk.Image,
         # generate an orthogonal projection overlaying the space of the image's grid
         # TODO: 202502 csk do we need an option for a reference image with it's origin/spacing/direction??
 
-        # find padded k index length to account for oblique images in 3d space
-        # TODO: 202502 csk can we/ do we need to do this for x and y too??
-        extent_z = img.TransformIndexToPhysicalPoint((0, 0, img.GetSize()[2]-1))[2] - img.TransformIndexToPhysicalPoint((0, 0, 0))[2]
-        index_z = int((extent_z-img.GetOrigin()[2])/img.GetSpacing()[2])
-
-        # use the image's GetSize() to initialize the output volume
-        new_volume = np.zeros((img.GetSize()[0], img.GetSize()[1], index_z), dtype=dtyp)
+        # use the image's GetSize() to initialize the output volume, padded for oblique images
+        new_volume = np.zeros(orthographic_grid_size(img), dtype=dtyp)
 
         # traverse the orthogonal indices of the projected grid
         for kk in range(0, new_volume.shape[2]):
@@ -128,7 +791,7 @@ def generate_regridded_volume(img:sitk.Image,
                     # catch index outside of grid and zero out those values
                     # TODO: csk 202601 break this out into separate function? seemed to be performance hit
                     try:
-                        new_value = evaluate_at_continuous_index_wrapper(img, new_point, interp=mode)
+                        new_value = evaluate_at_continuous_index_wrapper(img, new_point, default_value, interp=mode)
                     except IndexError as e:
                         new_value = default_value
 
@@ -143,7 +806,7 @@ def generate_regridded_volume(img:sitk.Image,
                 for ii in range(0, grid.shape[0]):
                     new_point = img.TransformPhysicalPointToContinuousIndex(grid[ii, jj, kk])
                     try:
-                        new_value = evaluate_at_continuous_index_wrapper(img, new_point, interp=mode)
+                        new_value = evaluate_at_continuous_index_wrapper(img, new_point, default_value, interp=mode)
                     except Exception as e:
                         new_value = default_value
                     new_volume[ii, jj, kk] = new_value
@@ -154,11 +817,16 @@ def generate_regridded_volume(img:sitk.Image,
 
 
 def generate_regridded_image(img:sitk.Image,
-                             grid:np.ndarray=None,
+                             grid:Union[np.ndarray, sitk.Image]=None,
                              mode=sitk.sitkLinear,
                              copy_tags=True,
                              new_spacing=(1, 1, 1),
-                             new_origin=(0, 0, 0)) -> sitk.Image:
+                             new_origin=(0, 0, 0),
+                             default_value:float=0,
+                             engine:str='vectorized',
+                             workers:int=1,
+                             memory_budget:int=None,
+                             plan_cache:RegridPlanCache=None) -> sitk.Image:
     """
     wrapper to get an sitk Image rather than an ndarray for a projection
 
@@ -166,23 +834,32 @@ def generate_regridded_image(img:sitk.Image,
     ----------
    img: sitk.Image
         The image to take volume information from
-    grid: np.ndarray, optional, default None
+    grid: np.ndarray or sitk.Image, optional, default None
         The grid of physical points to take volume information from,
         must be in the form [i, j, k, (x, y, z)] where i, j, and k are image index values, and x, y, z are
-        corresponding image physical values
+        corresponding image physical values, or an sitk.Image whose grid is used
         if not provided, will regrid on the size of the image data, attempting to pad for oblique images
     default_value: float=0
         the value to use if the index point is outside the index grid of the image. defaults to 0
     mode:
         the interpolation mode to use, from sitk constants. Possible values are sitk.sitkNearest, sitk.sitkLinear.
         detaults to sitk.sitkLinear
+    engine: str='vectorized'
+        "vectorized" or "reference", see generate_regridded_volume
+    workers: int=1
+        number of processes to regrid slabs with, see generate_regridded_volume
+    memory_budget: int, optional, default None
+        approximate bytes of working memory across all workers, see generate_regridded_volume
+    plan_cache: RegridPlanCache, optional, default None
+        cache of precomputed regrid plans, see generate_regridded_volume
 
     Returns
     -------
     a new sitk.Image with parameters of img but containing "regridded" image volume data
     """
 
-    new_volume = generate_regridded_volume(img, grid, mode)
+    new_volume = generate_regridded_volume(img, grid, default_value=default_value, mode=mode, engine=engine,
+                                           workers=workers, memory_budget=memory_budget, plan_cache=plan_cache)
 
     # TODO: csk 202501 do we need to reverse the swapaxes in this case??
     # new_volume = np.swapaxes(new_volume, 0, 2)
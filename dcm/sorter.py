@@ -1,14 +1,17 @@
 import os
 import glob
-import shutil
 import tempfile
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from enum import Enum
+from itertools import islice
 from multiprocessing import Process
+from queue import Queue, Empty
+from threading import Thread
 from zipfile import ZipFile
 
 import flywheel
-import pydicom
 import re
 import dicom2nifti
 import subprocess
@@ -18,6 +21,9 @@ from dicom2nifti.exceptions import ConversionError
 import sys
 sys.path.append('/home/aa-cxk023/share/radlib')
 from radlib.fw.flywheel_clients import uwhealthaz_client
+from radlib.dcm.readers import ZipDicomArchive, read_dicom_file, place_dicom_file, default_read_workers, \
+    scan_dicom_headers
+from radlib.dcm.dicom_index import DicomIndex
 
 class DicomSorter:
     # example "sort structure" uses pydicom tag names to produce a folder path to sort images
@@ -66,7 +72,14 @@ class DicomSorter:
                  flywheel_project=None,
                  preserve_input_files=False,
                  logger=None,
-                 scratch_folder=None
+                 scratch_folder=None,
+                 index_path=None,
+                 sort_workers=None,
+                 place_method='auto',
+                 convert_workers=None,
+                 pipelined=False,
+                 upload_workers=4,
+                 pipeline_depth=16
                  ):
 
         self.logger = logger
@@ -95,12 +108,27 @@ class DicomSorter:
         # TODO: 202505 csk add local variables or passed in parameters?
         self.filename_filter = DicomSorter.default_radsurv_filter if filename_filter is None else filename_filter
 
-        # lists of files so we know what's done and we don't leave extra copies around
-        self.sorted_paths = []
-        self.converted_paths = []
-        self.moved_paths = []
+        # persistent index of files and series so we know what's done, across restarts, and we don't leave extra
+        # copies around. opened on first use so it belongs to the process that runs the sorter (see start)
+        self.index_path = f'{self.sorted_folder}/.dicom_index.sqlite' if index_path is None else index_path
+        self._index = None
         self.files_to_delete = []
 
+        # sort stage concurrency, and how sorted files are placed (see readers.place_dicom_file)
+        self.sort_workers = default_read_workers() if sort_workers is None else sort_workers
+        self.place_method = place_method
+
+        # convert stage concurrency, series conversions are cpu bound so one process per core
+        self.convert_workers = (os.cpu_count() or 1) if convert_workers is None else convert_workers
+        self._filter_source = None
+        self._filter_matcher = None
+
+        # pipelined mode runs sort, convert and upload as overlapping stages joined by queues of pipeline_depth
+        # series (see run_pipeline)
+        self.pipelined = pipelined
+        self.upload_workers = upload_workers
+        self.pipeline_depth = pipeline_depth
+
         # pass in False to run once, or True for continuous use. Set to False for "manuaL" off
         self.service = service
 
@@ -115,6 +143,12 @@ class DicomSorter:
         # self.run_process.start()
 
 
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = DicomIndex(self.index_path)
+        return self._index
+
     @staticmethod
     def clean_path(path):
         # clean up "bad" path characters
@@ -146,15 +180,35 @@ class DicomSorter:
 
     @staticmethod
     def get_unique_sorted_paths(sorted_folder):
-        old_paths = [os.path.dirname(p) for p in DicomSorter.find_dcm_in_folder(sorted_folder)]
-        new_paths = []
-
-        for old_path in old_paths:
-            if old_path not in new_paths:
-                new_paths.append(old_path)
-
-        return new_paths
+        # unique folders in the order they are found
+        return list(dict.fromkeys(os.path.dirname(p) for p in DicomSorter.find_dcm_in_folder(sorted_folder)))
 
+    @staticmethod
+    def series_inputs(series_path):
+        # total size and newest modification time of the slices in a sorted series folder
+        size = 0
+        newest = 0
+        with os.scandir(series_path) as entries:
+            for entry in entries:
+                if entry.name.endswith('.dcm') and entry.is_file():
+                    stat = entry.stat()
+                    size += stat.st_size
+                    newest = max(newest, stat.st_mtime_ns)
+        return size, newest
+
+
+    def plan_sort_path(self, dcm_path, meta, planned_paths=None, allow_duplicates=False):
+        # where a file goes, given its header and the paths already taken in this pass
+        sort_dir = self.clean_path(self.get_sort_dir(meta))
+        sort_filename = self.clean_filename(os.path.basename(dcm_path))
+        sort_path = os.path.normpath(f'{self.sorted_folder}/{sort_dir}/{sort_filename}')
+        taken = planned_paths is not None and sort_path in planned_paths
+        if (taken or os.path.exists(sort_path)) and not allow_duplicates:
+            # TODO 202506 csk kludge to allow multiple images with same effective "name"
+            sort_path = f'{os.path.dirname(sort_path)}A/{os.path.basename(sort_path)}'
+        if planned_paths is not None:
+            planned_paths.add(sort_path)
+        return sort_path
 
     def sort_one_dcm(self, dcm_path, allow_duplicates=False):
         # TODO: 2025-06 csk temporary kludge for GBM data where two copies of each slice are
@@ -164,25 +218,108 @@ class DicomSorter:
         #     print("return?")
         #     return
         # get metadata
-        meta = pydicom.dcmread(dcm_path, stop_before_pixels=True)
-        sort_dir = self.clean_path(self.get_sort_dir(meta))
-        sort_filename = self.clean_filename(os.path.basename(dcm_path))
-        sort_path = f'{self.sorted_folder}/{sort_dir}/{sort_filename}'
-        if os.path.exists(sort_path) and not allow_duplicates:
-            # TODO 202506 csk kludge to allow multiple images with same effective "name"
-            sort_path = f'{os.path.dirname(sort_path)}A/{os.path.basename(sort_path)}'
+        meta = read_dicom_file(dcm_path, stop_before_pixels=True)
+        sort_path = self.plan_sort_path(dcm_path, meta, allow_duplicates=allow_duplicates)
         os.makedirs(os.path.dirname(sort_path), exist_ok=True)
-        shutil.copy(dcm_path, sort_path)
-        print(f"copied {dcm_path} to {sort_path}")
+        method = place_dicom_file(dcm_path, sort_path, self.place_method)
+        if self.logger is not None:
+            self.logger.debug(f'{method} {dcm_path} to {sort_path}')
         # TODO: 202506 csk fix this before enabling!
         # if self.preserve_input_files:
         #     shutil.copy(dcm_path, sort_path)
         # else:
         #     shutil.move(dcm_path, sort_path)
+        return dcm_path, meta, sort_path
+
+    def sort_dcm_paths(self, dcm_paths, allow_duplicates=False, failed=None, headers=None):
+        """
+        sort many files concurrently: headers are read on a bounded thread pool and each file is placed as soon as
+        its path is planned, so header reads and file placement overlap. Paths are planned in input order (so
+        duplicate names resolve the same way as sorting one at a time) and each destination folder is made once
+
+        Parameters
+        ----------
+        dcm_paths: list
+            file or zip member paths
+        allow_duplicates: bool=False
+            overwrite files with the same sorted path rather than moving them aside
+        failed: list, optional, default None
+            (path, error message) of each file that can't be read or sorted is added to it, for DicomIndex.record_failed
+        headers: dict, optional, default None
+            headers already read, by path, these files aren't read again
+
+        Returns
+        -------
+        generator of (path, header, sorted path) for each file placed, in the order they finish. Files that can't be
+        read or placed are logged and left out
+        """
+        def read_header(path):
+            if headers is not None and path in headers:
+                return headers[path]
+            return read_dicom_file(path, True)
+
+        planned_paths = set()
+        made_dirs = set()
+        window = 4 * self.sort_workers
+        paths = iter(dcm_paths)
+
+        with ThreadPoolExecutor(max_workers=self.sort_workers) as executor:
+            reads = deque((path, executor.submit(read_header, path)) for path in islice(paths, window))
+            placements = deque()
+            while len(reads) > 0 or len(placements) > 0:
+                # hand back finished placements, waiting on the oldest when too many are in flight
+                while len(placements) > 0 and (placements[0][1].done() or len(placements) > window
+                                               or len(reads) == 0):
+                    result, placement = placements.popleft()
+                    try:
+                        method = placement.result()
+                    except OSError as e:
+                        # eg the sorted folder filled up, tried again next pass
+                        self.log_error(f'could not place {result[0]} at {result[2]}: {e}')
+                        continue
+                    except Exception as e:
+                        # eg a zip member that can't be read, left alone until the file changes
+                        self.log_error(f'could not place {result[0]} at {result[2]}: {e}')
+                        if failed is not None:
+                            failed.append((result[0], f'{type(e).__name__}: {e}'))
+                        continue
+                    if self.logger is not None:
+                        self.logger.debug(f'{method} {result[0]} to {result[2]}')
+                    yield result
+                if len(reads) == 0:
+                    continue
+
+                dcm_path, read = reads.popleft()
+                next_path = next(paths, None)
+                if next_path is not None:
+                    reads.append((next_path, executor.submit(read_header, next_path)))
+                try:
+                    meta = read.result()
+                    sort_path = self.plan_sort_path(dcm_path, meta, planned_paths, allow_duplicates)
+                except Exception as e:
+                    self.log_error(f'could not sort {dcm_path}: {e}')
+                    if failed is not None:
+                        failed.append((dcm_path, f'{type(e).__name__}: {e}'))
+                    continue
+
+                sort_dir = os.path.dirname(sort_path)
+                if sort_dir not in made_dirs:
+                    os.makedirs(sort_dir, exist_ok=True)
+                    made_dirs.add(sort_dir)
+                placements.append(((dcm_path, meta, sort_path),
+                                   executor.submit(place_dicom_file, dcm_path, sort_path, self.place_method)))
+
+    def log_error(self, message):
+        if self.logger is not None:
+            self.logger.error(message)
+        else:
+            print(message)
 
     def run(self):
         while True:
-            if self.sort():
+            if self.pipelined:
+                self.run_pipeline()
+            elif self.sort():
                 # time.sleep(2)
                 self.convert()
                 if self.send_to_flywheel:
@@ -201,53 +338,62 @@ class DicomSorter:
     def stop(self):
         self.active = False
 
-    def all_paths_done(self, path_type, path_list):
-        unsorted_paths = True
-        checked_paths = self.sorted_paths
-        if path_type == 'converted':
-            checked_paths = self.converted_paths
-        if path_type == 'moved':
-            checked_paths = self.moved_paths
-
-        for path in path_list:
-            if path not in checked_paths:
-                unsorted_paths = False
-
-        return unsorted_paths
+    @staticmethod
+    def expand_sort_paths(sort_paths):
+        # files to sort, zips are sorted member by member straight out of the archive
+        dcm_paths = []
+        zip_members = {}
+        for sort_path in sort_paths:
+            if sort_path.endswith('dicom.zip'):
+                with ZipDicomArchive(sort_path) as archive:
+                    zip_members[sort_path] = archive.paths('*.dcm')
+                dcm_paths.extend(zip_members[sort_path])
+            else:
+                dcm_paths.append(sort_path)
+        return dcm_paths, zip_members
 
     def sort(self):
         try:
-            sort_paths = DicomSorter.find_dicom_in_folder(self.input_folder)
-            if self.all_paths_done('sorted', sort_paths):
+            # new or changed input files, see DicomIndex.scan
+            sort_paths = self.index.scan(self.input_folder, ('.dcm', 'dicom.zip'))
+            if len(sort_paths) == 0:
                 if self.logger is not None:
                     self.logger.info(f'no files found to sort')
                 return False
 
-            # self.resolve_duplicate_names(sort_paths)
+            dcm_paths, zip_members = self.expand_sort_paths(sort_paths)
 
-            for sort_path in sort_paths:
-                if sort_path in self.sorted_paths:
-                    continue
-
-                if sort_path.endswith('dicom.zip'):
-                    # path is a zip
-                    temp_dir = tempfile.TemporaryDirectory()
-                    with ZipFile(sort_path) as zip_file:
-                        zip_file.extractall(temp_dir.name)
-                        dcm_paths = DicomSorter.find_dcm_in_folder(temp_dir.name)
-                        for tmp_path in dcm_paths:
-                            self.sort_one_dcm(tmp_path)
-                else:
-                    # path is the file
-                    self.sort_one_dcm(sort_path)
+            # self.resolve_duplicate_names(sort_paths)
 
-                # TODO: 202506 csk fix this before turning back on!
-                # if not self.preserve_input_files:
-                #    os.remove(sort_path)
+            sorted_count = 0
+            sorted_files = []
+            sorted_members = set()
+            failed = []
+            for sorted_file in self.sort_dcm_paths(dcm_paths, failed=failed):
+                sorted_files.append(sorted_file)
+                # record in batches, one transaction each
+                if len(sorted_files) >= 256:
+                    self.index.record_sorted(sorted_files)
+                    sorted_members.update(path for path, _, _ in sorted_files)
+                    sorted_count += len(sorted_files)
+                    sorted_files = []
+            self.index.record_sorted(sorted_files)
+            sorted_members.update(path for path, _, _ in sorted_files)
+            sorted_count += len(sorted_files)
+            # unreadable files are left alone until they change
+            self.index.record_failed(failed)
+            sorted_members.update(path for path, _ in failed)
+
+            # a zip is done when all of its members are
+            self.index.mark_sorted([zip_path for zip_path, members in zip_members.items()
+                                    if all(member in sorted_members for member in members)])
+
+            # TODO: 202506 csk fix this before turning back on!
+            # if not self.preserve_input_files:
+            #    os.remove(sort_path)
 
-                self.sorted_paths.append(sort_path)
-                if self.logger is not None:
-                    self.logger.info(f'sorted {sort_path}')
+            if self.logger is not None:
+                self.logger.info(f'sorted {sorted_count} of {len(dcm_paths)} files from {len(sort_paths)} paths')
 
         except Exception as e:
             if self.logger is not None:
@@ -259,115 +405,398 @@ class DicomSorter:
     def convert(self):
         # get sorted folders
         try:
-            convert_paths = self.get_unique_sorted_paths(self.sorted_folder)
-            if self.all_paths_done('converted', convert_paths):
+            # series sorted into since they were last converted
+            convert_paths = self.index.pending_conversion()
+            if len(convert_paths) == 0:
                 return
 
+            jobs = []
             for convert_path in convert_paths:
+                job, _ = self.conversion_job(convert_path)
+                if job is not None:
+                    jobs.append(job)
+
+            # largest series first, so the longest conversion isn't the last one started
+            jobs.sort(reverse=True)
+            for convert_path, nii_path, error, seconds in self.convert_series(jobs):
+                if error is not None:
+                    self.log_error(f'dicom2nifti {error}, check dicom {convert_path}')
+                self.index.record_converted(convert_path, nii_path)
                 if self.logger is not None:
-                    self.logger.info(f'filter {self.filter(convert_path)} {convert_path}')
-
-                if self.filter(convert_path):
-                    nii_path = f'{convert_path.replace(" ", "_")}.nii.gz'
-                    nii_path = nii_path.replace(self.sorted_folder, self.converted_folder)
-                    os.makedirs(os.path.dirname(nii_path), exist_ok=True)
-
-                    try:
-                        dicom2nifti.dicom_series_to_nifti(convert_path, nii_path, reorient_nifti=True)
-                        print(f"converted {convert_path} to {nii_path}")
-                    except ConversionError as e:
-                        if self.logger is not None:
-                            self.logger.error(f'dicom2nifti ConversionError {e}, check dicom {convert_path}')
-
-                    self.converted_paths.append(convert_path)
-                    if self.logger is not None:
-                        self.logger.info(f'converted {convert_path}')
+                    self.logger.info(f'converted {convert_path} to {nii_path} in {seconds:.1f}s')
 
         except Exception as e:
             if self.logger is not None:
                 self.logger.info(f'convert exception! {e}')
             time.sleep(2)
 
+    def conversion_job(self, convert_path):
+        # ((size, series folder, nii path) to run or None, nii path or None) for a sorted series. Series the filter
+        # passes over, or converted since they were last sorted into, are recorded in the index and not run. The
+        # index's conversion time is used when it has one, otherwise the NIfTI's mtime. Slice mtimes can't tell:
+        # hardlinked and reflinked slices keep their input's mtime
+        selected = self.filter(convert_path)
+        if self.logger is not None:
+            self.logger.info(f'filter {selected} {convert_path}')
+        if not selected:
+            self.index.record_converted(convert_path, selected=False)
+            return None, None
+
+        nii_path = f'{convert_path.replace(" ", "_")}.nii.gz'
+        nii_path = nii_path.replace(self.sorted_folder, self.converted_folder)
+
+        size, newest = self.series_inputs(convert_path)
+        series = self.index.series_folder(convert_path)
+        if series is not None and series['sorted_ns'] is not None:
+            newest = series['sorted_ns']
+        converted_ns = os.stat(nii_path).st_mtime_ns if os.path.exists(nii_path) else None
+        if converted_ns is not None and series is not None and series['selected'] and \
+                series['converted_ns'] is not None:
+            # a conversion still running when more files were sorted in writes its NIfTI after them
+            converted_ns = series['converted_ns']
+        if converted_ns is not None and converted_ns >= newest:
+            self.index.record_converted(convert_path, nii_path, converted_ns=converted_ns)
+            if self.logger is not None:
+                self.logger.info(f'up to date {nii_path}')
+            return None, nii_path
+        return (size, convert_path, nii_path), nii_path
+
+    def convert_series(self, jobs):
+        # run (size, series folder, nii path) conversions over a process pool, yield results as they finish. A series
+        # that fails other than with a ConversionError (eg a broken pool) is logged and left out, as in convert_stage
+        if self.convert_workers <= 1 or len(jobs) <= 1:
+            for _, convert_path, nii_path in jobs:
+                try:
+                    yield convert_dicom_series(convert_path, nii_path)
+                except Exception as e:
+                    self.log_error(f'convert exception! {e}, check dicom {convert_path}')
+            return
+        with ProcessPoolExecutor(max_workers=min(self.convert_workers, len(jobs))) as executor:
+            futures = {executor.submit(convert_dicom_series, convert_path, nii_path): convert_path
+                       for _, convert_path, nii_path in jobs}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    self.log_error(f'convert exception! {e}, check dicom {futures[future]}')
+                    continue
+                yield result
+
+    @staticmethod
+    def compile_filter(filename_filter):
+        # one case-insensitive pattern for the whole filter: any item whose strings all appear in the name
+        items = ['^' + ''.join(f'(?=.*{re.escape(filter_string.lower())})' for filter_string in filter_item)
+                 for filter_item in filename_filter]
+        if len(items) == 0:
+            return re.compile(r'(?!)')
+        return re.compile('|'.join(items), re.IGNORECASE | re.DOTALL)
+
     def filter(self, file_path):
-        file_name = os.path.basename(file_path)
-        for filter_item in self.filename_filter:
-            passed_filter = True
-            for filter_string in filter_item:
-                if filter_string.lower() not in file_name.lower():
-                    passed_filter = False
-            if passed_filter:
-                return True
+        # recompile only when the filter was replaced
+        if self._filter_source is not self.filename_filter:
+            self._filter_matcher = DicomSorter.compile_filter(self.filename_filter)
+            self._filter_source = self.filename_filter
+        return self._filter_matcher.match(os.path.basename(file_path)) is not None
+
+
+    def sort_series(self, dcm_paths, failed=None):
+        """
+        sort files and hand back each series as soon as all of its files are placed: headers are read concurrently
+        first so every destination is planned (and every series' file count known), then files are placed by
+        sort_dcm_paths
+
+        Parameters
+        ----------
+        dcm_paths: list
+            file or zip member paths
+        failed: list, optional, default None
+            as for sort_dcm_paths
+
+        Returns
+        -------
+        generator of (series folder, [(path, header, sorted path), ...]) in the order series complete. A series with
+        files that couldn't be placed comes last, with the files that were
+        """
+        headers = {meta.filename: meta for meta in scan_dicom_headers(dcm_paths, workers=self.sort_workers)}
+        if len(headers) < len(dcm_paths):
+            self.log_error(f'skipped {len(dcm_paths) - len(headers)} files that are not DICOM')
+            if failed is not None:
+                failed.extend((path, 'not a readable DICOM file') for path in dcm_paths if path not in headers)
+        read_paths = [path for path in dcm_paths if path in headers]
+
+        # plan as sort_dcm_paths will (same order, same taken paths) to count each series' files
+        planned_paths = set()
+        remaining = {}
+        for path in read_paths:
+            try:
+                series_dir = os.path.dirname(self.plan_sort_path(path, headers[path], planned_paths))
+            except Exception:
+                # sort_dcm_paths logs it
+                continue
+            remaining[series_dir] = remaining.get(series_dir, 0) + 1
+
+        series_files = {}
+        for sorted_file in self.sort_dcm_paths(read_paths, failed=failed, headers=headers):
+            series_dir = os.path.dirname(sorted_file[2])
+            series_files.setdefault(series_dir, []).append(sorted_file)
+            remaining[series_dir] = remaining.get(series_dir, 1) - 1
+            if remaining[series_dir] == 0:
+                yield series_dir, series_files.pop(series_dir)
+        yield from series_files.items()
+
+    def convert_stage(self, convert_queue, upload_queue, failures=None):
+        # take sorted series off convert_queue, convert them on a process pool and put (series folder, nii path)
+        # on upload_queue as each finishes. A series queued again while it is converting (sorted into after it was
+        # queued) waits for that conversion to finish. None on convert_queue ends the stage (and is passed on). An
+        # exception that ends the stage early is added to failures, and convert_queue is still read up to its None so
+        # the sorting thread never blocks on it
+        executor = ProcessPoolExecutor(max_workers=max(1, self.convert_workers))
+        running = {}
+        waiting = deque()
+        inputs_done = False
+        try:
+            while not inputs_done or len(running) > 0 or len(waiting) > 0:
+                for future in [future for future in running if future.done()]:
+                    convert_path, nii_path, started_ns = running.pop(future)
+                    try:
+                        _, _, error, seconds = future.result()
+                    except Exception as e:
+                        self.log_error(f'convert exception! {e}, check dicom {convert_path}')
+                        continue
+                    if error is not None:
+                        self.log_error(f'dicom2nifti {error}, check dicom {convert_path}')
+                    self.index.record_converted(convert_path, nii_path, converted_ns=started_ns)
+                    if self.logger is not None:
+                        self.logger.info(f'converted {convert_path} to {nii_path} in {seconds:.1f}s')
+                    upload_queue.put((convert_path, nii_path))
+
+                converting = set(convert_path for convert_path, _, _ in running.values())
+                if len(waiting) > 0 and waiting[0] not in converting:
+                    convert_path = waiting.popleft()
+                elif inputs_done or len(running) >= 2 * max(1, self.convert_workers) or len(waiting) > 0:
+                    # wait for a conversion when the pool is full or there is nothing more to take
+                    wait(running, return_when=FIRST_COMPLETED)
+                    continue
+                else:
+                    try:
+                        convert_path = convert_queue.get(timeout=0.1 if len(running) > 0 else None)
+                    except Empty:
+                        continue
+                    if convert_path is None:
+                        inputs_done = True
+                        continue
+                    if convert_path in converting:
+                        waiting.append(convert_path)
+                        continue
+
+                try:
+                    started_ns = time.time_ns()
+                    job, nii_path = self.conversion_job(convert_path)
+                except Exception as e:
+                    self.log_error(f'convert exception! {e}, check dicom {convert_path}')
+                    continue
+                if job is None:
+                    upload_queue.put((convert_path, nii_path))
+                else:
+                    running[executor.submit(convert_dicom_series, convert_path, nii_path)] = \
+                        (convert_path, nii_path, started_ns)
+        except Exception as e:
+            if failures is not None:
+                failures.append(('convert', e))
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            upload_queue.put(None)
+            while not inputs_done:
+                inputs_done = convert_queue.get() is None
+
+    def upload_stage(self, upload_queue, fw_client=None, failures=None):
+        # take (series folder, nii path) off upload_queue and upload them on a thread pool with fw_client (nothing is
+        # uploaded without one), until None. The next item is only taken when a worker is free, so a full upload_queue
+        # holds the convert stage back. As convert_stage, upload_queue is always read up to its None and an exception
+        # that ends the stage early is added to failures
+        inputs_done = False
+        try:
+            if fw_client is None:
+                return
 
-        return False
+            def upload(series_dir, nii_path):
+                try:
+                    self.move_series(fw_client, series_dir, nii_path, replace_dicoms=True, replace_niftis=True)
+                except Exception as e:
+                    self.log_error(f'move exception! {e}, check {series_dir}')
+
+            with ThreadPoolExecutor(max_workers=max(1, self.upload_workers)) as executor:
+                running = set()
+                while not inputs_done:
+                    if len(running) >= max(1, self.upload_workers):
+                        _, running = wait(running, return_when=FIRST_COMPLETED)
+                    item = upload_queue.get()
+                    inputs_done = item is None
+                    if not inputs_done:
+                        running.add(executor.submit(upload, *item))
+        except Exception as e:
+            if failures is not None:
+                failures.append(('upload', e))
+        finally:
+            while not inputs_done:
+                inputs_done = upload_queue.get() is None
+
+    def run_pipeline(self):
+        """
+        one pass of sort -> convert -> upload with the stages overlapping: each runs in its own worker pool, joined
+        by bounded queues, so a series goes to conversion as soon as all of its files are sorted and to upload as
+        soon as it is converted, while the rest of the study is still being sorted. Series an earlier pass didn't
+        finish (it was stopped, or a conversion or upload failed) go through the stages again, as in sequential mode
+
+        Returns
+        -------
+        False when there was nothing to sort, convert or upload
+        """
+        sort_paths = self.index.scan(self.input_folder, ('.dcm', 'dicom.zip'))
+        if len(sort_paths) == 0 and self.logger is not None:
+            self.logger.info(f'no files found to sort')
+        dcm_paths, zip_members = self.expand_sort_paths(sort_paths)
+
+        # series an earlier pass left unconverted, or converted but not uploaded
+        pending_conversion = self.index.pending_conversion()
+        pending_upload = []
+        if self.send_to_flywheel:
+            converting = set(pending_conversion)
+            pending_upload = [(series['series_dir'], self.uploadable_nii_path(series))
+                              for series in self.index.series(moved=False) if series['series_dir'] not in converting]
+        if len(dcm_paths) == 0 and len(pending_conversion) == 0 and len(pending_upload) == 0:
+            return False
+
+        # check the destination and connect here, before any stage starts: check_flywheel_destination exits, which
+        # would only end the thread it ran in
+        fw_client = None
+        if self.send_to_flywheel:
+            self.check_flywheel_destination()
+            fw_client = uwhealthaz_client()
+
+        convert_queue = Queue(maxsize=self.pipeline_depth)
+        upload_queue = Queue(maxsize=self.pipeline_depth)
+        failures = []
+        converter = Thread(target=self.convert_stage, args=(convert_queue, upload_queue, failures), daemon=True)
+        uploader = Thread(target=self.upload_stage, args=(upload_queue, fw_client, failures), daemon=True)
+        converter.start()
+        uploader.start()
+
+        def feed_pending():
+            # on their own thread, so sorting starts without waiting for the stages to take them
+            for series_dir in pending_conversion:
+                convert_queue.put(series_dir)
+            for item in pending_upload:
+                upload_queue.put(item)
+
+        feeder = Thread(target=feed_pending, daemon=True)
+        feeder.start()
+
+        sorted_members = set()
+        failed = []
+        try:
+            for series_dir, sorted_files in self.sort_series(dcm_paths, failed):
+                self.index.record_sorted(sorted_files)
+                sorted_members.update(path for path, _, _ in sorted_files)
+                if self.logger is not None:
+                    self.logger.info(f'sorted {len(sorted_files)} files into {series_dir}')
+                convert_queue.put(series_dir)
+        except Exception as e:
+            self.log_error(f'sort exception! {e}')
+        finally:
+            feeder.join()
+            convert_queue.put(None)
+            converter.join()
+            uploader.join()
+        for stage, e in failures:
+            self.log_error(f'{stage} exception! {e}')
+        # unreadable files are left alone until they change
+        self.index.record_failed(failed)
+        sorted_members.update(path for path, _ in failed)
+
+        # a zip is done when all of its members are
+        self.index.mark_sorted([zip_path for zip_path, members in zip_members.items()
+                                if all(member in sorted_members for member in members)])
+        return True
+
+    def check_flywheel_destination(self):
+        if self.flywheel_group is None or self.flywheel_project is None:
+            if self.logger is not None:
+                self.logger.error(f'flywheel_group and flywheel project must be defined!')
+            else:
+                print(f'flywheel_group and flywheel project must be defined!')
+            exit()
+
+    def move_series(self, fw_client, dicom_path, nii_path=None, replace_dicoms=False, replace_niftis=False):
+        # zip and upload one sorted series folder, and its NIfTI if it was converted
+        group = self.flywheel_group
+        project = self.flywheel_project
+        dicom_path = os.path.normpath(dicom_path)
+        subject = dicom_path.split(os.path.sep)[-3]
+        session = dicom_path.split(os.path.sep)[-2]
+
+        # dicoms
+        acquisition = get_fw_acquisition(fw_client, group, project, subject, session, os.path.basename(dicom_path).replace('.dicom.zip', '').replace(" ", '_'))
+
+        # make zip file
+        zip_path = f'{dicom_path.replace(" ", "_")}.dicom.zip'
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+        with ZipFile(zip_path, mode='x') as zip_file:
+            for usable_path in glob.glob(f'{dicom_path}/*.dcm'):
+                zip_file.write(usable_path, arcname=os.path.basename(usable_path))
+        if replace_dicoms:
+            acquisition.upload_file(zip_path)
+            if self.logger is not None:
+                self.logger.info(f'upload to {acquisition.label} {zip_path}')
+        # shutil.rmtree(dicom_path)
+        # try:
+        #     os.remove(zip_path)
+        # except Exception as e:
+        #     self.files_to_delete.append(zip_path)
+
+        # nifti
+        if nii_path is not None:
+            acquisition = get_fw_acquisition(fw_client, group, project, subject, session, os.path.basename(nii_path).replace(".nii.gz", '').replace(' ', '_'))
+
+            if replace_niftis:
+                acquisition.upload_file(nii_path)
+                if self.logger is not None:
+                    self.logger.info(f'upload to {acquisition.label} {nii_path}')
+            # try:
+            #     os.remove(nii_path)
+            # except Exception as e:
+            #     self.files_to_delete.append(nii_path)
 
+        self.index.record_moved(dicom_path)
+
+    @staticmethod
+    def uploadable_nii_path(series):
+        # the NIfTI to upload with a series row from the index, if it was selected and converted
+        nii_path = series['converted_path']
+        if series['selected'] and nii_path is not None and os.path.exists(nii_path):
+            return nii_path
+        return None
 
     def move(self, replace_dicoms=False, replace_niftis=False):
         fw_client = uwhealthaz_client()
 
         try:
-            dicom_paths = DicomSorter.get_unique_sorted_paths(self.sorted_folder)
-            nii_paths = DicomSorter.find_nii_in_folder(self.converted_folder)
-
-            if len(dicom_paths) == 0 and len(nii_paths) == 0:
+            # series not uploaded since they were last sorted into or converted
+            pending_series = self.index.series(moved=False)
+            if len(pending_series) == 0:
                 return
-            group = self.flywheel_group
-            project = self.flywheel_project
+            self.check_flywheel_destination()
 
-            if group is None or project is None:
-                if self.logger is not None:
-                    self.logger.error(f'flywheel_group and flywheel project must be defined!')
-                else:
-                    print(f'flywheel_group and flywheel project must be defined!')
-                exit()
-
-            if len(dicom_paths) > 0:
-                subject = dicom_paths[0].split(os.path.sep)[-3]
-                session = dicom_paths[0].split(os.path.sep)[-2]
-            else:
-                subject = nii_paths[0].split(os.path.sep)[-3]
-                session = nii_paths[0].split(os.path.sep)[-2]
-
-            # dicoms
-            for dicom_path in dicom_paths:
-                acquisition = get_fw_acquisition(fw_client, group, project, subject, session, os.path.basename(dicom_path).replace('.dicom.zip', '').replace(" ", '_'))
-
-                dicom_path = os.path.normpath(dicom_path)
-
-                # make zip file
-                zip_path = f'{dicom_path.replace(" ", "_")}.dicom.zip'
-                if os.path.exists(zip_path):
-                    os.remove(zip_path)
-                with ZipFile(zip_path, mode='x') as zip_file:
-                    for usable_path in glob.glob(f'{dicom_path}/*.dcm'):
-                        zip_file.write(usable_path, arcname=os.path.basename(usable_path))
-                zip_file.close()
-                if replace_dicoms:
-                    acquisition.upload_file(zip_path)
-                    print("upload to ", acquisition.label, zip_path)
-                # shutil.rmtree(dicom_path)
-                # try:
-                #     os.remove(zip_path)
-                # except Exception as e:
-                #     self.files_to_delete.append(zip_path)
-
-            # niftis
-            for nii_path in nii_paths:
-                acquisition = get_fw_acquisition(fw_client, group, project, subject, session, os.path.basename(nii_path).replace(".nii.gz", '').replace(' ', '_'))
-
-                if replace_niftis:
-                    acquisition.upload_file(nii_path)
-                    print("upload to ", acquisition.label, nii_path)
-                # try:
-                #     os.remove(nii_path)
-                # except Exception as e:
-                #     self.files_to_delete.append(nii_path)
+            for series in pending_series:
+                self.move_series(fw_client, series['series_dir'], self.uploadable_nii_path(series),
+                                 replace_dicoms, replace_niftis)
 
         except Exception as e:
             if self.logger is not None:
                 self.logger.info(f'move exception! {e}')
             time.sleep(2)
 
-
     @staticmethod
     def find_dcm_in_folder(folder):
         # use glob ** recursive
@@ -390,6 +819,18 @@ class DicomSorter:
         return files
 
 
+def convert_dicom_series(convert_path, nii_path):
+    # convert one sorted series folder to NIfTI, module level so it can run in a process pool
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(nii_path), exist_ok=True)
+    error = None
+    try:
+        dicom2nifti.dicom_series_to_nifti(convert_path, nii_path, reorient_nifti=True)
+    except ConversionError as e:
+        error = f'ConversionError {e}'
+    return convert_path, nii_path, error, time.perf_counter() - start
+
+
 def get_fw_acquisition(fw_client, group, project_label, subject_label, session_label, acquisition_label):
     try:
         project = fw_client.resolve(f'{group}/{project_label}')['path'][-1]
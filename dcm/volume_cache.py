@@ -0,0 +1,278 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import SimpleITK as sitk
+
+from radlib.dcm.readers import open_zip, split_zip_member_path
+
+# metadata values that were numpy arrays are stored as lists in the sidecar and turned back into arrays on load
+_array_keys = '_array_keys'
+
+
+def default_cache_dir() -> str:
+    return os.path.join(tempfile.gettempdir(), 'radlib_volume_cache')
+
+
+def file_checksums(paths: list, checksum: str = 'stat') -> list:
+    """
+    per-file fingerprints used to key cached volumes
+
+    Parameters
+    ----------
+    paths: list
+        the files a volume was decoded from, zip member paths (see readers.zip_member_path) are fingerprinted by
+        their archive's stat and the member name, or the member's stored CRC for "content"
+    checksum: str='stat'
+        "stat" for path, size and modification time (cheap, no reads), "content" for a hash of the file bytes
+
+    Returns
+    -------
+    a list of strings, in the same order as paths
+    """
+    if checksum == 'stat':
+        checksums = []
+        for path in paths:
+            zip_path, member = split_zip_member_path(path)
+            stat = os.stat(zip_path)
+            checksums.append(f'{os.path.abspath(zip_path)}|{member}|{stat.st_size}|{stat.st_mtime_ns}')
+        return checksums
+
+    if checksum == 'content':
+        checksums = []
+        for path in paths:
+            zip_path, member = split_zip_member_path(path)
+            if member is not None:
+                info = open_zip(zip_path).getinfo(member)
+                checksums.append(f'{member}|{info.file_size}|{info.CRC:08x}')
+                continue
+            digest = hashlib.sha1()
+            with open(path, 'rb') as dicom_file:
+                for block in iter(lambda: dicom_file.read(1 << 20), b''):
+                    digest.update(block)
+            checksums.append(digest.hexdigest())
+        return checksums
+
+    raise ValueError(f'unknown checksum {checksum}, use "stat" or "content"')
+
+
+class VolumeCache:
+    """
+    A scratch-directory cache of decoded volumes: each one is written once as a raw .npy array with a .json sidecar
+    holding its metadata (geometry etc), and mapped back read-only with np.load(mmap_mode='r') so later loads don't
+    decode or copy anything. Entries are keyed by SeriesInstanceUID and the checksums of the source files, and the
+    folder is kept under max_bytes by evicting the least recently used entries
+
+    """
+    def __init__(self, cache_dir=None, max_bytes=4 << 30, checksum='stat'):
+        self.cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+        self.max_bytes = max_bytes
+        self.checksum = checksum
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, paths: list, series_uid: str = None, variant: str = '') -> str:
+        """
+        key a volume by its series, its source files and how it was decoded
+
+        Parameters
+        ----------
+        paths: list
+            the files the volume is decoded from, in the order they are decoded
+        series_uid: str, optional, default None
+            the SeriesInstanceUID
+        variant: str=''
+            anything else the decoded array depends on (loader, dtype, resample, ...) so different decodings of the
+            same series don't collide
+
+        Returns
+        -------
+        a hex digest string
+        """
+        key = hashlib.sha1()
+        key.update(f'{series_uid}|{variant}'.encode())
+        for checksum in file_checksums(paths, self.checksum):
+            key.update(checksum.encode())
+        return key.hexdigest()
+
+    def array_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npy')
+
+    def metadata_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def __contains__(self, key):
+        return os.path.exists(self.array_path(key)) and os.path.exists(self.metadata_path(key))
+
+    def get(self, key):
+        """
+        map a cached volume
+
+        Parameters
+        ----------
+        key: str
+            from VolumeCache.key
+
+        Returns
+        -------
+        (read-only memory-mapped array, metadata dict), or None when not cached
+        """
+        try:
+            with open(self.metadata_path(key)) as metadata_file:
+                metadata = json.load(metadata_file)
+            volume = np.load(self.array_path(key), mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        # the array file's mtime is the last used time for LRU
+        os.utime(self.array_path(key))
+        for name in metadata.pop(_array_keys, []):
+            metadata[name] = np.array(metadata[name])
+        return volume, metadata
+
+    def put(self, key, volume: np.ndarray, metadata: dict = None):
+        """
+        write a volume (and its metadata) to the cache, then evict down to max_bytes
+
+        Parameters
+        ----------
+        key: str
+            from VolumeCache.key
+        volume: np.ndarray
+            the decoded volume
+        metadata: dict, optional, default None
+            json-able values or numpy arrays
+
+        Returns
+        -------
+        (read-only memory-mapped array, metadata dict) of the cached copy
+        """
+        metadata = {} if metadata is None else dict(metadata)
+        sidecar = {}
+        array_keys = []
+        for name, value in metadata.items():
+            if isinstance(value, np.ndarray):
+                array_keys.append(name)
+                value = value.tolist()
+            elif isinstance(value, tuple):
+                value = list(value)
+            sidecar[name] = value
+        sidecar[_array_keys] = array_keys
+
+        # write to temp names and move into place so readers never see partial files
+        array_path = self.array_path(key)
+        metadata_path = self.metadata_path(key)
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.npy', delete=False) as array_file:
+            np.save(array_file, np.ascontiguousarray(volume))
+        with tempfile.NamedTemporaryFile('w', dir=self.cache_dir, suffix='.json', delete=False) as metadata_file:
+            json.dump(sidecar, metadata_file)
+        os.replace(metadata_file.name, metadata_path)
+        os.replace(array_file.name, array_path)
+
+        self.evict(keep=key)
+        return np.load(array_path, mmap_mode='r'), metadata
+
+    def get_or_put(self, key, decode):
+        """
+        get a cached volume, or decode and cache it
+
+        Parameters
+        ----------
+        key: str
+            from VolumeCache.key
+        decode: callable
+            no-argument function returning (volume, metadata)
+
+        Returns
+        -------
+        (read-only memory-mapped array, metadata dict)
+        """
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        volume, metadata = decode()
+        return self.put(key, volume, metadata)
+
+    def entries(self):
+        # (last used, bytes, key) for every cached volume, oldest first
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy') or name.startswith('tmp'):
+                continue
+            key = name[:-4]
+            try:
+                stat = os.stat(self.array_path(key))
+            except FileNotFoundError:
+                continue
+            size = stat.st_size
+            if os.path.exists(self.metadata_path(key)):
+                size += os.path.getsize(self.metadata_path(key))
+            entries.append((stat.st_mtime_ns, size, key))
+        return sorted(entries)
+
+    def nbytes(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def remove(self, key):
+        for path in (self.array_path(key), self.metadata_path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, keep=None):
+        # drop least recently used volumes until within max_bytes, never the one just written
+        if self.max_bytes is None:
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        for _, _, key in self.entries():
+            self.remove(key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'bytes': self.nbytes()}
+
+
+def sitk_image_from_cache(volume, metadata):
+    """
+    rebuild an sitk Image from a volume cached in sitk (z, y, x) order with spacing/origin/direction metadata, see
+    VolumeCache. sitk needs its own buffer so this is the one copy made on a cache hit
+
+    Parameters
+    ----------
+    volume: np.ndarray
+        the cached (z, y, x) array
+    metadata: dict
+        with spacing, origin and direction
+
+    Returns
+    -------
+    an sitk Image
+    """
+    image_sitk = sitk.GetImageFromArray(np.asarray(volume))
+    image_sitk.SetSpacing([float(v) for v in metadata['spacing']])
+    image_sitk.SetOrigin([float(v) for v in metadata['origin']])
+    image_sitk.SetDirection([float(v) for v in metadata['direction']])
+    return image_sitk
@@ -0,0 +1,285 @@
+import collections
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel
+import nrrd
+import numpy as np
+
+# numpy dtype (without byte order) to Nrrd type
+nrrd_types = {
+    'i1': 'int8', 'u1': 'uint8', 'i2': 'int16', 'u2': 'uint16', 'i4': 'int32', 'u4': 'uint32',
+    'i8': 'int64', 'u8': 'uint64', 'f4': 'float', 'f8': 'double'
+}
+numpy_types = {nrrd_type: numpy_type for numpy_type, nrrd_type in nrrd_types.items()}
+
+# a slab is encoded this many bytes at a time, so a whole volume passed as one slab is never copied in one go
+slab_chunk_bytes = 64 << 20
+
+# Nrrd header fields in the order they are written, anything else goes after them as a key:=value field
+nrrd_field_order = ['type', 'dimension', 'space', 'sizes', 'space directions', 'kinds', 'endian', 'encoding',
+                    'space origin']
+
+
+def _nrrd_field_value(field: str, value) -> str:
+    if isinstance(value, str):
+        return value
+    if field == 'space directions':
+        return ' '.join(nrrd.format_vector(row) for row in np.asarray(value, dtype=np.float64))
+    if field == 'space origin':
+        return nrrd.format_vector(np.asarray(value, dtype=np.float64))
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return ' '.join(str(item) for item in value)
+    return str(value)
+
+
+def write_nrrd_header(nrrd_file, nrrd_header: dict):
+    """
+    write a Nrrd header (everything up to and including the blank line before the data) to an open binary file
+
+    Parameters
+    ----------
+    nrrd_file:
+        a file opened for binary writing
+    nrrd_header: dict
+        the header, as for nrrd.write
+    """
+    nrrd_file.write(b'NRRD0005\n')
+    nrrd_file.write(b'# Complete NRRD file format specification at:\n')
+    nrrd_file.write(b'# http://teem.sourceforge.net/nrrd/format.html\n')
+    fields = [field for field in nrrd_field_order if field in nrrd_header]
+    for field in fields:
+        nrrd_file.write(f'{field}: {_nrrd_field_value(field, nrrd_header[field])}\n'.encode('ascii'))
+    for field, value in nrrd_header.items():
+        if field not in fields:
+            nrrd_file.write(f'{field}:={_nrrd_field_value(field, value)}\n'.encode('ascii'))
+    nrrd_file.write(b'\n')
+
+
+def default_compression_workers() -> int:
+    """
+    number of threads to compress with, deflate is cpu bound so one per core
+
+    Returns
+    -------
+    thread count
+    """
+    return os.cpu_count() or 1
+
+
+def _deflate_block(block: bytes, zdict: bytes, compression_level: int, last: bool) -> bytes:
+    # raw deflate of one block, ending on a byte boundary (sync flush) so blocks can simply be concatenated
+    if len(zdict) > 0:
+        compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter:
+    """
+    A write-only gzip stream that compresses fixed size blocks on a thread pool, the way pigz does: each block is
+    deflated on its own, primed with the 32 KiB before it, and ends on a byte boundary, so the compressed blocks just
+    concatenate into one ordinary gzip member. zlib releases the GIL while compressing so the threads run in parallel,
+    and at most a couple of blocks per thread are in flight so memory stays bounded
+
+    """
+    def __init__(self, file, compression_level=9, workers=None, block_size=1 << 20):
+        self.file = file
+        self.compression_level = compression_level
+        self.block_size = block_size
+        self.workers = default_compression_workers() if workers is None else max(1, workers)
+        self.executor = ThreadPoolExecutor(self.workers)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.zdict = b''
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+
+        # gzip header: deflate, no name, no mtime, unknown os
+        self.file.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(wait=True)
+
+    def _submit(self, block: bytes, last: bool):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(self.executor.submit(_deflate_block, block, self.zdict, self.compression_level, last))
+        self.zdict = block[-32768:]
+        # write finished blocks in order, waiting on the oldest when too many are in flight
+        while len(self.pending) > 0 and (self.pending[0].done() or len(self.pending) > 2 * self.workers):
+            self.file.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]), False)
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self._submit(bytes(self.buffer), True)
+        self.buffer = bytearray()
+        while len(self.pending) > 0:
+            self.file.write(self.pending.popleft().result())
+        self.executor.shutdown(wait=True)
+        # gzip trailer: crc32 and size mod 2^32 of the uncompressed data
+        self.file.write(struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+        self.closed = True
+
+
+def _write_slabs(data_file, slabs, dtype) -> int:
+    # Fortran-order bytes of each (x, y, k) slab, in pieces of about slab_chunk_bytes
+    voxels = 0
+    for slab in slabs:
+        slab = np.asarray(slab, dtype=dtype)
+        voxels += slab.size
+        step = max(1, slab_chunk_bytes // max(1, slab[..., :1].nbytes))
+        for start in range(0, slab.shape[-1], step):
+            # volume data is in Fortran order, so a slab of whole slices is one contiguous run of the file
+            data_file.write(slab[..., start:start + step].tobytes(order='F'))
+    return voxels
+
+
+def write_nrrd_slabs(file_path: str, nrrd_header: dict, slabs, compression_level: int = 9, workers: int = None) -> int:
+    """
+    write a Nrrd file from slabs of the volume, so the whole volume never has to be in memory: the header goes out
+    first and each slab is encoded and written as it arrives, gzip blocks are compressed in parallel
+
+    Parameters
+    ----------
+    file_path: str
+        the Nrrd file to write
+    nrrd_header: dict
+        the header, as for nrrd.write. sizes/type must describe the whole volume, encoding is "gzip" (default) or
+        "raw"
+    slabs: iterable
+        (sizes[0], sizes[1], k) arrays along the last axis in order, eg from a generator
+    compression_level: int=9
+        the gzip level, as nrrd.write
+    workers: int, optional, default None
+        number of compression threads (default: default_compression_workers())
+
+    Returns
+    -------
+    the number of voxels written
+    """
+    encoding = nrrd_header.get('encoding', 'gzip')
+    if encoding not in ['gzip', 'gz', 'raw']:
+        raise ValueError(f'unsupported encoding {encoding} for streaming, use gzip or raw')
+    dtype = None
+    if nrrd_header.get('type') in numpy_types:
+        dtype = np.dtype(numpy_types[nrrd_header['type']])
+        dtype = dtype.newbyteorder('>' if nrrd_header.get('endian') == 'big' else '<')
+
+    with open(file_path, 'wb') as nrrd_file:
+        write_nrrd_header(nrrd_file, nrrd_header)
+        if encoding == 'raw':
+            return _write_slabs(nrrd_file, slabs, dtype)
+        with ParallelGzipWriter(nrrd_file, compression_level, workers) as gzip_file:
+            return _write_slabs(gzip_file, slabs, dtype)
+
+
+def nrrd_header_affine(nrrd_header: dict) -> np.ndarray:
+    """
+    the NIfTI (RAS) voxel to world affine for a Nrrd header in left-posterior-superior space
+
+    Parameters
+    ----------
+    nrrd_header: dict
+        with space directions (one row per axis) and space origin
+
+    Returns
+    -------
+    a 4x4 array
+    """
+    affine = np.eye(4)
+    affine[:3, :3] = np.asarray(nrrd_header['space directions'], dtype=np.float64).T
+    affine[:3, 3] = np.asarray(nrrd_header['space origin'], dtype=np.float64)
+    # LPS to RAS
+    return np.diag([-1., -1., 1., 1.]) @ affine
+
+
+def write_nifti_slabs(file_path: str, shape, dtype, affine: np.ndarray, slabs, compression_level: int = 6,
+                      workers: int = None) -> int:
+    """
+    write a NIfTI-1 file from slabs of the volume, as write_nrrd_slabs. The file is gzipped (in parallel) when the
+    path ends in .gz
+
+    Parameters
+    ----------
+    file_path: str
+        the .nii or .nii.gz file to write
+    shape: tuple
+        the shape of the whole volume
+    dtype:
+        the voxel data type
+    affine: np.ndarray
+        4x4 voxel to RAS world transform, see nrrd_header_affine
+    slabs: iterable
+        (shape[0], shape[1], k) arrays along the last axis in order
+    compression_level: int=6
+        the gzip level
+    workers: int, optional, default None
+        number of compression threads (default: default_compression_workers())
+
+    Returns
+    -------
+    the number of voxels written
+    """
+    dtype = np.dtype(dtype).newbyteorder('<')
+    header = nibabel.Nifti1Header()
+    header.set_data_shape(tuple(int(size) for size in shape))
+    header.set_data_dtype(dtype)
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    header.set_xyzt_units('mm')
+    # single file (n+1): the voxels follow the 348 byte header and the 4 byte extension flag that write_to writes,
+    # readers other than nibabel take vox_offset literally and 0 would point them into the header
+    header['vox_offset'] = 352
+
+    with open(file_path, 'wb') as nifti_file:
+        if not file_path.endswith('.gz'):
+            header.write_to(nifti_file)
+            return _write_slabs(nifti_file, slabs, dtype)
+        with ParallelGzipWriter(nifti_file, compression_level, workers) as gzip_file:
+            header.write_to(gzip_file)
+            return _write_slabs(gzip_file, slabs, dtype)
+
+
+def write_volume_slabs(file_path: str, nrrd_header: dict, slabs, workers: int = None) -> int:
+    """
+    write slabs of a volume described by a Nrrd header to a Nrrd file, or a NIfTI file when the path ends in .nii or
+    .nii.gz
+
+    Parameters
+    ----------
+    file_path: str
+        the file to write
+    nrrd_header: dict
+        the header, as for write_nrrd_slabs
+    slabs: iterable
+        (sizes[0], sizes[1], k) arrays along the last axis in order
+    workers: int, optional, default None
+        number of compression threads (default: default_compression_workers())
+
+    Returns
+    -------
+    the number of voxels written
+    """
+    if file_path.endswith('.nii') or file_path.endswith('.nii.gz'):
+        return write_nifti_slabs(file_path, nrrd_header['sizes'], numpy_types[nrrd_header['type']],
+                                 nrrd_header_affine(nrrd_header), slabs, workers=workers)
+    return write_nrrd_slabs(file_path, nrrd_header, slabs, workers=workers)
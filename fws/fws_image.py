@@ -5,11 +5,15 @@ from enum import Enum
 from zipfile import ZipFile
 import SimpleITK as sitk
 import flywheel
-import pydicom
 import dicom2nifti
 from flywheel import ApiException
 from zipp.glob import separate
 
+from radlib.dcm.readers import scan_dicom_headers, sort_dicom_slices, read_dicom_files, read_dicom_bytes, \
+    is_zip_member_path, sitk_image_from_datasets, ZipDicomArchive
+from radlib.dcm.volume_cache import sitk_image_from_cache
+from radlib.dcm.bridges import sitk_to_pydicom_series, pydicom_to_sitk, dataset_bytes
+
 
 # from radlib.fw.flywheel_data import load_image_from_flywheel, load_image_from_local_path
 
@@ -58,6 +62,8 @@ class FWSImageFile:
 
         self.image_store = None
 
+        # in-memory DICOM slices from convert_image_to_dicom, saved by save_image
+        self.dicom_datasets = None
 
     def file_name(self):
         if self.fw_client is not None:
@@ -123,8 +129,7 @@ class FWSImageFile:
 
         return None
 
-    def load_image(self, image_type: FWSImageType = FWSImageType.sitk, force_reload=False):
-        image = None
+    def load_image(self, image_type: FWSImageType = FWSImageType.sitk, force_reload=False, cache=None):
 
         # 202503 csk made this on demand
         if self.usable_paths is None:
@@ -135,21 +140,42 @@ class FWSImageFile:
             return self.image_store
 
         if image_type == FWSImageType.sitk:
+            # decoded DICOM series can come from a volume_cache.VolumeCache instead of being read again
+            key = None
+            if cache is not None and FWSImageFile.fws_is_dcm_file(self.usable_paths[0]):
+                key = cache.key(self.usable_paths, variant='sitk')
+                cached = cache.get(key)
+                if cached is not None:
+                    self.image_store = sitk_image_from_cache(*cached)
+                    return self.image_store
+
             # TODO: 202503 csk something better than hiding the warning when there are missing slices?
             sitk.ProcessObject_SetGlobalWarningDisplay(False)
-            self.image_store = sitk.ReadImage(self.usable_paths)
+            if is_zip_member_path(self.usable_paths[0]):
+                # slices inside a zip archive are read in memory, see readers.sitk_image_from_datasets
+                self.image_store = sitk_image_from_datasets(read_dicom_files(self.usable_paths))
+            else:
+                self.image_store = sitk.ReadImage(self.usable_paths)
             sitk.ProcessObject_SetGlobalWarningDisplay(True)
 
+            if key is not None:
+                cache.put(key, sitk.GetArrayViewFromImage(self.image_store),
+                          {'spacing': self.image_store.GetSpacing(),
+                           'origin': self.image_store.GetOrigin(),
+                           'direction': self.image_store.GetDirection(),
+                           'size': self.image_store.GetSize()})
+
         elif image_type == FWSImageType.pydicom:
-            image = []
-            for path in self.usable_paths:
-                image.append(pydicom.dcmread(path))
-            self.image_store = image
+            self.image_store = read_dicom_files(self.usable_paths)
 
         elif image_type == FWSImageType.nii:
-            series_path = os.path.dirname(self.usable_paths[0])
             nifti_path = f'{tempfile.mkdtemp()}{os.path.sep}file.nii.gz'
-            self.image_store = dicom2nifti.dicom_series_to_nifti(series_path, nifti_path, reorient_nifti=True)
+            if is_zip_member_path(self.usable_paths[0]):
+                self.image_store = dicom2nifti.dicom_array_to_nifti(read_dicom_files(self.usable_paths), nifti_path,
+                                                                    reorient_nifti=True)
+            else:
+                series_path = os.path.dirname(self.usable_paths[0])
+                self.image_store = dicom2nifti.dicom_series_to_nifti(series_path, nifti_path, reorient_nifti=True)
 
         elif image_type == FWSImageType.tif:
             self.image_store = sitk.ReadImage(self.usable_paths[0])
@@ -166,11 +192,13 @@ class FWSImageFile:
         # make it easier and more intuitive for everyone to use!
 
         # 202503 csk made this on demand
-        if self.usable_paths is None:
+        # slices converted in memory (see convert_image_to_dicom) have no files to find
+        in_memory = type is FWSImageType.pydicom and self.dicom_datasets is not None
+        if self.usable_paths is None and not in_memory:
             self.usable_paths = self.generate_usable_paths()
 
         # make sure (local) usable paths is set
-        if len(self.usable_paths) == 0:
+        if not in_memory and len(self.usable_paths) == 0:
             self.usable_paths = self.generate_usable_paths()
 
         # root output file path: use force_local_path, or find a temp place for it before pushing to flywheel
@@ -185,14 +213,24 @@ class FWSImageFile:
                 local_path = f'{local_path}.zip'
 
             with ZipFile(local_path, mode='x') as zip_file:
-                for usable_path in self.usable_paths:
-                    zip_file.write(usable_path, arcname=os.path.basename(usable_path))
+                if in_memory:
+                    for dicom_dataset in self.dicom_datasets:
+                        zip_file.writestr(f'{dicom_dataset.SOPInstanceUID}.dcm', dataset_bytes(dicom_dataset))
+                else:
+                    for usable_path in self.usable_paths:
+                        if is_zip_member_path(usable_path):
+                            zip_file.writestr(os.path.basename(usable_path), read_dicom_bytes(usable_path))
+                        else:
+                            zip_file.write(usable_path, arcname=os.path.basename(usable_path))
 
         if type is FWSImageType.nii:
             # save to nii file
             if not local_path.endswith('.nii.gz'):
                 local_path = f'{local_path}.nii.gz'
-            dicom2nifti.dicom_series_to_nifti(os.path.dirname(self.usable_paths[0]), local_path)
+            if is_zip_member_path(self.usable_paths[0]):
+                dicom2nifti.dicom_array_to_nifti(read_dicom_files(self.usable_paths), local_path)
+            else:
+                dicom2nifti.dicom_series_to_nifti(os.path.dirname(self.usable_paths[0]), local_path)
 
         # upload to flywheel
         if force_local_path is None and self.fw_client is not None:
@@ -222,11 +260,9 @@ class FWSImageFile:
         if len(usable_paths) > 1 and usable_paths[0].endswith('.dcm'):
             # make sure these are sorted by z position fo correct reconstructuin!
             # do it now so we don't have to think about it later
-            z_positions = []
-            for usable_path in usable_paths:
-                dcm = pydicom.dcmread(usable_path, stop_before_pixels=True)
-                z_positions.append(dcm.ImagePositionPatient[2])
-            usable_paths = [x for _, x in sorted(zip(z_positions, usable_paths), key=lambda pair: pair[0])]
+            # header-only scan in parallel, see readers.scan_dicom_headers
+            headers = sort_dicom_slices(scan_dicom_headers(usable_paths, skip_invalid=False))
+            usable_paths = [header.filename for header in headers]
 
         return usable_paths
 
@@ -268,19 +304,10 @@ class FWSImageFile:
     @staticmethod
     def get_paths_from_local(local_path):
         # given the path to a file, whether "real" or "temp", get the list of paths to slices included in it
-        zip_dir = tempfile.mkdtemp()
-        extract_name = os.path.basename(local_path).replace('.zip', '')
-        # print("get_paths_from_local", local_path, zip_dir)
         if local_path.endswith('.zip'):
-            # save slices to a temp directory
-            with ZipFile(local_path) as zip_file:
-                zip_file.extractall(zip_dir)
-
-            # TODO 202503 csk look into this: sometimes unzips with extract name, sometimes does not.
-            # does this come from the existing zip file archname???
-            # paths = glob.glob(f'{zip_dir}/{extract_name}/*.dcm')
-            paths = glob.glob(f'{zip_dir}{os.path.sep}*.dcm')
-            return paths
+            # address the slices inside the archive instead of extracting it, see readers.ZipDicomArchive
+            with ZipDicomArchive(local_path) as archive:
+                return archive.paths('*.dcm')
 
         elif FWSImageFile.fws_is_image_file(local_path):
             return [local_path]
@@ -288,12 +315,10 @@ class FWSImageFile:
             return glob.glob(f'{local_path}{os.path.sep}*')
 
     def convert_image_to_dicom(self):
-        if self.local_path is not None:
-            self.local_path = f'{os.path.splitext(self.local_path)[0]}.dcm'
-        else:
-            self.local_path = f'{tempfile.mkdtemp()}{os.path.sep}{os.path.splitext(self.file_name())[0]}.dcm'
-        sitk.WriteImage(self.image_store, self.local_path)
-        self.image_store = sitk.ReadImage(self.local_path)
+        # convert in memory, save_image writes the slices out. local_path still points at the source, no .dcm file
+        # is written here
+        self.dicom_datasets = sitk_to_pydicom_series(self.image_store)
+        self.image_store = pydicom_to_sitk(self.dicom_datasets)
 
         return self.image_store
 
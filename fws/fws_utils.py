@@ -1,9 +1,7 @@
 import glob
 import os
 import shutil
-import tempfile
 import time
-import zipfile
 from pathlib import Path
 import re
 
@@ -12,6 +10,7 @@ import pydicom
 
 from radlib.fw.flywheel_clients import uwhealthaz_client
 from radlib.fw.flywheel_data import load_image_from_flywheel, load_image_from_local_path
+from radlib.dcm.readers import ZipDicomArchive
 
 # constants for the names and classes of the flywheel object hierarchy
 fw_types = ['group', 'project', 'subject', 'session', 'acquisition', 'file']
@@ -1077,10 +1076,9 @@ def fws_flywheel_glob(path, fw_client=None):
 def fws_expand_path(path):
     if not path.endswith('.dicom.zip'):
         return [path]
-    with zipfile.ZipFile(path, 'r') as zip_ref:
-        zip_path = tempfile.mkdtemp()
-        zip_ref.extractall(f'{zip_path}')
-        return glob.glob(f'{zip_path}/**/*.dcm', recursive=True)
+    # zip member paths instead of extracting, see readers.ZipDicomArchive
+    with ZipDicomArchive(path) as archive:
+        return archive.paths('*.dcm')
 
 
 import sys, inspect
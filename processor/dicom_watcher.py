@@ -2,24 +2,22 @@ import glob
 import os
 import shutil
 import sys
-import tempfile
 import time
-import logging
+import threading
 import zipfile
-import pydicom
 
 import yaml
 
 import flywheel
-from nibabel.dft import pydicom
 
 sys.path.append('/home/aa-cxk023/share/radlib')
 from radlib.dcm.sorter import DicomSorter
+from radlib.dcm.readers import ZipDicomArchive, read_dicom_file
 
 root_path = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 sys.path.append(root_path)
-from radlib.fw.flywheel_clients import uwhealthaz_client
 from radlib.processor.processor import Processor
+from radlib.processor.watcher import Watcher
 from radlib.fws.fws_utils import fws_is_flywheel_path, fws_has_more_scripts, fws_get_next_script, fws_resolve_object, \
     fws_expand_path, fws_add_script
 
@@ -29,14 +27,159 @@ from radlib.processors.rrs_radsurv_processor.processor_app import RrsRadsurvProc
 class DicomlWatcherException(Exception):
     pass
 
+
+# header elements that say how many images an acquisition should have
+expected_count_tags = ['ImagesInAcquisition', 'NumberOfSlices']
+
+
+class FolderArrival:
+    """
+    What has arrived so far in one watched folder: every file with its size and mtime and, for DICOM files, the
+    series/acquisition it belongs to, so the folder can be declared complete as soon as it is rather than after a fixed
+    wait. A folder is ready when
+
+    - every acquisition has as many files as its headers say it should (ImagesInAcquisition or NumberOfSlices), every
+      zip archive is whole and nothing changed for settle_seconds, or
+    - nothing changed for quiet_seconds (acquisitions without an expected count, or that never fill up)
+
+    Headers are read once per file (and again only if the file changes), so rescanning a folder is a stat per file
+
+    """
+    def __init__(self, folder, quiet_seconds=15.0, settle_seconds=2.0):
+        self.folder = folder
+        self.quiet_seconds = quiet_seconds
+        self.settle_seconds = settle_seconds
+        # path: (size, mtime_ns) of every file
+        self.files = {}
+        # path: header of DICOM files read so far, path: acquisition key
+        self.headers = {}
+        self.acquisitions = {}
+        # DICOM files and zips not read yet, or that could not be read yet (still being written)
+        self.pending = set()
+        self.changed_at = time.monotonic()
+        # set once the folder was handed on, so it isn't handed on again unless it changes
+        self.processed = False
+
+    @staticmethod
+    def is_dicom_path(path):
+        return path.endswith('.dcm') or path.endswith('.dicom.zip')
+
+    def scan(self) -> bool:
+        """
+        stat the folder's files, and read the headers of new or changed DICOM files
+
+        Returns
+        -------
+        whether anything changed since the last scan
+        """
+        current = {}
+        for root, _, names in os.walk(self.folder):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                current[path] = (stat.st_size, stat.st_mtime_ns)
+
+        changed = current != self.files
+        if changed:
+            for path in self.files.keys() - current.keys():
+                self.forget(path)
+            for path, state in current.items():
+                if self.files.get(path) != state:
+                    self.forget(path)
+                    if self.is_dicom_path(path):
+                        self.pending.add(path)
+            self.files = current
+            self.changed_at = time.monotonic()
+            self.processed = False
+
+        for path in list(self.pending):
+            self.read(path)
+        return changed
+
+    def forget(self, path):
+        self.headers.pop(path, None)
+        self.acquisitions.pop(path, None)
+        self.pending.discard(path)
+
+    def read(self, path):
+        # a file that can't be read yet stays pending and is tried again on the next scan
+        try:
+            if path.endswith('.zip'):
+                # a zip is whole once its central directory (written last) is there
+                if zipfile.is_zipfile(path):
+                    self.pending.discard(path)
+                return
+            header = read_dicom_file(path, stop_before_pixels=True)
+        except Exception:
+            return
+        self.headers[path] = header
+        self.acquisitions[path] = (str(header.get('SeriesInstanceUID', '')), str(header.get('AcquisitionNumber', '')))
+        self.pending.discard(path)
+
+    def expected_counts(self) -> dict:
+        # acquisition key: expected number of files, None when the headers don't say
+        expected = {}
+        for path, key in self.acquisitions.items():
+            if expected.get(key) is None:
+                header = self.headers[path]
+                expected[key] = next((int(header.get(tag)) for tag in expected_count_tags
+                                      if header.get(tag) not in [None, '']), None)
+        return expected
+
+    def is_complete(self) -> bool:
+        # every file read and every acquisition at its expected count
+        if len(self.pending) > 0 or len(self.headers) == 0:
+            return False
+        counts = {}
+        for key in self.acquisitions.values():
+            counts[key] = counts.get(key, 0) + 1
+        return all(expected is not None and counts[key] >= expected
+                   for key, expected in self.expected_counts().items())
+
+    def is_ready(self) -> bool:
+        """
+        whether the folder is done arriving, see the class description
+
+        Returns
+        -------
+        bool
+        """
+        if len(self.files) == 0 or self.processed:
+            return False
+        quiet = time.monotonic() - self.changed_at
+        if quiet >= self.quiet_seconds:
+            return True
+        return quiet >= self.settle_seconds and self.is_complete()
+
+    def first_header(self):
+        # a header from the folder, for its patient and study
+        if len(self.headers) > 0:
+            return self.headers[sorted(self.headers)[0]]
+        for path in sorted(self.files):
+            if path.endswith('.dicom.zip'):
+                with ZipDicomArchive(path) as archive:
+                    return archive.read(archive.members('*')[0], stop_before_pixels=True)
+        raise DicomlWatcherException(f'no DICOM files in {self.folder}')
+
 # TODO: 202507 csk add
-class DicomWatcher():
-    def __init__(self, config_path, scratch_path=None):
-        self.config = DicomWatcher.load_config(config_path)
-        self.scratch_path = tempfile.mkdtemp() if scratch_path is None else scratch_path
-        self.watch_log_path = f'{self.scratch_path}/{self.watch_name()}.log'
-        self.active = True
-        self.fw_client = uwhealthaz_client()
+class DicomWatcher(Watcher):
+    # watches folders DICOM is pushed into on the Watcher runtime: every watched path is an area, each folder under it
+    # is an item once it has finished arriving (see FolderArrival), and up to max_concurrent folders are processed at
+    # a time
+    def __init__(self, config_path, scratch_path=None, fw_client=None):
+        super().__init__(DicomWatcher.load_config(config_path) if isinstance(config_path, str) else config_path,
+                         scratch_path, fw_client)
+
+        # folders are handed on as soon as they are complete (see FolderArrival), several at a time
+        self.poll_seconds = self.config.get('poll_seconds', 1.0)
+        self.quiet_seconds = self.config.get('quiet_seconds', 15.0)
+        self.settle_seconds = self.config.get('settle_seconds', 2.0)
+        self.max_concurrent = self.config.get('max_concurrent', 4)
+        self.arrivals = {}
+        self.arrivals_lock = threading.Lock()
 
     @staticmethod
     def load_config(config_path):
@@ -55,102 +198,158 @@ class DicomWatcher():
             new_paths.extend(fws_expand_path(dicom_path))
         return new_paths
 
-    def watch(self):
-        # csk need to get the logger again when run in a separate process!
-        self.logger = logging.getLogger(self.watch_name())
-        print(">>>>>dicom watcher logger! named ", self.watch_name(), "path", self.watch_log_path)
-        logging.basicConfig(
-            filename=self.watch_log_path,
-            format='%(asctime)s %(levelname)-8s %(message)s',
-            level=logging.INFO,
-            datefmt='%Y-%m-%d %H:%M:%S')
+    def watched_areas(self):
+        return self.config.get('paths', [])
+
+    def area_root(self, area):
+        return area
 
+    def area_concurrency(self, area):
+        return self.max_concurrent
+
+    def item_key(self, arrival):
+        return arrival.folder
+
+    def items_for_area(self, area):
+        return self.ready_folders(area, None)
+
+    def items_for_events(self, area, events):
+        # quiet areas are still checked, folders become ready by staying unchanged
+        return self.ready_folders(area, self.changed_folders(area, events))
+
+    def changed_folders(self, area, events):
+        # the arriving (top level) folders events are in, None when everything has to be rescanned
+        root = os.path.normpath(area)
+        folders = set()
+        for event in events:
+            if event.path == root and event.kind == 'overflow':
+                return None
+            if event.path.startswith(root + os.sep):
+                folders.add(os.path.join(root, event.path[len(root) + 1:].split(os.sep)[0]))
+        return folders
+
+    def ready_folders(self, area, changed=None):
+        """
+        rescan the arriving folders of a watched path that changed, and find the ones that are ready
+
+        Parameters
+        ----------
+        area: str
+            the watched path
+        changed: set, optional, default None
+            the folders that changed since the last look, None rescans every folder under the path
+
+        Returns
+        -------
+        a list of FolderArrivals that are ready, each is returned once (unless it changes again)
+        """
+        if changed is None:
+            changed = set(glob.glob(f'{area}/*'))
+        in_flight = self.in_flight.get(self.area_name(area), {})
+        with self.arrivals_lock:
+            for folder in sorted(changed):
+                if folder in in_flight:
+                    continue
+                if not os.path.isdir(folder):
+                    self.arrivals.pop(folder, None)
+                    continue
+                arrival = self.arrivals.get(folder)
+                if arrival is None:
+                    arrival = FolderArrival(folder, self.quiet_seconds, self.settle_seconds)
+                    self.arrivals[folder] = arrival
+                    self.logger.info(f'new folder {folder}')
+                arrival.scan()
+
+            ready = []
+            root = os.path.normpath(area)
+            for folder, arrival in self.arrivals.items():
+                if os.path.dirname(folder) == root and folder not in in_flight and arrival.is_ready():
+                    self.logger.info(f'folder ready {folder}: {len(arrival.files)} files, '
+                                     f'{"complete" if arrival.is_complete() else "quiet"}')
+                    arrival.processed = True
+                    ready.append(arrival)
+        return ready
+
+    def process_item(self, arrival):
+        self.process_folder(arrival)
+
+    def item_done(self, area, arrival, error=None):
+        # a failed folder is kept (and not retried) until its contents change
+        if error is None:
+            with self.arrivals_lock:
+                self.arrivals.pop(arrival.folder, None)
+        else:
+            self.logger.error(f'could not process {arrival.folder}: {error}')
+            print("exception", error)
+
+    def process_folder(self, arrival):
+        """
+        submit a processor script for a folder that has finished arriving, wait for it to run and remove the folder
+
+        Parameters
+        ----------
+        arrival: FolderArrival
+            the folder
+        """
         base_image = 'rrs_radsurv'
-        scripts_label = 'scripts'
         active_fw_name = f'{base_image}_{time.time()}'
         active_label = 'active'
         active_script_label = 'active_script_name'
 
-        while self.active:
-            # for each path being watched
-            for path_def in self.config.get('paths', []):
-                watch_path = f'{path_def}/*'
-                print(f"watch path {watch_path}")
-                new_folders = glob.glob(watch_path)
-
-                group_id = 'idia_group'
-                project_label = 'idia_brain_segmentation'
-
-                if len(new_folders) > 0:
-                    new_folder = new_folders[0]
-                    print("new_folder!", new_folder)
-                    time.sleep(30)
-                    # get first actual dcm file
-                    print("folder:", new_folders[0])
-                    files = glob.glob(f'{new_folders[0]}/**/*.dcm', recursive=True)
-                    if len(files) == 0:
-                        files = glob.glob(f'{new_folders[0]}/**/*.dicom.zip', recursive=True)
-                    dicom_path = files[0]
-                    if dicom_path.endswith('.zip'):
-                        with tempfile.TemporaryDirectory() as temp_path:
-                            with zipfile.ZipFile(dicom_path) as zip:
-                                zip.extractall(temp_path)
-                                dicom_path = glob.glob(f'{temp_path}/*')[0]
-                                dcm = pydicom.dcmread(dicom_path)
-                    else:
-                        dcm = pydicom.dcmread(dicom_path)
-
-                    subject_label = dcm.PatientID  # '<SUBJECT>'
-                    session_label = dcm.StudyDate.replace(' ', '_')  # '<SESSION>'
-                    print(f'>>>>>found [{subject_label}] [{session_label}]')
-
-                    script_info = {
-                        'base_image': base_image,
-                        'active_fw_name': active_fw_name,
-                        'filesets': {
-                            'dicom_raw': f'{new_folder}/*',
-                            'dicom_sorted': f'fw://{group_id}/{project_label}/{subject_label}/{session_label}/*/*.dicom.zip',
-                            'nifti_raw': f'fw://{group_id}/{project_label}/{subject_label}/{session_label}/*/*.nii.gz',
-                            'preprocessed': f'fw://{group_id}/{project_label}/{subject_label}/{session_label}/preprocessed/*',
-                            'nifti_raw_modalities_niiQuery.csv': '/home/aa-cxk023/share/files/nifti_raw_modalities_niiQuery.csv'
-                        }
-                    }
-
-                    try:
-                        # Get the analysis container object from Flywheel where the processor will look for scripts:
-                        analysis = \
-                        self.fw_client.resolve(f'{group_id}/{project_label}/analyses/{script_info["base_image"]}')['path'][-1]
-
-                        # submit the script
-                        print("add script!")
-                        print(analysis.label)
-                        print(script_info)
-                        fws_add_script(analysis, script_info)
-
-                        # wait for the cript to run
-                        analysis = analysis.reload()
-                        active = analysis.info.get(active_label)
-                        if active:
-                            active_script = analysis.info.get(active_script_label)
-                            while active_script != active_fw_name:
-                                time.sleep(3)
-                                analysis = analysis.reload()
-                                active_script = analysis.info.get(active_script_label)
-
-                            while active_script == active_fw_name:
-                                time.sleep(3)
-                                analysis = analysis.reload()
-                                active_script = analysis.info.get(active_script_label)
-
-
-                    except Exception as e:
-                        print("exception", e)
-                        raise Exception(f'Not connected to a processor for {script_info["base_image"]}!')
-
-                    shutil.rmtree(new_folder)
-
-            # pause for a breath
-            time.sleep(3)
+        group_id = 'idia_group'
+        project_label = 'idia_brain_segmentation'
+
+        new_folder = arrival.folder
+        print("new_folder!", new_folder)
+        dcm = arrival.first_header()
+
+        subject_label = dcm.PatientID  # '<SUBJECT>'
+        session_label = dcm.StudyDate.replace(' ', '_')  # '<SESSION>'
+        print(f'>>>>>found [{subject_label}] [{session_label}]')
+
+        script_info = {
+            'base_image': base_image,
+            'active_fw_name': active_fw_name,
+            'filesets': {
+                'dicom_raw': f'{new_folder}/*',
+                'dicom_sorted': f'fw://{group_id}/{project_label}/{subject_label}/{session_label}/*/*.dicom.zip',
+                'nifti_raw': f'fw://{group_id}/{project_label}/{subject_label}/{session_label}/*/*.nii.gz',
+                'preprocessed': f'fw://{group_id}/{project_label}/{subject_label}/{session_label}/preprocessed/*',
+                'nifti_raw_modalities_niiQuery.csv': '/home/aa-cxk023/share/files/nifti_raw_modalities_niiQuery.csv'
+            }
+        }
+
+        try:
+            # Get the analysis container object from Flywheel where the processor will look for scripts:
+            analysis = \
+            self.fw_client.resolve(f'{group_id}/{project_label}/analyses/{script_info["base_image"]}')['path'][-1]
+
+            # submit the script
+            print("add script!")
+            print(analysis.label)
+            print(script_info)
+            fws_add_script(analysis, script_info)
+
+            # wait for the cript to run
+            analysis = analysis.reload()
+            active = analysis.info.get(active_label)
+            if active:
+                active_script = analysis.info.get(active_script_label)
+                while active_script != active_fw_name:
+                    time.sleep(3)
+                    analysis = analysis.reload()
+                    active_script = analysis.info.get(active_script_label)
+
+                while active_script == active_fw_name:
+                    time.sleep(3)
+                    analysis = analysis.reload()
+                    active_script = analysis.info.get(active_script_label)
+
+        except Exception as e:
+            print("exception", e)
+            raise Exception(f'Not connected to a processor for {script_info["base_image"]}!')
+
+        shutil.rmtree(new_folder)
 
 if __name__ == "__main__":
     # watcher = DicomWatcher("dicom_watcher_config.yaml", "z:/scratch")
@@ -1,8 +1,6 @@
 import os
 import sys
-import tempfile
 import time
-import logging
 from pprint import pprint
 
 import yaml
@@ -11,26 +9,27 @@ import flywheel
 
 root_path = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 sys.path.append(root_path)
-from radlib.fw.flywheel_clients import uwhealthaz_client
 from radlib.processor.processor import Processor
+from radlib.processor.watcher import Watcher
 from radlib.fws.fws_utils import fws_is_flywheel_path, fws_has_more_scripts, fws_get_next_script, fws_resolve_object
 
-from radlib.processors.rrs_radsurv_processor.processor_app import RrsRadsurvProcessor
-
 
 class FlywheelWatcherException(Exception):
     pass
 
 # TODO: 202507 csk add
-class FlywheelWatcher():
-    def __init__(self, config_path, scratch_path=None):
-        self.config = FlywheelWatcher.load_config(config_path)
-        self.scratch_path = tempfile.mkdtemp() if scratch_path is None else scratch_path
-        self.watch_log_path = f'{self.scratch_path}/{self.watch_name()}.log'
-        self.active = True
-        self.fw_client = uwhealthaz_client()
-
-        self.active_processors = {'rrs_radsurv_processor': RrsRadsurvProcessor, 'rrs_radsurv': RrsRadsurvProcessor}
+class FlywheelWatcher(Watcher):
+    # watches flywheel "processor analyses" for scripts on the Watcher runtime: every project is its own area, so a
+    # slow project doesn't hold up listing the others. Scripts are run one at a time: run_dockerized builds every
+    # script in the same docker_app folder and compose service (publishing the same port), and a project's analysis
+    # has a single active_script_name that submitters wait on. max_concurrent can be raised in the config for
+    # processors that don't run dockerized, a project still runs one script at a time
+    def __init__(self, config_path, scratch_path=None, fw_client=None, active_processors=None):
+        # analysis of each watched project, set up the first time the project is looked at
+        self.analyses = {}
+        super().__init__(FlywheelWatcher.load_config(config_path) if isinstance(config_path, str) else config_path,
+                         scratch_path, fw_client, active_processors)
+        self.max_concurrent = self.config.get('max_concurrent', 1)
 
     @staticmethod
     def load_config(config_path):
@@ -43,62 +42,76 @@ class FlywheelWatcher():
             return self.config.get('watch_name')
         return 'unnamed_watcher'
 
-    def watch(self):
-        # csk need to get the logger again when run in a separate process!
-        new_logger = logging.getLogger(self.watch_name())
-        print(">>>>>flywheel watcher logger! named ", self.watch_name(), "path", self.watch_log_path)
-        logging.basicConfig(
-            filename=self.watch_log_path,
-            format='%(asctime)s %(levelname)-8s %(message)s',
-            level=logging.INFO,
-            datefmt='%Y-%m-%d %H:%M:%S')
-
-        while self.active:
-            # for each project being watched
-            for project_def in self.config.get('projects', []):
-                watch_path = f'{project_def.get("group_label", "")}/{project_def.get("project_label", "")}/analyses/{project_def.get("analysis_label", "")}'
-                print(f"watch {watch_path}...")
-                # check for analysis, create if it does not exist
-                try:
-                    analysis = self.fw_client.resolve(f'{watch_path}')['path'][-1]
-                except Exception:
-                    # raise FlywheelWatcherException(f"analysis {watch_path} does not exist!")
-                    project = self.fw_client.resolve(f'{project_def.get("group_label", "")}/{project_def.get("project_label", "")}')['path'][-1]
-                    analysis = project.add_analysis(label=project_def.get("analysis_label"))
-
-                analysis = analysis.reload()
-                info = analysis.info
-                info['script_template'] = {}  #rrs_radsurv_template
-                info['active'] = True
+    def watched_areas(self):
+        return self.config.get('projects', [])
+
+    def area_name(self, project_def):
+        return f'{project_def.get("group_label", "")}/{project_def.get("project_label", "")}/analyses/{project_def.get("analysis_label", "")}'
+
+    def area_kind(self, project_def):
+        return 'flywheel'
+
+    def area_concurrency(self, project_def):
+        # one script per project, see active_script_name in process_item
+        return 1
+
+    def project_analysis(self, project_def):
+        watch_path = self.area_name(project_def)
+        analysis = self.analyses.get(watch_path)
+        if analysis is not None:
+            return analysis
+
+        # check for analysis, create if it does not exist
+        try:
+            analysis = self.fw_client.resolve(f'{watch_path}')['path'][-1]
+        except Exception:
+            # raise FlywheelWatcherException(f"analysis {watch_path} does not exist!")
+            project = self.fw_client.resolve(f'{project_def.get("group_label", "")}/{project_def.get("project_label", "")}')['path'][-1]
+            analysis = project.add_analysis(label=project_def.get("analysis_label"))
+
+        analysis = analysis.reload()
+        info = analysis.info
+        info['script_template'] = {}  #rrs_radsurv_template
+        info['active'] = True
+        analysis.update_info(info)
+        self.analyses[watch_path] = analysis
+        return analysis
+
+    def items_for_area(self, project_def):
+        # take as many scripts as the project has free slots for, the rest stay on flywheel
+        watch_path = self.area_name(project_def)
+        print(f"watch {watch_path}...")
+        analysis = self.project_analysis(project_def)
+        free = self.area_concurrency(project_def) - len(self.in_flight.get(watch_path, {}))
+        scripts = []
+        while len(scripts) < free and fws_has_more_scripts(analysis):
+            scripts.append((project_def, fws_get_next_script(analysis, remove=True)))
+        return scripts
+
+    def process_item(self, item):
+        project_def, script_info = item
+        try:
+            pprint(script_info)
+            analysis = self.project_analysis(project_def).reload()
+            info = analysis.info
+            # a script file each, scripts of different projects can run at the same time when max_concurrent is raised
+            script_path = f'{self.scratch_path}/script_{script_info.get("active_fw_name", time.time())}.yaml'
+            if script_info.get('active_fw_name') is not None:
+                info['active_script_name'] = script_info.get('active_fw_name')
                 analysis.update_info(info)
 
-                while fws_has_more_scripts(analysis):
-                    try:
-                        script_info = fws_get_next_script(analysis, remove=True)
-                        pprint(script_info)
-                        analysis = analysis.reload()
-                        info = analysis.info
-                        script_path = f'{self.scratch_path}/script.yaml'
-                        if script_info.get('active_fw_name') is not None:
-                            info['active_script_name'] = script_info.get('active_fw_name')
-                            analysis.update_info(info)
-
-                        Processor.save_script(script_info, script_path)
-                        processor = self.active_processors.get(script_info['base_image'])
-                        processor.run_processor(scratch_path=self.scratch_path, script_path=script_path)
-                        time.sleep(60)
-
-                        analysis = analysis.reload()
-                        info = analysis.info
-                        info['active_script_name'] = None
-                        analysis.update_info(info)
+            Processor.save_script(script_info, script_path)
+            processor = self.active_processors.get(script_info['base_image'])
+            processor.run_processor(scratch_path=self.scratch_path, script_path=script_path)
+            time.sleep(60)
 
-                    except OverflowError as e:
-                        print("Exception", e)
-                        continue
+            analysis = analysis.reload()
+            info = analysis.info
+            info['active_script_name'] = None
+            analysis.update_info(info)
 
-            # pause?
-            time.sleep(5)
+        except OverflowError as e:
+            print("Exception", e)
 
 
 def get_analysis(object, analysis_label):
@@ -117,5 +130,6 @@ def add_analysis(object, analysis_label):
         return get_analysis(object, analysis_label)
 
 
-watcher = FlywheelWatcher("flywheel_watcher_config.yaml", "/home/aa-cxk023/share/scratch")
-watcher.watch()
\ No newline at end of file
+if __name__ == "__main__":
+    watcher = FlywheelWatcher("flywheel_watcher_config.yaml", "/home/aa-cxk023/share/scratch")
+    watcher.watch()
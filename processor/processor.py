@@ -1,7 +1,11 @@
 import copy
 import glob
+import hashlib
 import os
 import re
+import signal
+import subprocess
+import sys
 import time
 import shutil
 import logging
@@ -13,6 +17,7 @@ from radlib.fw.flywheel_clients import uwhealthaz_client
 from radlib.fws.fws_fileset import FWSFileSet, FWSFileSetException
 from radlib.fws.fws_utils import (fws_create_paths, fws_expand_flywheel_path,
                                   fws_download_file_from_flywheel, fws_in_docker)
+from radlib.processor.watch_backend import watch_backend
 
 # templates for docker files
 
@@ -84,6 +89,235 @@ cd docker_app
 sudo docker compose up
 '''
 
+# worker mode: a long running processor pulls scripts from a local queue folder, so container startup and model loading
+# happen once rather than for every script. These are the files its build depends on, its build and compose files are
+# only written again (and the worker restarted) when a hash of them and of the generated files changes
+worker_source_files = ['processor_app.py', 'requirements.txt', 'UWHEALTHROOT.crt']
+
+worker_shell_script_template = '''
+cd {work_dir}
+sudo docker compose up -d
+'''
+
+# how long run_in_worker waits for a script (and for a busy worker to go idle before a restart) unless the script sets
+# worker_timeout
+worker_timeout = 6 * 60 * 60
+
+
+def enqueue_script(script_path: str, queue_path: str) -> str:
+    """
+    add a script to a worker queue folder, the copy appears under its final name in one step so a worker never sees
+    half a script
+
+    Parameters
+    ----------
+    script_path: str
+        the yaml script
+    queue_path: str
+        the queue folder
+
+    Returns
+    -------
+    the path of the queued script
+    """
+    os.makedirs(queue_path, exist_ok=True)
+    name = f'{time.time_ns()}_{os.path.basename(script_path)}'
+    if not name.endswith('.yaml'):
+        name = f'{name}.yaml'
+    temp_path = f'{queue_path}/.{name}.part'
+    shutil.copy(script_path, temp_path)
+    os.replace(temp_path, f'{queue_path}/{name}')
+    return f'{queue_path}/{name}'
+
+
+def claim_next_script(queue_path: str) -> str:
+    """
+    take the oldest script in a worker queue folder by moving it to the active folder, only one worker can move a
+    script. Nothing is claimed while the queue is paused (see pause_worker)
+
+    Parameters
+    ----------
+    queue_path: str
+        the queue folder
+
+    Returns
+    -------
+    the claimed script's path in the active folder, or None when the queue is empty
+    """
+    os.makedirs(f'{queue_path}/active', exist_ok=True)
+    if os.path.exists(f'{queue_path}/pause'):
+        return None
+    for script_path in sorted(glob.glob(f'{queue_path}/*.yaml')):
+        active_path = f'{queue_path}/active/{os.path.basename(script_path)}'
+        try:
+            os.rename(script_path, active_path)
+            return active_path
+        except FileNotFoundError:
+            # another worker got it first
+            continue
+    return None
+
+
+def requeue_active_scripts(queue_path: str) -> list:
+    """
+    put scripts left in the active folder (by a worker that was stopped or died while running them) back in the queue,
+    under their old names so they keep their place. Called when a worker starts, there is one worker per queue
+
+    Parameters
+    ----------
+    queue_path: str
+        the queue folder
+
+    Returns
+    -------
+    the requeued scripts' paths
+    """
+    requeued = []
+    for active_path in sorted(glob.glob(f'{queue_path}/active/*.yaml')):
+        script_path = f'{queue_path}/{os.path.basename(active_path)}'
+        os.rename(active_path, script_path)
+        requeued.append(script_path)
+    return requeued
+
+
+def pause_worker(queue_path: str, runtime, timeout: float = None) -> bool:
+    """
+    stop a worker between scripts: it takes no new scripts from a paused queue, so once its active folder is empty
+    it is idle and can be stopped without cutting a script short. The queue stays paused until resume_worker
+
+    Parameters
+    ----------
+    queue_path: str
+        the queue folder
+    runtime:
+        the worker's runtime, see worker_runtimes
+    timeout: float, optional, default None
+        most seconds to wait for the running script. When it doesn't finish in time the worker is stopped anyway, the
+        script is requeued when the worker starts again
+
+    Returns
+    -------
+    True when the worker was idle when it was stopped
+    """
+    os.makedirs(f'{queue_path}/active', exist_ok=True)
+    with open(f'{queue_path}/pause', 'w'):
+        pass
+    deadline = None if timeout is None else time.monotonic() + timeout
+    idle = True
+    with watch_backend([f'{queue_path}/active'], recursive=False) as backend:
+        while len(glob.glob(f'{queue_path}/active/*.yaml')) > 0 and runtime.is_running():
+            if deadline is not None and time.monotonic() >= deadline:
+                idle = False
+                break
+            backend.events(timeout=1)
+    runtime.stop()
+    return idle
+
+
+def resume_worker(queue_path: str):
+    if os.path.exists(f'{queue_path}/pause'):
+        os.remove(f'{queue_path}/pause')
+
+
+def script_status(queue_path: str, queued_path: str) -> str:
+    # "queued", "active", "finished" or "failed" for a script added by enqueue_script
+    name = os.path.basename(queued_path)
+    for status in ['finished', 'failed', 'active']:
+        if os.path.exists(f'{queue_path}/{status}/{name}'):
+            return status
+    return 'queued' if os.path.exists(queued_path) else None
+
+
+class LocalSubprocessRuntime:
+    """
+    Stands in for the container runtime in worker mode: the worker is a plain local python process running the
+    processor_app.py copied to the worker folder, with the pid kept in worker.pid so a restarted caller finds a worker
+    that is still running. Used to run and test worker mode without docker
+
+    """
+    def __init__(self, work_dir: str, queue_path: str):
+        self.work_dir = work_dir
+        self.queue_path = queue_path
+        self.pid_path = f'{work_dir}/worker.pid'
+        self.process = None
+
+    def pid(self):
+        try:
+            with open(self.pid_path) as pid_file:
+                return int(pid_file.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def is_running(self) -> bool:
+        if self.process is not None:
+            return self.process.poll() is None
+        pid = self.pid()
+        if pid is None:
+            return False
+        try:
+            os.kill(pid, 0)
+            return True
+        except OSError:
+            return False
+
+    def start(self, rebuild: bool = False):
+        # a running worker is left alone, run_in_worker stops it between scripts (see pause_worker) before a rebuild
+        if self.is_running():
+            return
+        # radlib has to be importable by the worker, as it is in the image
+        env = dict(os.environ)
+        root_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env['PYTHONPATH'] = os.pathsep.join([root_path] + [path for path in [env.get('PYTHONPATH')] if path])
+        with open(f'{self.work_dir}/worker.log', 'a') as log_file:
+            self.process = subprocess.Popen([sys.executable, 'processor_app.py', '--worker_queue', self.queue_path],
+                                            cwd=self.work_dir, env=env, stdout=log_file, stderr=subprocess.STDOUT,
+                                            start_new_session=True)
+        with open(self.pid_path, 'w') as pid_file:
+            pid_file.write(str(self.process.pid))
+
+    def stop(self, timeout: float = 10):
+        pid = self.process.pid if self.process is not None else self.pid()
+        if pid is not None and self.is_running():
+            os.kill(pid, signal.SIGTERM)
+            if self.process is not None:
+                try:
+                    self.process.wait(timeout)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+                    self.process.wait()
+        self.process = None
+        if os.path.exists(self.pid_path):
+            os.remove(self.pid_path)
+
+
+class DockerComposeRuntime:
+    """
+    Runs the worker as a docker compose service that stays up (restart: unless-stopped), the image is only rebuilt
+    when the worker's build files changed
+
+    """
+    def __init__(self, work_dir: str, queue_path: str):
+        self.work_dir = work_dir
+        self.queue_path = queue_path
+
+    def is_running(self) -> bool:
+        result = subprocess.run(['sudo', 'docker', 'compose', 'ps', '--status', 'running', '-q'], cwd=self.work_dir,
+                                capture_output=True)
+        return result.returncode == 0 and result.stdout.strip() != b''
+
+    def start(self, rebuild: bool = False):
+        if not rebuild and self.is_running():
+            return
+        subprocess.run(['sudo', 'docker', 'compose', 'up', '-d'] + (['--build'] if rebuild else []), cwd=self.work_dir,
+                       check=True)
+
+    def stop(self):
+        subprocess.run(['sudo', 'docker', 'compose', 'down'], cwd=self.work_dir)
+
+
+worker_runtimes = {'docker': DockerComposeRuntime, 'local': LocalSubprocessRuntime}
+
+
 class Processor:
     """
     A Processor sets up an area for scratch space, defines a "processor_script" which runs
@@ -94,6 +328,8 @@ class Processor:
 
     """
     counter = 0
+    # set on the processors run_worker makes, one per script
+    in_worker = False
 
     def __init__(self, script_path=None, scratch_path=None ):
         # save the passed-in parameters
@@ -298,6 +534,274 @@ class Processor:
         os.system(f'/bin/bash {os.path.join(work_dir, "start_docker.sh")}')
 
 
+    @classmethod
+    def warm_up(cls):
+        """
+        Called once when a worker starts, before its first script. Processors load models (and anything else that is
+        slow to set up) here and keep them on the class, so every script the worker runs reuses them
+
+        """
+        pass
+
+    def worker_path(self) -> str:
+        # folder for the worker's build files and queue, one per processor
+        return os.path.abspath(self.script_info.get('worker_path', f'docker_app/{self.processor_name()}_worker'))
+
+    def worker_files(self, queue_path: str) -> dict:
+        """
+        the worker's generated build files. Unlike run_dockerized nothing here depends on a single script: the worker
+        mounts the queue, scratch and the folders listed in the script's worker_volumes, and reads each script
+        from the queue
+
+        Parameters
+        ----------
+        queue_path: str
+            the queue folder
+
+        Returns
+        -------
+        dict of file name: content
+        """
+        service_name = self.processor_docker_image_name()
+        docker_compose_content = copy.deepcopy(docker_compose_template_yaml)
+        service = docker_compose_content['services'].pop('service_name')
+        service['image'] = service_name
+        service['volumes'] = self.worker_volumes(queue_path, self.scratch_path)
+        service['command'] = ['python', 'processor_app.py', '--worker_queue', '/queue']
+        service['restart'] = 'unless-stopped'
+        docker_compose_content['services'][service_name] = service
+        docker_compose_content['volumes'] = {'scratch': None, 'files': None, 'queue': None}
+
+        dockerfile_content = Processor.replace_tokens(dockerfile_template, self.script_info)
+        shell_script_content = Processor.replace_tokens(worker_shell_script_template,
+                                                        {'work_dir': self.worker_path()})
+        return {
+            'docker-compose.yaml': yaml.safe_dump(docker_compose_content),
+            'Dockerfile': dockerfile_content.strip(),
+            'start_worker.sh': shell_script_content.strip()
+        }
+
+    def worker_volumes(self, queue_path: str, scratch_path: str) -> list:
+        # the worker's "host:container" mounts: scratch, files, the queue and the script's worker_volumes
+        return [
+            f'{scratch_path}:/scratch',
+            '/mnt/RadServiceCache/files:/files',
+            f'{queue_path}:/queue'
+        ] + list(self.script_info.get('worker_volumes', []))
+
+    def worker_mounts(self, volumes: list) -> dict:
+        """
+        where each fileset of the script is inside the worker. run_dockerized mounts every fileset at /<fileset name>,
+        a worker that is already running can't get new mounts, so instead the fileset's folder has to be under one of
+        the worker's volumes and run_worker links /<fileset name> to it for the script. Call after set_up
+
+        Parameters
+        ----------
+        volumes: list
+            the worker's volumes, see worker_volumes
+
+        Returns
+        -------
+        dict of fileset name: {'source': path inside the worker, 'mount_point': the <fileset>_MOUNT_POINT value}
+        """
+        mounts = {}
+        for fileset in self.filesets:
+            if fileset.original_path == 'scratch':
+                continue
+            host_path = fileset.get_mount_string()[:-len(f':/{fileset.fileset_name}')]
+            source = None
+            for volume in volumes:
+                volume_host, volume_path = volume.split(':')[:2]
+                volume_host = volume_host.rstrip('/')
+                if host_path == volume_host or host_path.startswith(f'{volume_host}/'):
+                    source = f'{volume_path}{host_path[len(volume_host):]}'
+                    break
+            if source is None:
+                raise FWSFileSetException(f'fileset {fileset.fileset_name} at {host_path} is not in a worker volume, '
+                                          f'add its folder to worker_volumes')
+            mounts[fileset.fileset_name] = {'source': source, 'mount_point': f'{fileset.get_common_path()}'}
+        return mounts
+
+    def prepare_worker(self, work_dir: str, queue_path: str) -> bool:
+        """
+        write the worker's build and compose files, only when their inputs changed since the last time
+
+        Parameters
+        ----------
+        work_dir: str
+            the worker folder
+        queue_path: str
+            the queue folder
+
+        Returns
+        -------
+        True when the files were written (so the worker has to be rebuilt/restarted)
+        """
+        copy_dir = f'{os.path.dirname(os.path.dirname(__file__))}/processors/{self.processor_name()}'
+        sources = [name for name in worker_source_files if os.path.exists(f'{copy_dir}/{name}')]
+        generated = self.worker_files(queue_path)
+
+        digest = hashlib.sha256()
+        for name in sources:
+            digest.update(name.encode())
+            with open(f'{copy_dir}/{name}', 'rb') as source_file:
+                digest.update(source_file.read())
+        for name, content in sorted(generated.items()):
+            digest.update(name.encode())
+            digest.update(content.encode())
+        digest = digest.hexdigest()
+
+        hash_path = f'{work_dir}/inputs.sha256'
+        if os.path.exists(hash_path):
+            with open(hash_path) as hash_file:
+                if hash_file.read().strip() == digest:
+                    return False
+
+        os.makedirs(queue_path, exist_ok=True)
+        for name in sources:
+            shutil.copy(f'{copy_dir}/{name}', work_dir)
+        for name, content in generated.items():
+            Processor.write_file(work_dir, name, content)
+        # the hash goes last, so an interrupted write is done again
+        Processor.write_file(work_dir, 'inputs.sha256', digest)
+        return True
+
+    def run_in_worker(self, wait: bool = True, timeout: float = None) -> str:
+        """
+        run the script on this processor's worker: start the worker if it isn't running (rebuilding it, between
+        scripts, when its build files changed) and add the script to its queue. The runtime is the script's
+        worker_runtime, "docker" (default) or "local" (LocalSubprocessRuntime)
+
+        Parameters
+        ----------
+        wait: bool=True
+            wait for the worker to finish the script
+        timeout: float, optional, default None
+            most seconds to wait, for the script and for a busy worker to finish before a rebuild (default: the
+            script's worker_timeout, or worker_timeout)
+
+        Returns
+        -------
+        the script's status, see script_status
+
+        Notes
+        -----
+        A worker runs many scripts in one process, one at a time. Each script gets its own processor instance and
+        scratch folder (as from set_up), its path as self.script_path (there is no /script.yaml), and in docker its
+        filesets linked at /<fileset name> with <fileset>_MOUNT_POINT set, as run_dockerized mounts them. Fileset
+        folders have to be under a worker volume (see worker_mounts). Processors that keep per-script state on the
+        instance and read the script through self.script_path or self.script_info can run in a worker:
+        test_processor, template_processor, ingest_processor and total_segmentator_processor.
+        rrs_radsurv_processor can't yet, it rewrites its config files under /app and reinstalls requirements for every
+        script, and msft_model_processor isn't a Processor subclass
+        """
+        timeout = self.script_info.get('worker_timeout', worker_timeout) if timeout is None else timeout
+        work_dir = self.worker_path()
+        queue_path = f'{work_dir}/queue'
+        os.makedirs(work_dir, exist_ok=True)
+        if self.scratch_path is None:
+            # scratch has to be a worker volume, set_up would pick a new temporary folder for every script
+            self.scratch_path = f'{work_dir}/scratch'
+        scratch_root = self.scratch_path
+        changed = self.prepare_worker(work_dir, queue_path)
+        runtime_name = self.script_info.get('worker_runtime', 'docker')
+        runtime = worker_runtimes[runtime_name](work_dir, queue_path)
+        if changed and runtime.is_running():
+            print(f"restarting {self.processor_name()} worker once its running script is done")
+            pause_worker(queue_path, runtime, timeout)
+        resume_worker(queue_path)
+        runtime.start(rebuild=changed)
+
+        # the script's scratch folder and filesets, made here as run_dockerized does, the worker only uses them
+        self.set_up()
+        worker_script = dict(self.script_info)
+        worker_script['scratch_path'] = scratch_root
+        if runtime_name == 'docker':
+            worker_script['worker_mounts'] = self.worker_mounts(self.worker_volumes(queue_path, scratch_root))
+        worker_script_path = f'{self.scratch_path}/{os.path.basename(self.script_path)}'
+        Processor.save_script(worker_script, worker_script_path)
+
+        queued_path = enqueue_script(worker_script_path, queue_path)
+        print(f"queued {queued_path} for {self.processor_name()} worker")
+        if not wait:
+            return script_status(queue_path, queued_path)
+
+        deadline = time.monotonic() + timeout
+        for status in ['finished', 'failed']:
+            os.makedirs(f'{queue_path}/{status}', exist_ok=True)
+        with watch_backend([f'{queue_path}/finished', f'{queue_path}/failed'], recursive=False) as backend:
+            while script_status(queue_path, queued_path) not in ['finished', 'failed']:
+                if time.monotonic() >= deadline:
+                    print(f"{self.processor_name()} worker did not finish {queued_path} in {timeout}s")
+                    break
+                if not runtime.is_running():
+                    print(f"{self.processor_name()} worker stopped")
+                    break
+                backend.events(timeout=1)
+        return script_status(queue_path, queued_path)
+
+    @staticmethod
+    def link_worker_mounts(mounts: dict):
+        # inside a docker worker, point /<fileset name> at the script's fileset folders (see worker_mounts)
+        for name, mount in mounts.items():
+            link_path = f'/{name}'
+            if os.path.islink(link_path):
+                os.remove(link_path)
+            elif os.path.exists(link_path):
+                raise FWSFileSetException(f'{link_path} exists in the worker, can\'t link fileset {name} there')
+            os.symlink(mount['source'], link_path)
+
+    @classmethod
+    def run_worker(cls, queue_path: str):
+        """
+        the worker loop: warm up once, then run the scripts in queue_path one at a time, in this process, as they come
+        in. Scripts go to the active folder while they run, then to finished or failed. Scripts a previous worker left
+        in the active folder are run again
+
+        Parameters
+        ----------
+        queue_path: str
+            the queue folder
+        """
+        for status in ['active', 'finished', 'failed']:
+            os.makedirs(f'{queue_path}/{status}', exist_ok=True)
+        for script_path in requeue_active_scripts(queue_path):
+            print(f"requeued {os.path.basename(script_path)}")
+        cls.warm_up()
+        print(f"{cls.processor_name()} worker on {queue_path}")
+
+        with watch_backend([queue_path], recursive=False) as backend:
+            while True:
+                script_path = claim_next_script(queue_path)
+                if script_path is None:
+                    backend.events(timeout=60)
+                    continue
+
+                status = 'finished'
+                mount_points = []
+                try:
+                    script_info = Processor.load_script(script_path)
+                    mounts = script_info.get('worker_mounts', {})
+                    if fws_in_docker():
+                        Processor.link_worker_mounts(mounts)
+                    for name, mount in mounts.items():
+                        os.environ[f'{name}_MOUNT_POINT'] = mount['mount_point']
+                        mount_points.append(f'{name}_MOUNT_POINT')
+                    processor = cls(scratch_path=script_info.get('scratch_path'), script_path=script_path)
+                    processor.in_worker = True
+                    processor.process(script_path=script_path)
+                except Exception as e:
+                    print("Exception", e)
+                    status = 'failed'
+                for mount_point in mount_points:
+                    os.environ.pop(mount_point, None)
+                # each script logs to its own file, set_up only configures logging when nothing else has
+                for handler in logging.root.handlers[:]:
+                    logging.root.removeHandler(handler)
+                    handler.close()
+                shutil.move(script_path, f'{queue_path}/{status}/{os.path.basename(script_path)}')
+                print(f"{status} {os.path.basename(script_path)}")
+
     def set_up(self, script_path=None):
 
         class StreamToLogger:
@@ -315,10 +819,12 @@ class Processor:
 
         # get unique name for the run
         self.script_info['unique_name'] = self.get_unique_name()
-        if fws_in_docker():
+        if fws_in_docker() and not self.in_worker:
             self.scratch_path = "/scratch"
         else:
-            self.scratch_path = f'{tempfile.mkdtemp()}/{self.script_info.get("unique_name")}' if self.scratch_path is None else f'{self.scratch_path}/{self.script_info.get("unique_name")}'
+            # a worker runs many scripts, each gets its own folder under the worker's /scratch
+            scratch_root = "/scratch" if fws_in_docker() else self.scratch_path
+            self.scratch_path = f'{tempfile.mkdtemp()}/{self.script_info.get("unique_name")}' if scratch_root is None else f'{scratch_root}/{self.script_info.get("unique_name")}'
         fws_create_paths([self.scratch_path])
         # self.script_path = script_path
 
@@ -457,12 +963,18 @@ class Processor:
        parser = argparse.ArgumentParser()
        parser.add_argument("-s", "--script_path", help="path to a script file")
        parser.add_argument("-c", "--scratch_path", help="path to scratch (storage, temp file) space")
+       parser.add_argument("-w", "--worker_queue", help="run as a worker on the scripts in this queue folder")
        args = parser.parse_args()
        return args
 
     @classmethod
     def run_processor(cls, scratch_path=None, script_path=None):
         args = Processor.parse_args()
+        if args.worker_queue is not None:
+            # started as a worker (see run_in_worker)
+            cls.run_worker(args.worker_queue)
+            return
+
         if fws_in_docker() and script_path is None:
             script_path = '/script.yaml'
         elif script_path is None:
@@ -483,7 +995,10 @@ class Processor:
                 script_info['scratch_path'] = scratch_path
                 Processor.save_script(script_info, script_path)
             processor = cls(scratch_path=script_info.get("scratch_path", scratch_path), script_path=script_path)
-            processor.run_dockerized()
+            if script_info.get('worker', False):
+                processor.run_in_worker()
+            else:
+                processor.run_dockerized()
 
         else:
             # start watcher
@@ -519,12 +1034,17 @@ class Watcher():
             level=logging.INFO,
             datefmt='%Y-%m-%d %H:%M:%S')
 
-        while self.active:
-            new_logger.info("watch")
-            # check folder
-            script_paths = glob.glob(f'{self.watch_path}/*.yaml')
+        # wake up as soon as a script lands in the watch folder rather than polling it, the timeout is a safety net
+        with watch_backend([self.watch_path], recursive=False) as backend:
+            while self.active:
+                new_logger.info("watch")
+                # check folder
+                script_paths = sorted(glob.glob(f'{self.watch_path}/*.yaml'))
+
+                if len(script_paths) == 0:
+                    backend.events(timeout=60)
+                    continue
 
-            if len(script_paths) > 0:
                 # move the file with a try to avoid race condition
                 new_path = f'{self.active_path}/{os.path.basename(script_paths[0])}'
 
@@ -544,8 +1064,6 @@ class Watcher():
 
                 except Exception as e:
                     print("Exception", e)
+                    # pause?
+                    backend.events(timeout=5)
                     continue
-
-            # pause?
-            time.sleep(5)
-
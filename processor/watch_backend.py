@@ -0,0 +1,445 @@
+import collections
+import ctypes
+import ctypes.util
+import errno
+import glob
+import os
+import select
+import struct
+import sys
+import time
+
+# a change under a watched path: kind is "created", "modified", "deleted" or "overflow" (events were lost, rescan
+# path)
+WatchEvent = collections.namedtuple('WatchEvent', ['path', 'kind'])
+
+# inotify flags and event masks, see inotify(7)
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+inotify_mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                IN_DELETE_SELF | IN_MOVE_SELF)
+_inotify_event = struct.Struct('iIII')
+
+# file systems where inotify only sees changes made on this machine, so they are polled
+network_file_systems = ['nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'afs', 'ceph', 'glusterfs', 'lustre', 'gpfs', '9p',
+                        'fuse.sshfs', 'fuse.glusterfs', 'fuse.rclone', 'fuse.s3fs', 'fuse.blobfuse', 'fuse.gcsfuse']
+
+
+class WatchBackendException(Exception):
+    pass
+
+
+def _libc():
+    # libc with the inotify calls, or None when they are not there (not Linux)
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+def file_system_type(path: str) -> str:
+    """
+    the type of the file system a path is on, from the longest matching mount point in /proc/mounts
+
+    Parameters
+    ----------
+    path: str
+        a file or folder
+
+    Returns
+    -------
+    the type, eg "ext4" or "nfs4", or None when it can't be told
+    """
+    path = os.path.realpath(path)
+    best, best_type = '', None
+    try:
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # spaces in mount points are escaped as \040
+                mount_point = fields[1].replace('\\040', ' ')
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and \
+                        len(mount_point) >= len(best):
+                    best, best_type = mount_point, fields[2]
+    except OSError:
+        return None
+    return best_type
+
+
+def glob_root(pattern: str) -> str:
+    """
+    the deepest folder of a glob pattern without wildcards, the folder to watch for it
+
+    Parameters
+    ----------
+    pattern: str
+        eg "/data/in/**/*.dcm"
+
+    Returns
+    -------
+    eg "/data/in"
+    """
+    parts = pattern.replace('\\', '/').split('/')
+    root = []
+    for part in parts:
+        if glob.has_magic(part):
+            break
+        root.append(part)
+    if len(root) == len(parts):
+        # no wildcards: a folder is watched itself, a file through its folder
+        return pattern if os.path.isdir(pattern) else os.path.dirname(pattern)
+    return '/'.join(root) if len(root) > 1 or root[0] != '' else '/'
+
+
+class WatchBackend:
+    """
+    Base for the file system watch backends: raw changes under the watched folders are collected by _poll, merged per
+    path (a burst of writes to one file is one event, a file created and deleted again is none) and handed out by
+    events() once the path had no changes for debounce_seconds, or at the latest after max_delay_seconds
+
+    """
+    def __init__(self, paths: list, recursive: bool = True, debounce_seconds: float = 0.5,
+                 max_delay_seconds: float = 5.0):
+        self.recursive = recursive
+        self.debounce_seconds = debounce_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.paths = []
+        # path: [kind, first change, last change] of the changes not handed out yet, in the order they were first seen
+        self.pending = collections.OrderedDict()
+        for path in paths:
+            self.add_path(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add_path(self, path: str):
+        self.paths.append(os.path.normpath(path))
+
+    def close(self):
+        pass
+
+    def _poll(self, timeout: float) -> list:
+        # wait up to timeout seconds for raw changes, returns a list of (path, kind)
+        raise NotImplementedError("You should implement this method on a subclass of WatchBackend")
+
+    def _merge(self, path: str, kind: str):
+        now = time.monotonic()
+        previous = self.pending.get(path)
+        if previous is None:
+            self.pending[path] = [kind, now, now]
+            return
+        if previous[0] == 'created' and kind == 'deleted':
+            # came and went between two deliveries
+            del self.pending[path]
+            return
+        if previous[0] == 'deleted' and kind == 'created':
+            previous[0] = 'modified'
+        elif previous[0] not in ['created', 'overflow']:
+            previous[0] = kind
+        previous[2] = now
+
+    def events(self, timeout: float = None) -> list:
+        """
+        wait for changes under the watched paths. Each path is handed out once it has been quiet for
+        debounce_seconds, so a file still being written doesn't hold up the others
+
+        Parameters
+        ----------
+        timeout: float, optional, default None
+            most seconds to wait, None waits until there are changes
+
+        Returns
+        -------
+        a list of WatchEvents, one per changed path, empty when timeout passed without (settled) changes
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            settled = [path for path, (_, first, last) in self.pending.items()
+                       if now - last >= self.debounce_seconds or now - first >= self.max_delay_seconds]
+            if len(settled) > 0:
+                return [WatchEvent(path, self.pending.pop(path)[0]) for path in settled]
+            if deadline is not None and now >= deadline:
+                return []
+
+            # wait for more changes, or for the first pending one to settle
+            wait = None if deadline is None else deadline - now
+            if len(self.pending) > 0:
+                settle = min(min(last + self.debounce_seconds, first + self.max_delay_seconds)
+                             for _, first, last in self.pending.values()) - now
+                wait = settle if wait is None else min(wait, settle)
+            for path, kind in self._poll(max(0.0, wait) if wait is not None else None):
+                self._merge(path, kind)
+
+
+class InotifyWatchBackend(WatchBackend):
+    """
+    Linux inotify, through libc with ctypes: one watch per folder (new folders are watched as they appear), the kernel
+    queues changes and _poll blocks on the inotify file descriptor, so an idle watch costs nothing and changes are seen
+    at once. Only sees changes made on this machine, see PollingWatchBackend for network mounts
+
+    """
+    def __init__(self, paths: list, recursive: bool = True, debounce_seconds: float = 0.5,
+                 max_delay_seconds: float = 5.0):
+        self.libc = _libc()
+        if self.libc is None:
+            raise WatchBackendException('inotify is not available on this system')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatchBackendException(f'inotify_init1 failed: {os.strerror(ctypes.get_errno())}')
+        # watch descriptor: folder, folder: watch descriptor
+        self.watches = {}
+        self.watch_descriptors = {}
+        super().__init__(paths, recursive, debounce_seconds, max_delay_seconds)
+
+    def add_path(self, path: str):
+        super().add_path(path)
+        self._watch_folder(os.path.normpath(path), report=False)
+
+    def _watch_folder(self, folder: str, report: bool):
+        # watch a folder (and its subfolders when recursive), reporting what is already in it when it is new, since
+        # files can land in a new folder before its watch is added
+        folders = [folder]
+        while len(folders) > 0:
+            folder = folders.pop()
+            if folder in self.watch_descriptors:
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), inotify_mask)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise WatchBackendException('out of inotify watches, raise fs.inotify.max_user_watches')
+                continue
+            self.watches[wd] = folder
+            self.watch_descriptors[folder] = wd
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        is_folder = entry.is_dir(follow_symlinks=False)
+                        if report and (self.recursive or not is_folder):
+                            self._merge(entry.path, 'created')
+                        if is_folder and self.recursive:
+                            folders.append(entry.path)
+            except OSError:
+                continue
+
+    def _forget_folder(self, folder: str):
+        wd = self.watch_descriptors.pop(folder, None)
+        if wd is not None:
+            self.watches.pop(wd, None)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def _poll(self, timeout: float) -> list:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+
+        changes = []
+        offset = 0
+        while offset + _inotify_event.size <= len(data):
+            wd, mask, _, name_length = _inotify_event.unpack_from(data, offset)
+            offset += _inotify_event.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+
+            if mask & IN_Q_OVERFLOW:
+                # the kernel queue filled up and changes were dropped
+                changes.extend((path, 'overflow') for path in self.paths)
+                continue
+            folder = self.watches.get(wd)
+            if folder is None:
+                continue
+            if mask & IN_IGNORED or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self._forget_folder(folder)
+                continue
+
+            path = os.path.join(folder, name) if name != '' else folder
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and self.recursive:
+                    self._watch_folder(path, report=True)
+                changes.append((path, 'created' if mask & (IN_CREATE | IN_MOVED_TO) else
+                                'deleted' if mask & (IN_DELETE | IN_MOVED_FROM) else 'modified'))
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                changes.append((path, 'created'))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                changes.append((path, 'deleted'))
+            else:
+                changes.append((path, 'modified'))
+        return changes
+
+
+class PollingWatchBackend(WatchBackend):
+    """
+    Polling for file systems inotify can't see into (NFS, SMB and other network mounts): every poll is one stat per
+    known folder, and only folders whose mtime changed (a file was added, removed or renamed) are listed again. A file
+    being written in place doesn't change its folder's mtime, so the files of recently changed ("hot") folders are also
+    stat'ed each poll for hot_seconds after the folder last changed
+
+    """
+    def __init__(self, paths: list, recursive: bool = True, debounce_seconds: float = 0.5,
+                 max_delay_seconds: float = 5.0, poll_seconds: float = 1.0, hot_seconds: float = 30.0):
+        self.poll_seconds = poll_seconds
+        self.hot_seconds = hot_seconds
+        # folder: (mtime_ns, {name: (is_folder, size, mtime_ns)}), folder: when it last changed
+        self.folders = {}
+        self.hot = {}
+        self.last_poll = None
+        super().__init__(paths, recursive, debounce_seconds, max_delay_seconds)
+
+    def add_path(self, path: str):
+        super().add_path(path)
+        self._scan(os.path.normpath(path), [], report=False)
+
+    @staticmethod
+    def _list(folder: str) -> dict:
+        entries = {}
+        with os.scandir(folder) as scanned:
+            for entry in scanned:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        entries[entry.name] = (True, 0, 0)
+                    else:
+                        stat = entry.stat(follow_symlinks=False)
+                        entries[entry.name] = (False, stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    continue
+        return entries
+
+    def _scan(self, folder: str, changes: list, report: bool = True):
+        # list a folder and compare it to what was known, recursing into new subfolders
+        try:
+            mtime_ns = os.stat(folder).st_mtime_ns
+            entries = self._list(folder)
+        except OSError:
+            self._drop(folder, changes)
+            return
+        previous = self.folders.get(folder, (None, {}))[1]
+        self.folders[folder] = (mtime_ns, entries)
+        for name, state in entries.items():
+            path = os.path.join(folder, name)
+            old = previous.get(name)
+            if state[0]:
+                if old is None and self.recursive:
+                    if report:
+                        # a new folder is probably still being filled
+                        changes.append((path, 'created'))
+                        self.hot[path] = time.monotonic()
+                    self._scan(path, changes, report)
+            elif old is None:
+                if report:
+                    changes.append((path, 'created'))
+            elif old != state:
+                changes.append((path, 'modified'))
+        for name, state in previous.items():
+            if name not in entries:
+                path = os.path.join(folder, name)
+                changes.append((path, 'deleted'))
+                if state[0]:
+                    self._drop(path, changes)
+
+    def _drop(self, folder: str, changes: list):
+        # a folder went away, with everything in it
+        for known in [known for known in self.folders if known == folder or known.startswith(folder + os.sep)]:
+            for name, state in self.folders.pop(known)[1].items():
+                if not state[0]:
+                    changes.append((os.path.join(known, name), 'deleted'))
+            self.hot.pop(known, None)
+
+    def _poll(self, timeout: float) -> list:
+        # keep to one poll every poll_seconds whatever events() asks for
+        now = time.monotonic()
+        if self.last_poll is not None:
+            wait = self.last_poll + self.poll_seconds - now
+            if timeout is not None and timeout < wait:
+                time.sleep(timeout)
+                return []
+            if wait > 0:
+                time.sleep(wait)
+        self.last_poll = time.monotonic()
+
+        changes = []
+        for folder in list(self.folders):
+            if folder not in self.folders:
+                # dropped along with a parent this poll
+                continue
+            try:
+                mtime_ns = os.stat(folder).st_mtime_ns
+            except OSError:
+                self._drop(folder, changes)
+                continue
+            if mtime_ns != self.folders[folder][0]:
+                self._scan(folder, changes)
+                self.hot[folder] = self.last_poll
+            elif folder in self.hot and self.last_poll - self.hot[folder] < self.hot_seconds:
+                # files still being written keep their folder's mtime, so stat them directly
+                self._scan(folder, changes)
+            else:
+                self.hot.pop(folder, None)
+        return changes
+
+
+def watch_backend(paths: list, recursive: bool = True, debounce_seconds: float = 0.5, backend: str = 'auto',
+                  **kwargs) -> WatchBackend:
+    """
+    a watch backend for paths: inotify where it is available and every path is on a local file system, otherwise
+    polling
+
+    Parameters
+    ----------
+    paths: list
+        folders to watch
+    recursive: bool=True
+        also watch their subfolders
+    debounce_seconds: float=0.5
+        how long a path has to be quiet before its changes are handed out
+    backend: str='auto'
+        "auto", "inotify" or "polling"
+    kwargs:
+        passed on to the backend, eg poll_seconds for polling
+
+    Returns
+    -------
+    an InotifyWatchBackend or PollingWatchBackend
+    """
+    if backend == 'auto':
+        local = all(file_system_type(path) not in network_file_systems for path in paths)
+        backend = 'inotify' if local and _libc() is not None else 'polling'
+    if backend == 'inotify':
+        kwargs.pop('poll_seconds', None)
+        kwargs.pop('hot_seconds', None)
+        try:
+            return InotifyWatchBackend(paths, recursive, debounce_seconds, **kwargs)
+        except WatchBackendException:
+            pass
+    return PollingWatchBackend(paths, recursive, debounce_seconds, **kwargs)
@@ -1,9 +1,14 @@
+import asyncio
+import collections
+import contextlib
+import functools
 import glob
 import os
 import sys
 import tempfile
-import time
+import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 
 import flywheel
@@ -13,13 +18,78 @@ sys.path.append(root_path)
 
 from radlib.fw.flywheel_clients import uwhealthaz_client
 from radlib.processor.processor import Processor
-from radlib.fws.fws_utils import fws_has_more_scripts, fws_get_next_script, fws_is_flywheel_path
+from radlib.fws.fws_utils import fws_has_more_scripts, fws_get_next_script, fws_is_flywheel_path, match
+from radlib.processor.watch_backend import watch_backend, glob_root
 from radlib.processors.rrs_radsurv_processor.processor_app import RrsRadsurvProcessor
 
 
 class WatcherException(Exception):
     pass
 
+
+class FairScheduler:
+    """
+    Shares a fixed number of processing slots between watched areas: each area gets at most its own limit at a time,
+    and when a slot frees up it goes to the next waiting area in round robin order, so an area with a long backlog
+    can't starve the others. Used from one asyncio event loop
+
+    """
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.in_use = 0
+        # area: limit, area: running count, area: waiting futures (the order of areas is the round robin)
+        self.limits = {}
+        self.running = collections.Counter()
+        self.waiting = collections.OrderedDict()
+
+    def set_limit(self, area, limit: int):
+        self.limits[area] = max(1, limit)
+
+    def _dispatch(self):
+        while self.in_use < self.slots:
+            area = next((area for area, waiters in self.waiting.items()
+                         if len(waiters) > 0 and self.running[area] < self.limits.get(area, 1)), None)
+            if area is None:
+                return
+            # served areas go to the back of the line
+            self.waiting.move_to_end(area)
+            waiter = self.waiting[area].popleft()
+            if waiter.done():
+                continue
+            self.in_use += 1
+            self.running[area] += 1
+            waiter.set_result(None)
+
+    async def acquire(self, area):
+        waiter = asyncio.get_running_loop().create_future()
+        if area not in self.waiting:
+            # an area not served yet goes to the front of the line
+            self.waiting[area] = collections.deque()
+            self.waiting.move_to_end(area, last=False)
+        self.waiting[area].append(waiter)
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was granted as the wait was cancelled, hand it on
+                self.release(area)
+            raise
+
+    def release(self, area):
+        self.in_use -= 1
+        self.running[area] -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, area):
+        await self.acquire(area)
+        try:
+            yield
+        finally:
+            self.release(area)
+
+
 # TODO: 202507 csk add
 class Watcher():
     # a Watcher has a config file that contains a set of "areas" to watch, each item can contain "items" that will be "processed"
@@ -27,15 +97,28 @@ class Watcher():
     #    PathWatcher: watch one or more file paths for new files, and do something with the files
     #    ScriptWatcher: watch one or more file paths for processor scripts, and process the scripts as the come in
     #    FlywheelWatcher: watch one or more flywheel "processor analyses" for new scripts, and process the scripts as they come in
+    #
+    # watching runs on asyncio: every area is its own task, listing an area runs on a bounded executor ("flywheel" for
+    # flywheel areas, "io" for the rest) so a slow flywheel project only holds up itself, and items are processed on a
+    # third executor through a FairScheduler (max_concurrent slots, area_concurrency per area). Local areas wake up on
+    # watch backend events, the others are polled every poll_seconds
 
     def __init__(self, config_path, scratch_path=None, fw_client=None, active_processors=None):
         self.config = Watcher.load_script(config_path)
+        self.active_processors = {'rrs_radsurv_processor': RrsRadsurvProcessor, 'rrs_radsurv': RrsRadsurvProcessor} if active_processors is None else active_processors
         self.scratch_path = tempfile.mkdtemp() if scratch_path is None else scratch_path
         self.watch_log_path = f'{self.scratch_path}/{self.watch_name()}.log'
         self.active = True
         self.fw_client = uwhealthaz_client() if fw_client is None else fw_client
 
-        self.active_processors = {'rrs_radsurv_processor': RrsRadsurvProcessor, 'rrs_radsurv': RrsRadsurvProcessor} if active_processors is None else active_processors
+        self.poll_seconds = self.config.get('poll_seconds', 3.0)
+        self.max_concurrent = self.config.get('max_concurrent', 8)
+        self.io_workers = self.config.get('io_workers', 8)
+        self.flywheel_workers = self.config.get('flywheel_workers', 4)
+        self.executors = {}
+        self.scheduler = None
+        self.area_queues = {}
+        self.in_flight = {}
         self.start_logging()
 
     def watched_areas(self):
@@ -50,22 +133,179 @@ class Watcher():
 
         raise NotImplementedError("You should implement this method on a subclass of Watcher")
 
+    def area_root(self, area):
+        # the local folder to watch for changes to an area, None for areas that have to be polled (eg flywheel)
+        return None
+
+    def items_for_events(self, area, events):
+        # the items of an area affected by a batch of watch events (empty when the area was quiet for poll_seconds),
+        # by default everything in the area when anything changed
+        return self.items_for_area(area) if len(events) > 0 else []
+
+    def area_name(self, area):
+        # a hashable name for an area, areas can be eg dicts from the config
+        return area if isinstance(area, str) else yaml.safe_dump(area, sort_keys=True)
+
+    def area_kind(self, area):
+        # which executor lists an area: "flywheel" or "io"
+        return 'flywheel' if isinstance(area, str) and fws_is_flywheel_path(area) else 'io'
+
+    def area_concurrency(self, area):
+        # how many of an area's items can be processed at once
+        if isinstance(area, dict) and area.get('concurrency') is not None:
+            return area.get('concurrency')
+        return self.config.get('area_concurrency', 1)
+
+    def item_key(self, item):
+        # items with the same key are not processed twice at the same time
+        try:
+            hash(item)
+            return item
+        except TypeError:
+            return id(item)
+
+    def item_done(self, area, item, error=None):
+        # called (on the event loop) once an item was processed, error is the exception it raised
+        if error is not None:
+            self.logger.error(f'could not process {item}: {error}')
+            print("Exception", error)
+
+    async def run_blocking(self, kind, function, *args):
+        # run a blocking call on one of the bounded executors
+        return await asyncio.get_running_loop().run_in_executor(self.executors[kind],
+                                                                functools.partial(function, *args))
+
+    async def process_area_item(self, area, item, key):
+        error = None
+        try:
+            async with self.scheduler.slot(self.area_name(area)):
+                await self.run_blocking('process', self.process_item, item)
+        except Exception as e:
+            error = e
+        finally:
+            self.in_flight[self.area_name(area)].pop(key, None)
+        self.item_done(area, item, error)
+
+    def start_items(self, area, items):
+        # hand items to the scheduler, skipping ones that are still being processed
+        in_flight = self.in_flight.setdefault(self.area_name(area), {})
+        for item in items or []:
+            key = self.item_key(item)
+            if key not in in_flight:
+                in_flight[key] = asyncio.create_task(self.process_area_item(area, item, key))
+
+    async def wait_for_changes(self, area):
+        # watch backend events for a local area (empty after poll_seconds without any), None for polled areas
+        queue = self.area_queues.get(self.area_name(area))
+        if queue is None:
+            await asyncio.sleep(self.poll_seconds)
+            return None
+        try:
+            events = list(await asyncio.wait_for(queue.get(), timeout=self.poll_seconds))
+        except asyncio.TimeoutError:
+            return []
+        while not queue.empty():
+            events.extend(queue.get_nowait())
+        return events
+
+    async def watch_area(self, area):
+        kind = self.area_kind(area)
+        events = None
+        while self.active:
+            try:
+                if events is None:
+                    items = await self.run_blocking(kind, self.items_for_area, area)
+                else:
+                    items = await self.run_blocking(kind, self.items_for_events, area, events)
+                self.start_items(area, items)
+                events = await self.wait_for_changes(area)
+            except Exception as e:
+                self.logger.error(f'could not watch {self.area_name(area)}: {e}')
+                print("Exception", e)
+                events = None
+                await asyncio.sleep(self.poll_seconds)
+
+    def dispatch_events(self, roots, events):
+        # (on the event loop) hand each local area the events under its folder
+        for name, root in roots.items():
+            area_events = [event for event in events
+                           if event.path == root or event.path.startswith(root.rstrip('/') + '/')]
+            if len(area_events) > 0:
+                self.area_queues[name].put_nowait(area_events)
+
+    def pump_events(self, backend, roots, loop):
+        # (on its own thread) wait on the watch backend and pass its events to the event loop
+        while self.active:
+            events = backend.events(timeout=1)
+            if len(events) > 0:
+                loop.call_soon_threadsafe(self.dispatch_events, roots, events)
+
+    @contextlib.contextmanager
+    def runtime(self):
+        # the executors and scheduler, for the duration of a watch
+        self.executors = {'io': ThreadPoolExecutor(self.io_workers, thread_name_prefix='watch_io'),
+                          'flywheel': ThreadPoolExecutor(self.flywheel_workers, thread_name_prefix='watch_flywheel'),
+                          'process': ThreadPoolExecutor(self.max_concurrent, thread_name_prefix='watch_process')}
+        self.scheduler = FairScheduler(self.max_concurrent)
+        for area in self.watched_areas():
+            self.scheduler.set_limit(self.area_name(area), self.area_concurrency(area))
+        try:
+            yield
+        finally:
+            for executor in self.executors.values():
+                executor.shutdown(wait=True)
+
+    async def wait_for_items(self):
+        # wait for every item being processed
+        tasks = [task for in_flight in self.in_flight.values() for task in in_flight.values()]
+        if len(tasks) > 0:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def watch_once_async(self):
+        with self.runtime():
+            for area, items in zip(self.watched_areas(), await asyncio.gather(
+                    *[self.run_blocking(self.area_kind(area), self.items_for_area, area)
+                      for area in self.watched_areas()])):
+                self.start_items(area, items)
+            await self.wait_for_items()
+
+    async def watch_async(self):
+        roots = {}
+        for area in self.watched_areas():
+            if self.area_root(area) is not None:
+                roots[self.area_name(area)] = os.path.normpath(self.area_root(area))
+        self.area_queues = {name: asyncio.Queue() for name in roots}
+
+        with self.runtime(), contextlib.ExitStack() as stack:
+            if len(roots) > 0:
+                backend = stack.enter_context(watch_backend(sorted(set(roots.values()))))
+                pump = threading.Thread(target=self.pump_events, args=(backend, roots, asyncio.get_running_loop()),
+                                        daemon=True)
+                pump.start()
+            areas = [asyncio.create_task(self.watch_area(area)) for area in self.watched_areas()]
+            try:
+                await asyncio.gather(*areas)
+            finally:
+                # stop the other areas if one failed, before the executors go away
+                self.active = False
+                for task in areas:
+                    task.cancel()
+                await self.wait_for_items()
+            if len(roots) > 0:
+                await asyncio.get_running_loop().run_in_executor(None, pump.join)
+
     def watch_once(self):
-        for watched_area in self.watched_areas():
-            for item in self.items_for_area(watched_area):
-                 self.process_item(item)
-            time.sleep(3)
+        # one pass: list every area and process its items
+        asyncio.run(self.watch_once_async())
 
 
     def watch(self):
-        while self.active:
-            self.watch_once()
-            time.sleep(3)
+        asyncio.run(self.watch_async())
 
 
     def start_logging(self):
         # csk need to get the logger again when run in a separate process!
-        new_logger = logging.getLogger(self.watch_name())
+        self.logger = logging.getLogger(self.watch_name())
         print(">>>>>watcher logger! named ", self.watch_name(), "path", self.watch_log_path)
         logging.basicConfig(
             filename=self.watch_log_path,
@@ -79,7 +319,7 @@ class Watcher():
         if isinstance(script_data, str) and os.path.exists(script_data):
             # local file
             with open(script_data, 'r') as yaml_path:
-                return yaml.safe_load(script_data)
+                return yaml.safe_load(yaml_path)
         # direct data
         return script_data
 
@@ -88,7 +328,7 @@ class Watcher():
         if self.config.get('watch_name') is not None:
             return self.config.get('watch_name')
         # TODO: 202508 csk update this to "all" active_processors
-        return self.active_processors.keys[0]
+        return list(self.active_processors)[0]
 
 
 def fws_glob(area):
@@ -99,12 +339,30 @@ class FileWatcher(Watcher):
     def watched_areas(self):
         return self.config.get('paths', [])
 
+    def area_root(self, area):
+        return None if fws_is_flywheel_path(area) else glob_root(area)
+
     def items_for_area(self, area):
         if fws_is_flywheel_path(area):
             return fws_glob(area)
         else:
             return glob.glob(area, recursive=True)
 
+    def items_for_events(self, area, events):
+        # only the files that were added or changed, without globbing the area again
+        if any(event.kind == 'overflow' for event in events):
+            return self.items_for_area(area)
+        items = []
+        for event in events:
+            path = event.path.replace('\\', '/')
+            # * doesn't cross folders in a glob, only ** does
+            if event.kind == 'deleted' or not match(path, area.replace('\\', '/').replace('**', '*')) or \
+                    ('**' not in area and path.count('/') != area.replace('\\', '/').count('/')):
+                continue
+            if os.path.isfile(event.path):
+                items.append(event.path)
+        return items
+
     def process_item(self, item):
         item = item.replace('\\', '/')
         print(f'file {item}, {fws_is_flywheel_path(item)}, {os.path.exists(item)}')
@@ -114,6 +372,9 @@ class ScriptWatcher(Watcher):
     def watched_areas(self):
         return self.config.get('paths', [])
 
+    def area_root(self, area):
+        return None if fws_is_flywheel_path(area) else glob_root(area)
+
     def items_for_area(self, area):
         return glob.glob(area)
 
@@ -8,7 +8,7 @@ class TestProcessor(Processor):
 
     def processor_script(self):
         print(f'this is {self.processor_name()} processor_script!')
-        with open('/script.yaml') as f:
+        with open(self.script_path) as f:
             print(f.readlines())
 
 if __name__ == "__main__":
@@ -3,10 +3,10 @@ import shutil
 import pandas as pd
 import SimpleITK as sitk
 import glob
-import tempfile
 import pydicom
 import os
 
+from radlib.dcm.bridges import sitk_to_pydicom
 from radlib.dcm.loaders import load_dicom_series_sitk
 from radlib.dcm.utilities import set_sitk_dicom_tag, get_sitk_dicom_tag
 from radlib.fw.flywheel_clients import uwhealth_client
@@ -104,17 +104,8 @@ def use_pathology_slice_image(image_name):
     return True
 
 def convert_sitk_to_pydicom(sitk_image):
-    # Create a named temporary file with dcm suffix
-    temp = tempfile.NamedTemporaryFile(delete=False)
-    dcm_file_name = f'{temp.name}.dcm'
-
-    # save sitk_image as dcm
-    sitk.WriteImage(sitk_image, dcm_file_name)
-
-    # load with pydicom for ease of metadata editing
-    pydicom_image = pydicom.dcmread(dcm_file_name)
-
-    return pydicom_image
+    # convert in memory to pydicom for ease of metadata editing, no temporary file
+    return sitk_to_pydicom(sitk_image)
 
 def convert_pathology_images_to_dcm(excel_id):
     images = [convert_sitk_to_pydicom(image) for image in get_pathology_images(excel_id)]
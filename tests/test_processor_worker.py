@@ -0,0 +1,57 @@
+import glob
+import os
+import sys
+import time
+
+import pytest
+import yaml
+
+root_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(root_path)
+from radlib.processor.processor import LocalSubprocessRuntime
+from radlib.processors.test_processor import processor_app
+
+
+@pytest.fixture
+def worker_path(tmp_path, monkeypatch):
+    # Processor parses the command line, keep pytest's arguments away from it
+    monkeypatch.setattr(sys, 'argv', ['processor_app.py'])
+    worker_path = str(tmp_path / 'worker')
+    yield worker_path
+    LocalSubprocessRuntime(worker_path, f'{worker_path}/queue').stop()
+
+
+def run_script(tmp_path, worker_path, **values):
+    script_info = {'filesets': {}, 'worker': True, 'worker_runtime': 'local', 'worker_path': worker_path}
+    script_info.update(values)
+    script_path = str(tmp_path / f'script_{time.time_ns()}.yaml')
+    with open(script_path, 'w') as script_file:
+        yaml.safe_dump(script_info, script_file)
+    processor = processor_app.TestProcessor(script_path=script_path, scratch_path=str(tmp_path / 'scratch'))
+    return processor.run_in_worker(timeout=120)
+
+
+def read(path):
+    with open(path) as read_file:
+        return read_file.read().strip()
+
+
+def test_run_in_worker(tmp_path, worker_path):
+    queue_path = f'{worker_path}/queue'
+
+    assert run_script(tmp_path, worker_path) == 'finished'
+    assert len(glob.glob(f'{queue_path}/finished/*.yaml')) == 1
+    pid = read(f'{worker_path}/worker.pid')
+    digest = read(f'{worker_path}/inputs.sha256')
+
+    # nothing changed: the same worker runs the next script
+    assert run_script(tmp_path, worker_path) == 'finished'
+    assert len(glob.glob(f'{queue_path}/finished/*.yaml')) == 2
+    assert read(f'{worker_path}/worker.pid') == pid
+    assert read(f'{worker_path}/inputs.sha256') == digest
+
+    # a changed input (here the compose volumes) restarts the worker
+    assert run_script(tmp_path, worker_path, worker_volumes=[f'{tmp_path}:/data']) == 'finished'
+    assert len(glob.glob(f'{queue_path}/finished/*.yaml')) == 3
+    assert read(f'{worker_path}/worker.pid') != pid
+    assert read(f'{worker_path}/inputs.sha256') != digest